@@ -0,0 +1,515 @@
+'''
+Local, on-disk caches used to avoid recomputing or re-extracting data.
+'''
+
+import os
+import time
+import uuid
+import pickle
+import sqlite3
+import hashlib
+import inspect
+import datetime
+import functools
+import threading
+import contextlib
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+import pandas as pd
+
+import pemi
+import pemi.files
+
+# Parquet converts object columns of numbers to float columns and of datetimes to
+# datetime64 columns, and stores decimals with a single scale for the whole column
+COLUMNAR_SAFE_TYPES = (str, bytes, bool, datetime.date)
+COLUMNAR_UNSAFE_TYPES = (datetime.datetime,)
+
+def _is_columnar_safe(df):
+    '''
+    Parquet can only faithfully round-trip dataframes with string column names and
+    object columns that contain a single kind of string, bytes, boolean or date value.
+    '''
+    if not all(isinstance(col, str) for col in df.columns) or df.columns.has_duplicates:
+        return False
+
+    for col in df.columns:
+        if df[col].dtype != object:
+            continue
+
+        value_types = set(df[col].dropna().map(type))
+        if len(value_types) > 1:
+            return False
+        if not all(
+                issubclass(value_type, COLUMNAR_SAFE_TYPES)
+                and not issubclass(value_type, COLUMNAR_UNSAFE_TYPES)
+                for value_type in value_types
+        ):
+            return False
+    return True
+
+def _parquet_available():
+    try:
+        import pyarrow #pylint: disable=unused-import,import-outside-toplevel
+    except ImportError:
+        return False
+    return True
+
+def dump_frame(df, path):
+    '''
+    Writes a dataframe to ``path``.  Uses the Parquet columnar format when pyarrow
+    is installed and the dataframe can be faithfully represented, otherwise falls back
+    to pickling.
+
+    Returns:
+        str: The format used to write the file (``'parquet'`` or ``'pickle'``).
+    '''
+    if _parquet_available() and _is_columnar_safe(df):
+        df.to_parquet(path, engine='pyarrow')
+        return 'parquet'
+
+    with open(path, 'wb') as frame_file:
+        pickle.dump(df, frame_file, protocol=pickle.HIGHEST_PROTOCOL)
+    return 'pickle'
+
+def load_frame(path, fmt):
+    'Reads a dataframe written by ``dump_frame``'
+    if fmt == 'parquet':
+        return pd.read_parquet(path, engine='pyarrow')
+
+    with open(path, 'rb') as frame_file:
+        return pickle.load(frame_file)
+
+
+def fingerprint(*values):
+    '''
+    Builds a stable hex digest from a collection of values.  Values are hashed via their
+    ``repr``, with dictionaries sorted by key so that the digest does not depend on
+    insertion order.
+    '''
+    def normalize(value):
+        if isinstance(value, dict):
+            return sorted((repr(k), normalize(v)) for k, v in value.items())
+        if isinstance(value, (list, tuple)):
+            return [normalize(v) for v in value]
+        return repr(value)
+
+    return hashlib.sha256(repr(normalize(values)).encode('utf-8')).hexdigest()
+
+def schema_fingerprint(schema):
+    'Builds a fingerprint of the fields and field metadata of a ``pemi.Schema``'
+    if schema is None:
+        return fingerprint(None)
+
+    return fingerprint([
+        (name, type(field).__name__, {k: v for k, v in field.metadata.items() if k != 'faker'})
+        for name, field in schema.items()
+    ])
+
+def frame_fingerprint(df):
+    '''
+    Builds a fingerprint of the contents of a dataframe (index, columns, dtypes and values).
+    Rows are hashed with pandas' vectorized row hashing, falling back to pickling for
+    columns containing values that cannot be hashed (e.g., lists or dicts).
+    '''
+    digest = hashlib.sha256()
+    digest.update(repr([(str(col), str(dtype)) for col, dtype in df.dtypes.items()]).encode())
+    try:
+        digest.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    except TypeError:
+        digest.update(pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL))
+    return digest.hexdigest()
+
+def _code_version(pipe_class):
+    try:
+        return fingerprint(inspect.getsource(pipe_class))
+    except (OSError, TypeError):
+        return None
+
+def memoize_flow(cache, version=None, key=None):
+    '''
+    A class decorator for pipes that are pure functions of their sources and ``params``.
+    Before the pipe flows, its sources are fingerprinted (see ``frame_fingerprint``) along
+    with its ``params`` and a code version.  If the cache holds the targets produced for
+    the same fingerprint, they are restored instead of calling ``flow``; otherwise the pipe
+    flows and its targets are stored in the cache.
+
+    Sources and targets are read with ``to_pd`` and restored with ``from_pd``.
+
+    Args:
+        cache (LocalFileCache): Cache used to store the targets.  Use the ``max_bytes``
+          option of the cache to bound its size, and its ``stats`` for hit/miss statistics.
+        version: A code version included in the fingerprint.  Defaults to a fingerprint of
+          the source code of the pipe class, so changing the class invalidates old results.
+        key (function): If provided, a function of the pipe returning additional values to
+          include in the fingerprint (e.g., attributes that are not part of ``params``).
+
+    Example:
+        Memoizing an expensive lookup pipe::
+
+            @pemi.cache.memoize_flow(pemi.cache.LocalFileCache('.pemi-cache', max_bytes=2**30))
+            class BuildLookupsPipe(pemi.Pipe):
+                ...
+    '''
+    def decorate(pipe_class):
+        flow = pipe_class.flow
+        code_version = version if version is not None else _code_version(pipe_class)
+
+        @functools.wraps(flow)
+        def memoized_flow(self):
+            memo_key = fingerprint(
+                '{}.{}'.format(pipe_class.__module__, pipe_class.__qualname__),
+                code_version,
+                self.params,
+                key(self) if key is not None else None,
+                {name: frame_fingerprint(source.to_pd()) for name, source in self.sources.items()}
+            )
+
+            targets = cache.get(memo_key)
+            if targets is not None:
+                pemi.log.info("Restored targets of '%s' from the flow cache", self.name)
+                for name, df in targets.items():
+                    self.targets[name].from_pd(df)
+                return None
+
+            result = flow(self)
+            cache.put(memo_key, {name: target.to_pd() for name, target in self.targets.items()})
+            return result
+
+        pipe_class.flow = memoized_flow
+        return pipe_class
+    return decorate
+
+
+class LocalFileCache:
+    '''
+    A cache of dataframes (or any other picklable value) stored in files in a local
+    directory.  Entries may expire after a time-to-live, and the least recently used
+    entries are evicted when the total size of the cache grows beyond a limit.
+
+    The directory may be shared by several processes (e.g., by pipes flowed with the
+    ``'process'`` executor): changes to the index of entries are made under an exclusive
+    file lock (where ``fcntl`` is available).  The last access of an entry is recorded as
+    the modification time of its file, so lookups do not rewrite the index.
+
+    Args:
+        path (str): Directory where the cache is stored.  Created if it does not exist.
+        ttl (float): Number of seconds an entry remains valid (default: no expiration).
+        max_bytes (int): Maximum total size of the cached files (default: unlimited).
+
+    Attributes:
+        hits (int): Number of successful lookups made through this cache object.
+        misses (int): Number of unsuccessful lookups made through this cache object.
+        evictions (int): Number of entries evicted to keep the cache under ``max_bytes``.
+
+    Example:
+        Caching the result of an expensive computation::
+
+            cache = LocalFileCache('.pemi-cache', ttl=3600, max_bytes=2**30)
+            df = cache.get('lookups')
+            if df is None:
+                df = build_lookups()
+                cache.put('lookups', df)
+    '''
+
+    INDEX_FILE = 'index.json'
+    LOCK_FILE = 'index.lock'
+
+    def __init__(self, path, ttl=None, max_bytes=None):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
+
+        os.makedirs(self.path, exist_ok=True)
+
+    @property
+    def stats(self):
+        'A dictionary summarizing cache activity and size'
+        index = self._read_index()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(index),
+            'bytes': sum(entry['bytes'] for entry in index.values())
+        }
+
+    @contextlib.contextmanager
+    def _locked(self):
+        'Holds the lock of this object and, where supported, the lock of the index file'
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+
+            with open(os.path.join(self.path, self.LOCK_FILE), 'a', encoding='utf-8') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _index_path(self):
+        return os.path.join(self.path, self.INDEX_FILE)
+
+    def _read_index(self):
+        return pemi.files.read_json(self._index_path(), default={})
+
+    def _write_index(self, index):
+        pemi.files.write_json(self._index_path(), index)
+
+    def _entry_path(self, entry):
+        return os.path.join(self.path, entry['file'])
+
+    def _remove_entry(self, index, key):
+        entry = index.pop(key)
+        try:
+            os.remove(self._entry_path(entry))
+        except FileNotFoundError:
+            pass
+
+    def _expired(self, entry):
+        return self.ttl is not None and time.time() - entry['created'] > self.ttl
+
+    def _accessed(self, entry):
+        try:
+            return os.path.getmtime(self._entry_path(entry))
+        except FileNotFoundError:
+            return entry['created']
+
+    def __contains__(self, key):
+        index = self._read_index()
+        return key in index and not self._expired(index[key])
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key, default=None):
+        '''
+        Returns the value cached under ``key``, or ``default`` if there is no
+        valid entry for the key.
+        '''
+        entry = self._read_index().get(key)
+        if entry is not None and self._expired(entry):
+            pemi.log.debug('Cache entry %s in %s has expired', key, self.path)
+            self._discard(key, entry)
+            entry = None
+
+        if entry is None:
+            self._count(hit=False)
+            return default
+
+        try:
+            value = self._load(entry)
+            os.utime(self._entry_path(entry))
+        except FileNotFoundError:
+            self._discard(key, entry)
+            self._count(hit=False)
+            return default
+
+        self._count(hit=True)
+        return value
+
+    def _discard(self, key, entry):
+        'Removes an entry, unless it has been replaced since it was read'
+        with self._locked():
+            index = self._read_index()
+            if index.get(key) == entry:
+                self._remove_entry(index, key)
+                self._write_index(index)
+
+    def put(self, key, value):
+        'Stores ``value`` in the cache under ``key``'
+        filename = uuid.uuid4().hex
+        filepath = os.path.join(self.path, filename)
+        if isinstance(value, pd.DataFrame):
+            fmt = dump_frame(value, filepath)
+        else:
+            fmt = 'object'
+            with open(filepath, 'wb') as value_file:
+                pickle.dump(value, value_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+        with self._locked():
+            index = self._read_index()
+            if key in index:
+                self._remove_entry(index, key)
+
+            index[key] = {
+                'file': filename,
+                'format': fmt,
+                'bytes': os.path.getsize(filepath),
+                'created': time.time()
+            }
+            self._evict(index)
+            self._write_index(index)
+
+    def invalidate(self, key=None):
+        'Removes the entry for ``key`` from the cache, or all entries if no key is given'
+        with self._locked():
+            index = self._read_index()
+            keys = list(index.keys()) if key is None else [key]
+            for k in keys:
+                if k in index:
+                    self._remove_entry(index, k)
+            self._write_index(index)
+
+    def _evict(self, index):
+        for key in [k for k, entry in index.items() if self._expired(entry)]:
+            self._remove_entry(index, key)
+
+        if self.max_bytes is None:
+            return
+
+        total_bytes = sum(entry['bytes'] for entry in index.values())
+        accessed = {key: self._accessed(entry) for key, entry in index.items()}
+        for key in sorted(index, key=accessed.get):
+            if total_bytes <= self.max_bytes:
+                break
+            total_bytes -= index[key]['bytes']
+            pemi.log.debug('Evicting cache entry %s from %s', key, self.path)
+            self._remove_entry(index, key)
+            self.evictions += 1
+
+    def _load(self, entry):
+        filepath = self._entry_path(entry)
+        if entry['format'] == 'object':
+            with open(filepath, 'rb') as value_file:
+                return pickle.load(value_file)
+        return load_frame(filepath, entry['format'])
+
+
+class RowCache:
+    '''
+    A persistent key-value store of per-row results, kept in a local SQLite database.
+    When the store holds more than ``max_rows`` rows, the least recently used rows are
+    evicted.  Used by ``PdLambdaPipe`` to memoize expensive row-level functions.
+
+    Args:
+        path (str): Path of the SQLite database file.  Created if it does not exist.
+        max_rows (int): Maximum number of rows kept in the store (default: unlimited).
+
+    Attributes:
+        hits (int): Number of keys found by ``get_many`` through this object.
+        misses (int): Number of keys not found by ``get_many`` through this object.
+        evictions (int): Number of rows evicted to keep the store under ``max_rows``.
+    '''
+
+    BATCH_SIZE = 500
+
+    def __init__(self, path, max_rows=None):
+        self.path = path
+        self.max_rows = max_rows
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
+
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS rows '
+                '(key TEXT PRIMARY KEY, value BLOB, accessed REAL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS rows_accessed ON rows (accessed)')
+
+    def _connect(self):
+        return contextlib.closing(sqlite3.connect(self.path, timeout=60))
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        'Holds the lock and a connection that commits (or rolls back) when the block ends'
+        with self._lock, self._connect() as conn:
+            with conn:
+                yield conn
+
+    @property
+    def stats(self):
+        'A dictionary summarizing cache activity and size'
+        with self._lock, self._connect() as conn:
+            rows = conn.execute('SELECT COUNT(*) FROM rows').fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'rows': rows}
+
+    def _batches(self, keys):
+        keys = list(keys)
+        for start in range(0, len(keys), self.BATCH_SIZE):
+            yield keys[start:start + self.BATCH_SIZE]
+
+    def get_many(self, keys):
+        'Returns a dictionary of the values stored for those of ``keys`` that are found'
+        keys = set(keys)
+        found = {}
+        with self._transaction() as conn:
+            now = time.time()
+            for batch in self._batches(keys):
+                placeholders = ','.join('?' * len(batch))
+                found.update(
+                    (key, pickle.loads(value)) for key, value in conn.execute(
+                        'SELECT key, value FROM rows WHERE key IN ({})'.format(placeholders),
+                        batch
+                    )
+                )
+                conn.execute(
+                    'UPDATE rows SET accessed = ? WHERE key IN ({})'.format(placeholders),
+                    [now] + batch
+                )
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items):
+        'Stores the values of a dictionary of keys and values'
+        with self._transaction() as conn:
+            now = time.time()
+            conn.executemany(
+                'INSERT OR REPLACE INTO rows (key, value, accessed) VALUES (?, ?, ?)',
+                [
+                    (key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), now)
+                    for key, value in items.items()
+                ]
+            )
+            self._evict(conn)
+
+    def _evict(self, conn):
+        if self.max_rows is None:
+            return
+
+        excess = conn.execute('SELECT COUNT(*) FROM rows').fetchone()[0] - self.max_rows
+        if excess > 0:
+            conn.execute(
+                'DELETE FROM rows WHERE key IN '
+                '(SELECT key FROM rows ORDER BY accessed LIMIT ?)',
+                (excess,)
+            )
+            self.evictions += excess
+            pemi.log.debug('Evicted %d rows from %s', excess, self.path)
+
+    def invalidate(self):
+        'Removes all rows from the store'
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM rows')
+
+
+def row_keys(df, columns, namespace=''):
+    '''
+    Builds a key for each row of a dataframe from the values of ``columns``.  Keys hold the
+    ``repr`` of the values themselves rather than a hash of them, so rows with different
+    values (including values of different types) never share a key.  Keys are prefixed
+    with ``namespace``.
+    '''
+    rows = df[list(columns)].astype(object).itertuples(index=False, name=None)
+    return ['{}:{!r}'.format(namespace, row) for row in rows]
@@ -0,0 +1,223 @@
+'''
+Checkpoint files holding the data subjects of a pipe and all of its nested pipes.
+
+A checkpoint is written by pickling the pipe with ``Pipe.to_pickle`` using pickle protocol 5.
+The large data buffers of the subjects (e.g., the numeric column data of dataframes) are
+collected out-of-band and written to the file one at a time, directly from the memory
+that holds them, so writing a checkpoint never holds a second copy of the data.
+Restoring a checkpoint memory-maps the file, so uncompressed dataframes reference the
+mapped pages rather than being copied into memory.
+
+``CheckpointHook`` checkpoints the targets of each pipe of an execution plan as soon as it
+has flowed, so that a failed run can be resumed.
+'''
+
+import os
+import re
+import mmap
+import bz2
+import gzip
+import json
+import lzma
+import zlib
+import pickle
+import time
+import struct
+import threading
+
+import pemi
+import pemi.files
+import pemi.hooks
+
+MAGIC = b'PEMICKPT'
+ALIGNMENT = 64
+
+COMPRESSORS = {
+    'zlib': (zlib.compress, zlib.decompress),
+    'gzip': (gzip.compress, gzip.decompress),
+    'bz2': (bz2.compress, bz2.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+}
+
+class CheckpointError(Exception): pass
+
+def write_checkpoint(pipe, path, compression=None):
+    '''
+    Writes the data subjects of a pipe (and all nested pipes) to a checkpoint file.  The
+    file is written to a temporary path and moved into place once complete.
+
+    Args:
+        pipe (pemi.Pipe): The pipe to checkpoint.
+        path (str): Path of the checkpoint file.
+        compression (str): If provided, each part of the checkpoint is compressed with
+          ``'zlib'``, ``'gzip'``, ``'bz2'`` or ``'lzma'``.  Compressed checkpoints are
+          smaller, but must be decompressed into memory when restored.
+
+    Returns:
+        int: The size of the checkpoint file in bytes.
+    '''
+    if compression is not None and compression not in COMPRESSORS:
+        raise ValueError('Unknown checkpoint compression: {}'.format(compression))
+    if pickle.HIGHEST_PROTOCOL < 5:
+        raise CheckpointError('Checkpoints require pickle protocol 5')
+
+    buffers = []
+    pickled = pipe.to_pickle(buffer_callback=buffers.append)
+
+    segments = []
+    with pemi.files.atomic_write(path, 'wb') as checkpoint_file:
+        checkpoint_file.write(MAGIC)
+        for data in [memoryview(pickled)] + [buf.raw() for buf in buffers]:
+            if compression is not None:
+                data = COMPRESSORS[compression][0](data)
+
+            offset = checkpoint_file.tell()
+            padding = -offset % ALIGNMENT
+            checkpoint_file.write(b'\0' * padding)
+            checkpoint_file.write(data)
+            segments.append([offset + padding, len(data)])
+
+        index = json.dumps({'compression': compression, 'segments': segments}).encode('utf-8')
+        checkpoint_file.write(index)
+        checkpoint_file.write(struct.pack('<Q', len(index)))
+        nbytes = checkpoint_file.tell()
+
+    pemi.log.debug('Wrote a checkpoint of %d bytes for pipe %s to %s', nbytes, pipe, path)
+    return nbytes
+
+def read_checkpoint(pipe, path):
+    '''
+    Loads the data subjects stored in a checkpoint file into a pipe.  The file is mapped
+    copy-on-write, so the dataframes of uncompressed checkpoints reference the mapped pages
+    directly and are only read from disk as they are accessed.
+
+    Returns:
+        pemi.Pipe: The pipe.
+    '''
+    with open(path, 'rb') as checkpoint_file:
+        mapped = mmap.mmap(checkpoint_file.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    view = memoryview(mapped)
+    if view[:len(MAGIC)] != MAGIC:
+        raise CheckpointError('{} is not a pemi checkpoint'.format(path))
+
+    index_length = struct.unpack('<Q', view[-8:])[0]
+    index = json.loads(bytes(view[-8 - index_length:-8]).decode('utf-8'))
+
+    segments = [view[offset:offset + length] for offset, length in index['segments']]
+    if index['compression'] is not None:
+        decompress = COMPRESSORS[index['compression']][1]
+        segments = [bytearray(decompress(segment)) for segment in segments]
+
+    return pipe.from_pickle(segments[0], buffers=segments[1:])
+
+
+def step_paths(plan):
+    '''
+    Returns a path for each flow step of a plan that identifies the pipe it flows across
+    runs (e.g., ``'MyJob/nested/pipe'``), even when nested pipes are flattened.
+    '''
+    flattened = {id(pipe) for pipe in plan.flattened}
+    parent_paths = {}
+    pending = [
+        (parent, parent.__class__.__name__) for parent in plan.parents
+        if id(parent) not in flattened
+    ]
+    while pending:
+        parent, path = pending.pop()
+        parent_paths[id(parent)] = path
+        for name, pipe in parent.pipes.items():
+            if pipe is not parent and id(pipe) in flattened:
+                pending.append((pipe, '{}/{}'.format(path, name)))
+
+    return {
+        step: '{}/{}'.format(parent_paths[id(step.parent)], step.pipe_name)
+        for step in plan.flow_steps
+    }
+
+
+class CheckpointHook(pemi.hooks.ExecutionHook):
+    '''
+    Persists the targets of each pipe to a run directory as soon as the pipe has flowed,
+    along with a record that the pipe completed.  If a run fails, a resumed run (see
+    ``resume``) restores the targets of the completed pipes instead of flowing them again,
+    so execution restarts from the pipes that failed or never ran.
+
+    Targets are written with ``write_checkpoint``.
+
+    Args:
+        run_dir (str): Directory holding the checkpoints and completion records of a run.
+          Created if it does not exist.
+        compression (str): Compression used for the checkpoint files (see
+          ``write_checkpoint``).
+
+    Attributes:
+        restored (list): Paths (see ``step_paths``) of the pipes restored by ``resume``.
+    '''
+
+    LEDGER_FILE = 'completed.json'
+
+    def __init__(self, run_dir, compression=None):
+        self.run_dir = run_dir
+        self.compression = compression
+        self.restored = []
+        self._paths = {}
+        self._lock = threading.Lock()
+        self._ledger = pemi.files.JsonStore(os.path.join(self.run_dir, self.LEDGER_FILE))
+        os.makedirs(self.run_dir, exist_ok=True)
+
+    def completed(self):
+        'Returns the completion records of the pipes that have been checkpointed'
+        return self._ledger.read()
+
+    def _complete(self, path, filename):
+        with self._lock:
+            self._ledger.set(path, {'file': filename, 'completed': time.time()})
+
+    def reset(self):
+        'Removes all checkpoints and completion records, so that the next run starts over'
+        for record in self.completed().values():
+            try:
+                os.remove(os.path.join(self.run_dir, record['file']))
+            except FileNotFoundError:
+                pass
+        if os.path.exists(self._ledger.path):
+            os.remove(self._ledger.path)
+
+    def resume(self, plan):
+        '''
+        Restores the targets of the pipes that completed in a previous run and returns a plan
+        that no longer flows them.  Connections from the restored pipes are still made.
+        '''
+        completed = self.completed()
+        restored = set()
+        for step, path in step_paths(plan).items():
+            if path not in completed:
+                continue
+
+            holder = read_checkpoint(
+                pemi.Pipe(), os.path.join(self.run_dir, completed[path]['file'])
+            )
+            for name, target in holder.targets.items():
+                target.pipe = step.pipe
+                step.pipe.targets[name] = target
+
+            restored.add(step)
+            self.restored.append(path)
+            pemi.log.info('Restored pipe %s from a checkpoint', path)
+
+        return plan._subplan(set(plan.steps) - restored) #pylint: disable=protected-access
+
+    def before_run(self, plan):
+        self._paths = step_paths(plan)
+
+    def after_flow(self, step):
+        path = self._paths[step]
+        filename = '{}.ckpt'.format(re.sub(r'[^A-Za-z0-9_.-]', '_', path))
+
+        holder = pemi.Pipe()
+        holder.targets.update(step.pipe.targets)
+        write_checkpoint(
+            holder, os.path.join(self.run_dir, filename), compression=self.compression
+        )
+        self._complete(path, filename)
@@ -1,13 +1,16 @@
+import threading
 from collections import defaultdict
 
-import dask
-import dask.dot
-
 import pemi
-
-class DagValidationError(Exception): pass
-
-class PipeConnection:
+import pemi.execution
+import pemi.executors
+import pemi.hooks
+import pemi.checkpoint
+import pemi.tracing
+import pemi.metrics
+from pemi.execution import DagValidationError
+
+class PipeConnection: #pylint: disable=too-many-instance-attributes
     def __init__(self, parent, from_pipe_name, from_subject_name):
         self.parent = parent
         self.from_pipe_name = from_pipe_name
@@ -15,6 +18,8 @@ class PipeConnection:
         self.group = None
         self.to_pipe_name = None
         self.to_subject_name = None
+        self.streaming = False
+        self.max_chunks = None
 
 
     def to(self, to_pipe_name, to_subject_name): #pylint: disable=invalid-name
@@ -53,12 +58,34 @@ class PipeConnection:
         return self.parent is self.to_pipe
 
     def connect(self):
-        self.to_subject.connect_from(self.from_subject)
+        with pemi.tracing.connect_span(self):
+            if self.streaming:
+                self.to_subject.attach_stream(self.from_subject.open_stream(self.max_chunks))
+            else:
+                self.to_subject.connect_from(self.from_subject)
 
     def group_as(self, name):
         self.group = name
         return self
 
+    def stream(self, max_chunks=2):
+        '''
+        Streams the data of this connection in chunks.  The downstream pipe flows at the
+        same time as the upstream pipe and receives chunks as soon as they are produced
+        (see ``PdDataSubject.put_chunk`` and ``PdDataSubject.iter_chunks``).  At most
+        ``max_chunks`` chunks are held between the pipes; the upstream pipe waits for the
+        downstream pipe to catch up, which caps the memory used by the connection.
+
+        Both subjects must be ``PdDataSubject`` objects and both pipes must be flowed by a
+        native executor (the distributed executor is not supported).  Pipes that are not
+        chunk-capable still work: they produce their data as a single chunk, or read the
+        whole stream when they access ``df``.  Chunks sent downstream are not kept in the
+        upstream subject.
+        '''
+        self.streaming = True
+        self.max_chunks = max_chunks
+        return self
+
     def __str__(self):
         return 'PipeConnection: {}.{} -> {}.{}'.format(
             self.from_pipe,
@@ -70,49 +97,377 @@ class PipeConnection:
     def __repr__(self):
         return '<{}>'.format(self.__str__())
 
+class SparkPersistPlanner(pemi.hooks.ExecutionHook):
+    '''
+    Plans when Spark data subjects should be persisted.  Spark dataframes are lazy, so when
+    the target of one pipe is consumed by more than one downstream pipe (e.g., via a
+    ``SparkForkPipe``), each consumer would recompute its entire lineage.  The planner counts
+    the downstream consumers of each Spark subject, persists subjects with more than one
+    consumer before they are connected, and unpersists them once all of the consumers
+    have flowed.
+
+    Consumers are counted over the steps of an execution plan, so the connections of
+    flattened nested pipes are planned along with the top level connections.  Subjects and
+    consumers are identified by the pipe that owns their connections as well as by name,
+    so nested pipes with the same name do not collide.
+
+    Subjects that are also connected to the targets of the parent pipe are never unpersisted,
+    since they may still be used after the connections have flowed.
+
+    Args:
+        plan: The ``ExecutionPlan`` to plan, or a list of ``PipeConnection`` objects, which
+          are compiled into a plan without flattening.
+        storage_level: A ``pyspark.StorageLevel``, or the name of one (e.g., 'MEMORY_ONLY').
+
+    Attributes:
+        consumers (dict): The keys (see ``pemi.execution.Step.key``) of the flow steps that
+          consume each planned subject, keyed by ``subject_key``.
+    '''
+
+    def __init__(self, plan, storage_level='MEMORY_AND_DISK'):
+        if not isinstance(plan, pemi.execution.ExecutionPlan):
+            plan = pemi.execution.ExecutionPlan(plan)
+
+        self.storage_level = storage_level
+        self.consumers = self._plan(plan)
+        self.remaining = {key: set(consumers) for key, consumers in self.consumers.items()}
+        self.persisted = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def subject_key(conn):
+        'Identifies the source subject of a connection by its parent, pipe and subject names'
+        return (id(conn.parent), conn.from_pipe_name, conn.from_subject_name)
+
+    @staticmethod
+    def _plan(plan):
+        from pemi.pipes.patterns import ForkPipe #pylint: disable=import-outside-toplevel
+
+        top_level = {id(parent) for parent in plan.parents}
+
+        def consumers_of(step, visited):
+            if step.kind == 'connect' and step.conn.is_to_self and (
+                    id(step.conn.parent) in top_level or not step.dependents):
+                return {('self', id(step.conn.parent), 'self')}
+
+            consumers = set()
+            for dependent in step.dependents:
+                if dependent.kind == 'connect':
+                    consumers |= consumers_of(dependent, visited)
+                elif isinstance(dependent.pipe, ForkPipe) and dependent.key not in visited:
+                    consumers |= consumers_of(dependent, visited | {dependent.key})
+                else:
+                    consumers.add(dependent.key)
+            return consumers
+
+        plan_consumers = defaultdict(set)
+        for step in plan.steps:
+            if step.kind != 'connect' or step.conn.streaming:
+                continue
+            if not isinstance(step.conn.from_subject, pemi.SparkDataSubject):
+                continue
+
+            plan_consumers[SparkPersistPlanner.subject_key(step.conn)] |= consumers_of(
+                step, frozenset()
+            )
+        return {
+            key: consumers for key, consumers in plan_consumers.items() if len(consumers) > 1
+        }
+
+    def _resolve_storage_level(self):
+        if isinstance(self.storage_level, str):
+            import pyspark #pylint: disable=import-outside-toplevel
+            return getattr(pyspark.StorageLevel, self.storage_level)
+        return self.storage_level
+
+    def before_connect(self, conn):
+        'Persists the source of the connection if it has more than one consumer'
+        key = self.subject_key(conn)
+        if key not in self.consumers:
+            return
+
+        with self._lock:
+            if key in self.persisted:
+                return
+
+            subject = conn.from_subject
+            if subject.df is None or subject.df.is_cached:
+                return
+
+            pemi.log.debug(
+                'Persisting %s for consumers %s', subject,
+                sorted(name for _, _, name in self.consumers[key])
+            )
+            subject.df = subject.df.persist(self._resolve_storage_level())
+            self.persisted[key] = subject.df
+
+    def after_flow(self, step):
+        'Unpersists any subjects whose consumers have all flowed'
+        unpersist = []
+        with self._lock:
+            for key in list(self.persisted):
+                self.remaining[key].discard(step.key)
+                if len(self.remaining[key]) == 0:
+                    unpersist.append((key, self.persisted.pop(key, None)))
+
+        for key, df in unpersist:
+            if df is not None:
+                pemi.log.debug('Unpersisting %s.%s', *key[1:])
+                df.unpersist()
+
+
 class DaskPipe: #pylint: disable=too-few-public-methods
     'DaskPipe is just a wrapper around Pipe that allows us to use the Pipes in the context of Dask'
 
-    def __init__(self, pipe, flow=True):
+    def __init__(self, pipe, flow=True, on_flow=None):
         self.pipe = pipe
         self.flow = flow
+        self.on_flow = on_flow
 
     def __call__(self, *args):
         pemi.log.info('DaskPipe flowing pipe %s', self.pipe)
         if self.flow:
-            self.pipe.flow()
+            with pemi.execution.instrument_flow(self.pipe):
+                self.pipe.flow()
+            if self.on_flow:
+                self.on_flow()
         return self
 
     def __str__(self):
         return self.pipe.name
 
 
+class FlowOptions: #pylint: disable=too-many-instance-attributes,too-few-public-methods
+    '''
+    Options that control how ``PipeConnections.flow`` executes the connections of a pipe
+    with a native executor.  ``PipeConnections.flow`` accepts these options as keyword
+    arguments.
+
+    Args:
+        executor: The native executor used to flow the pipes.  Either ``'serial'``,
+          ``'thread'``, ``'process'``, ``'asyncio'`` or a ``pemi.executors.Executor``
+          object.
+        max_workers (int): Maximum number of pipes flowed concurrently by the thread
+          and process executors (defaults to the number of CPUs), or the number of
+          threads used to flow synchronous pipes with the asyncio executor.
+        flatten (bool): Schedule the connections of nested pipes that do not define
+          their own ``flow`` method as part of this plan, rather than flowing each of
+          those pipes as a single opaque step.  This lets independent branches in
+          different nested pipes flow concurrently.
+        release (bool): Release intermediate data subjects as soon as all of their
+          consumers have flowed (see ``pemi.hooks.ReleaseHook``).  Subjects that
+          should be inspected after flowing can be created with ``retain=True``.
+        history: Path to a local history file (or a ``pemi.hooks.DurationHistory``)
+          used to record how long each pipe takes to flow.  The thread and process
+          executors use the durations of previous runs to start the ready pipes with
+          the longest remaining critical path first.
+        hooks (list): Additional ``pemi.hooks.ExecutionHook`` objects to notify as
+          the plan is executed (native executors only).
+        targets (list): If provided, a list of ``(pipe_name, subject_name)`` tuples.
+          Only the pipes and connections needed to produce these target subjects are
+          flowed (see ``pemi.execution.ExecutionPlan.select``).
+        from_pipe (str): If provided, only the named pipe and the pipes downstream of
+          it are flowed, reusing the data already held by the upstream subjects.
+        resource_limits (dict): Maximum number of pipes that may use each resource at
+          the same time, with the thread, process and asyncio executors.  Pipes use
+          the resources listed in ``Pipe.resources``, and pipes at either end of a
+          connection grouped with ``group_as`` use the resource named by the group.
+          Not supported by the distributed executor.
+        checkpoint: Path to a run directory (or a ``pemi.checkpoint.CheckpointHook``).
+          The targets of each pipe are persisted to the run directory as soon as the
+          pipe has flowed.  Not supported by the distributed executor.
+        resume (bool): Resume the run checkpointed in ``checkpoint``: the targets of
+          the pipes that completed are restored and only the remaining pipes are
+          flowed.  Otherwise, any previous checkpoints in the run directory are removed.
+        spark_storage_level: Storage level used to persist Spark data subjects that
+          are consumed by more than one pipe (see ``SparkPersistPlanner``).  Set to
+          ``None`` to disable persisting.
+        trace: Path of a file to which a Chrome trace-event JSON timeline of the run
+          is written (or a ``pemi.tracing.Tracer`` to record the spans with).  Spans
+          recorded by the workers of the distributed executor are not collected.
+        metrics: Path of a textfile to which Prometheus metrics of the run are written
+          (or a ``pemi.metrics.MetricsRegistry``, which may also serve the metrics over
+          HTTP while the run is in progress).  Metrics recorded by the workers of the
+          distributed executor are not collected.
+    '''
+
+    def __init__(self, *, executor='serial', #pylint: disable=too-many-arguments,too-many-locals
+                 max_workers=None, flatten=False, release=False, history=None, hooks=None,
+                 targets=None, from_pipe=None, resource_limits=None, checkpoint=None,
+                 resume=False, spark_storage_level='MEMORY_AND_DISK', trace=None,
+                 metrics=None):
+        self.executor = executor
+        self.max_workers = max_workers
+        self.flatten = flatten
+        self.release = release
+        self.history = history
+        self.hooks = hooks
+        self.targets = targets
+        self.from_pipe = from_pipe
+        self.resource_limits = resource_limits
+        self.checkpoint = checkpoint
+        self.resume = resume
+        self.spark_storage_level = spark_storage_level
+        self.trace = trace
+        self.metrics = metrics
+
+
 class PipeConnections:
     def __init__(self, connections=None):
         self.connections = connections or []
+        self._plan = None
+        self._plan_signature = None
+        self._groups = {}
 
     def append(self, conn):
         self.connections.append(conn)
 
     def group(self, group):
-        return self.__class__([c for c in self.connections if c.group == group])
+        conns = [c for c in self.connections if c.group == group]
+        signature = tuple(id(c) for c in conns)
+        if group not in self._groups or self._groups[group][0] != signature:
+            self._groups[group] = (signature, self.__class__(conns))
+        return self._groups[group][1]
+
+    def _signature(self, flatten):
+        signature = [id(conn) for conn in self.connections]
+        pending = list({id(conn.parent): conn.parent for conn in self.connections}.values())
+        seen = set()
+        while pending:
+            parent = pending.pop()
+            if id(parent) in seen:
+                continue
+            seen.add(id(parent))
+
+            for name, pipe in parent.pipes.items():
+                signature.append((id(parent), name, id(pipe)))
+                if flatten and pipe is not parent:
+                    signature.extend(id(conn) for conn in pipe.connections.connections)
+                    pending.append(pipe)
+        return (flatten, tuple(signature))
+
+    def plan(self, flatten=False):
+        '''
+        Returns the compiled ``ExecutionPlan`` for these connections.  The plan is validated
+        and compiled once, and recompiled only if connections or nested pipes change.
+
+        Args:
+            flatten (bool): Compile the connections of nested pipes into the same plan
+              (see ``pemi.execution.ExecutionPlan``).
+        '''
+        signature = self._signature(flatten)
+        if self._plan is None or signature != self._plan_signature:
+            self.validate_dag()
+            self._plan = pemi.execution.ExecutionPlan(self.connections, flatten=flatten)
+            for pipe in self._plan.flattened:
+                pipe.connections.validate_dag()
+            self._plan_signature = signature
+        return self._plan
+
+    def flow(self, dask_get=None, **options):
+        '''
+        Flows all of the pipes and connections.
+
+        Args:
+            dask_get: If provided, the connections are compiled into a dask graph and
+              executed with this dask scheduler (e.g., ``dask.threaded.get``) instead of
+              with a native executor.
+            options: Options of the native execution (see ``FlowOptions``), e.g.
+              ``executor='thread'``.  The ``spark_storage_level``, ``trace`` and
+              ``metrics`` options also apply when flowing with ``dask_get``.
+        '''
+        options = FlowOptions(**options)
+        with pemi.tracing.trace_run(options.trace), pemi.metrics.metrics_run(options.metrics):
+            return self._flow(dask_get, options)
+
+    def _flow(self, dask_get, options):
+        if dask_get is not None:
+            if any(conn.streaming for conn in self.connections):
+                raise ValueError('Streaming connections require a native executor')
+            dask_dag = self.dask_dag(self._persist_planner(self.plan(), options))
+            return dask_get(dask_dag, list(dask_dag.keys()))
+
+        plan = self.plan(flatten=options.flatten)
+        if options.targets is not None or options.from_pipe is not None:
+            plan = plan.select(targets=options.targets, from_pipe=options.from_pipe)
+
+        hooks = list(options.hooks or [])
+        executor = pemi.executors.get_executor(options.executor, max_workers=options.max_workers)
+        if options.checkpoint is not None:
+            plan = self._checkpoint(plan, executor, options, hooks)
+        planner = self._persist_planner(plan, options)
+        if planner is not None:
+            hooks.append(planner)
+        if options.release:
+            hooks.append(pemi.hooks.ReleaseHook())
+        self._schedule(plan, executor, options, hooks)
+
+        for hook in hooks:
+            hook.before_run(plan)
+        executor.run(plan, hooks)
+        for hook in hooks:
+            hook.after_run(plan)
+        return plan
+
+    @staticmethod
+    def _persist_planner(plan, options):
+        'Returns a ``SparkPersistPlanner`` for the plan, unless it connects no Spark subjects'
+        if options.spark_storage_level is None:
+            return None
+
+        if not any(
+                step.kind == 'connect' and isinstance(step.conn.from_subject, pemi.SparkDataSubject)
+                for step in plan.steps
+        ):
+            return None
+        return SparkPersistPlanner(plan, storage_level=options.spark_storage_level)
 
-    def flow(self, dask_get=dask.get):
-        dask_dag = self.dask_dag()
-        return dask_get(dask_dag, list(dask_dag.keys()))
+    @staticmethod
+    def _checkpoint(plan, executor, options, hooks):
+        'Adds the checkpoint hook, returning the plan of the pipes that still need to flow'
+        if isinstance(executor, pemi.executors.DistributedExecutor):
+            raise ValueError('Checkpoints are not supported by the distributed executor')
+
+        checkpoint = options.checkpoint
+        if not isinstance(checkpoint, pemi.checkpoint.CheckpointHook):
+            checkpoint = pemi.checkpoint.CheckpointHook(checkpoint)
+        if options.resume:
+            plan = checkpoint.resume(plan)
+        else:
+            checkpoint.reset()
+        hooks.insert(0, checkpoint)
+        return plan
+
+    @staticmethod
+    def _schedule(plan, executor, options, hooks):
+        'Configures the resource limits and history-based priorities of the executor'
+        if options.resource_limits is not None:
+            if isinstance(executor, pemi.executors.DistributedExecutor):
+                raise ValueError('Resource limits are not supported by the distributed executor')
+            if hasattr(executor, 'resource_limits'):
+                executor.resource_limits = options.resource_limits
+
+        history = options.history
+        if history is not None:
+            if not isinstance(history, pemi.hooks.DurationHistory):
+                history = pemi.hooks.DurationHistory(history)
+            hooks.append(pemi.hooks.HistoryHook(history))
+            if isinstance(executor, pemi.executors.ConcurrentExecutor):
+                executor.priorities = pemi.execution.critical_path(plan, history)
 
 
     def graph(self):
         return self.dask_graph()
 
     def dask_graph(self):
+        import dask.dot #pylint: disable=import-outside-toplevel
         return dask.dot.dot_graph(self.dask_dag(), rankdir='TB')
 
-    def dask_dag(self):
+    def dask_dag(self, planner=None):
         self.validate_dag()
         dag = {}
         for conn in self.connections:
-            for node, edge in self._node_edge(conn).items():
+            for node, edge in self._node_edge(conn, planner).items():
                 if node in dag:
                     dag[node][1].extend(edge[1])
                 else:
@@ -177,9 +532,11 @@ class PipeConnections:
             raise DagValidationError(msg)
 
     @staticmethod
-    def _connect_to(source, connection):
+    def _connect_to(source, connection, planner=None):
         def __connect_to(target):
             pemi.log.debug('connecting %s to %s', target, source)
+            if planner:
+                planner.before_connect(connection)
             connection.connect()
             return target
         __connect_to.__name__ = 'connect_to'
@@ -193,7 +550,7 @@ class PipeConnections:
         __get_subject.__name__ = '[{}]'.format(name)
         return __get_subject
 
-    def _node_edge(self, conn):
+    def _node_edge(self, conn, planner=None):
         '''
         A dask graph is a dictionary mapping keys to computations.
 
@@ -244,10 +601,20 @@ class PipeConnections:
                 keys['from_pipe_subjects']
             ),
             'connect_data': (
-                self._connect_to(getattr(conn.to_pipe, to_type)[conn.to_subject_name], conn),
+                self._connect_to(
+                    getattr(conn.to_pipe, to_type)[conn.to_subject_name], conn, planner
+                ),
                 keys['from_pipe_subject']
             ),
-            'flow_to_pipe': (DaskPipe(conn.to_pipe), [keys['to_pipe_subject']])
+            'flow_to_pipe': (
+                DaskPipe(
+                    conn.to_pipe,
+                    on_flow=planner and (lambda: planner.after_flow(
+                        pemi.execution.Step('flow', conn.parent, conn.to_pipe_name)
+                    ))
+                ),
+                [keys['to_pipe_subject']]
+            )
         }
 
 
@@ -1,19 +1,177 @@
 import json
+import weakref
+import threading
+from collections import deque
+from contextlib import contextmanager
 
 import pandas as pd
 import sqlalchemy as sa
 
 import pemi
+import pemi.memory
 from pemi.fields import *
 
 __all__ = [
     'PdDataSubject',
+    'PdChunkedDataSubject',
     'SaDataSubject',
     'SparkDataSubject'
 ]
 
 class MissingFieldsError(Exception): pass
 
+def coerce_series(series, field):
+    '''
+    Coerces all of the values of a series according to a field.  Each distinct value is only
+    coerced once, which is much faster than coercing element by element when values repeat.
+    '''
+    if len(series) == 0:
+        return series.apply(field.coerce)
+
+    try:
+        codes, uniques = pd.factorize(series)
+    except TypeError:
+        return series.apply(field.coerce)
+
+    coerced = [field.coerce(value) for value in uniques]
+    null = field.coerce(None)
+    return pd.Series(
+        [coerced[code] if code >= 0 else null for code in codes],
+        index=series.index,
+        name=series.name
+    )
+
+def iterate_chunks(chunks):
+    'Returns a new iterator over a re-iterable source of chunks (see ``PdChunkedDataSubject``)'
+    if callable(chunks):
+        return iter(chunks())
+    return iter(chunks)
+
+
+class ChunkStream:
+    '''
+    A bounded, thread-safe stream of dataframe chunks between two pipes that are connected
+    with a streaming connection (see ``PipeConnection.stream``).  The producer blocks when
+    the stream holds ``max_chunks`` chunks, until the consumer catches up.
+
+    Args:
+        max_chunks (int): Maximum number of chunks held by the stream.
+
+    Attributes:
+        peak_chunks (int): Largest number of chunks held by the stream at any one time.
+    '''
+
+    def __init__(self, max_chunks=2):
+        self.max_chunks = max_chunks
+        self._chunks = deque()
+        self._closed = False
+        self._detached = False
+        self._error = None
+        self._changed = threading.Condition()
+        self.peak_chunks = 0
+
+    def put(self, chunk):
+        'Adds a chunk to the stream, waiting while the stream is full'
+        with self._changed:
+            self._changed.wait_for(
+                lambda: len(self._chunks) < self.max_chunks or self._detached or self._error
+            )
+            if self._error is not None:
+                raise self._error
+            if not self._detached:
+                self._chunks.append(chunk)
+                self.peak_chunks = max(self.peak_chunks, len(self._chunks))
+                self._changed.notify_all()
+
+    def close(self):
+        'Signals that no more chunks will be added'
+        with self._changed:
+            self._closed = True
+            self._changed.notify_all()
+
+    def detach(self):
+        'Signals that the consumer will not read any more chunks, so they can be dropped'
+        with self._changed:
+            self._detached = True
+            self._chunks.clear()
+            self._changed.notify_all()
+
+    def abort(self, error):
+        'Fails the stream, raising ``error`` in both the producer and the consumer'
+        with self._changed:
+            if self._error is None:
+                self._error = error
+            self._changed.notify_all()
+
+    def __iter__(self):
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: self._chunks or self._closed or self._error)
+                if self._error is not None:
+                    raise self._error
+                if not self._chunks:
+                    return
+                chunk = self._chunks.popleft()
+                self._changed.notify_all()
+            yield chunk
+
+
+class ChunkSplitter: #pylint: disable=too-few-public-methods
+    '''
+    Splits a re-iterable source of chunks, each of which is a dictionary of dataframes,
+    into one re-iterable source of dataframe chunks per key (see ``source``), so that
+    several subjects can be produced from a single pass over the data (e.g., the ``main``
+    and ``errors`` targets of a CSV source).  While one of the sources is read, the chunks
+    of the others are held until they are read as well.  A source that is read again after
+    it has been exhausted starts a new pass over the data.
+
+    Args:
+        chunks: Either a collection of dictionaries of dataframes, or a function that
+          returns a new iterator of such dictionaries each time it is called.
+        names (list): The keys of the dictionaries.
+    '''
+
+    def __init__(self, chunks, names):
+        self.chunks = chunks
+        self.names = list(names)
+        self._iterator = iter([])
+        self._held = {name: deque() for name in self.names}
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def source(self, name):
+        'Returns a re-iterable source of the dataframe chunks held under ``name``'
+        return lambda: self._iterate(name)
+
+    def _next(self, name):
+        with self._lock:
+            if name not in self._pending:
+                self._iterator = iterate_chunks(self.chunks)
+                self._held = {other: deque() for other in self.names}
+                self._pending = set(self.names)
+
+            if self._held[name]:
+                return self._held[name].popleft()
+
+            try:
+                split = next(self._iterator)
+            except StopIteration:
+                self._pending.discard(name)
+                raise
+
+            for other in self._pending - {name}:
+                self._held[other].append(split[other])
+            return split[name]
+
+    def _iterate(self, name):
+        while True:
+            try:
+                chunk = self._next(name)
+            except StopIteration:
+                return
+            yield chunk
+
+
 class DataSubject:
     '''
     A data subject is mostly just a schema and a generic data object
@@ -21,10 +179,11 @@ class DataSubject:
     and can be converted from and to a pandas dataframe (really only needed for testing to work)
     '''
 
-    def __init__(self, schema=None, name=None, pipe=None):
+    def __init__(self, schema=None, name=None, pipe=None, retain=False):
         self.schema = schema or pemi.Schema()
         self.name = name
         self.pipe = pipe
+        self.retain = retain
 
     def __str__(self):
         subject_str = '<{}({}) {}>'.format(self.__class__.__name__, self.name, id(self))
@@ -45,16 +204,213 @@ class DataSubject:
     def validate_schema(self): #pylint: disable=no-self-use
         return True
 
+    def release(self): #pylint: disable=no-self-use
+        '''
+        Releases the data held by this subject once it is no longer needed.  Connection
+        graphs flowed with ``release=True`` call this when all of the consumers of the
+        subject have flowed, unless the subject was created with ``retain=True``.
+
+        Returns:
+            int: The number of bytes of memory freed.
+        '''
+        return 0
+
 
-class PdDataSubject(DataSubject):
+class PdDataSubject(DataSubject): #pylint: disable=too-many-instance-attributes
     def __init__(self, df=None, strict_match_schema=False, **kwargs):
         super().__init__(**kwargs)
 
+        self._df = None
+        self._frame = None
+        self._source = None
+        self._inlet = None
+        self._outlets = []
+        self._chunks = None
         if df is None or df.shape == (0, 0):
             df = self._empty_df()
         self.strict_match_schema = strict_match_schema
         self.df = df
 
+    @property
+    def df(self):
+        '''
+        The dataframe held by this subject.  When a ``pemi.memory.MemoryManager`` is
+        active, the dataframe may have been spilled to disk, in which case it is reloaded.
+        '''
+        if self._inlet is not None or self._source is not None:
+            self.df = self._concat_chunks(list(self.iter_chunks()))
+        if self._frame is not None:
+            return self._frame.get()
+        return self._df
+
+    @df.setter
+    def df(self, df):
+        self._source = None
+        manager = pemi.memory.get_manager()
+        if manager is None or df is None or len(df) == 0:
+            self._df = df
+            self._frame = None
+        else:
+            self._df = None
+            self._frame = manager.track(df)
+
+        profiler = pemi.memory.get_profiler()
+        if profiler is not None and df is not None and len(df) > 0:
+            profiler.record_subject(self, df, self._frame and self._frame.nbytes)
+
+    def resident_df(self):
+        '''
+        Returns the dataframe held by this subject if it is in memory, without reading any
+        chunks or reloading a spilled dataframe.  Returns ``None`` for chunked and streaming
+        subjects and for subjects whose dataframe has been spilled to disk.
+        '''
+        if self._inlet is not None or self._source is not None:
+            return None
+        if self._frame is not None:
+            return self._frame.df
+        return self._df
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_df'] = self.df
+        state['_frame'] = None
+        state['_source'] = None
+        state['_inlet'] = None
+        state['_outlets'] = []
+        state['_chunks'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(
+            {'_source': None, '_inlet': None, '_outlets': [], '_chunks': None, **state}
+        )
+        self.df = state['_df']
+
+    def _concat_chunks(self, chunks):
+        if len(chunks) == 0:
+            return self._empty_df()
+        if len(chunks) == 1:
+            return chunks[0]
+        return pd.concat(chunks, sort=False)
+
+    @property
+    def is_chunked(self):
+        'Whether the data of this subject is read lazily from a source of chunks'
+        return self._source is not None
+
+    @property
+    def chunks(self):
+        'The re-iterable source of chunks of this subject (``None`` if it holds a dataframe)'
+        return self._source
+
+    def from_chunks(self, chunks):
+        '''
+        Makes this subject read its data lazily from a re-iterable source of dataframe
+        chunks: either a collection of dataframes, or a function that returns a new
+        iterator of dataframes each time it is called.  The chunks are only read when the
+        subject is iterated (see ``iter_chunks``) or materialized (see ``to_pd``).
+        '''
+        self.df = self._empty_df()
+        self._source = chunks
+
+    def map_chunks(self, fun):
+        '''
+        Returns a re-iterable source of chunks that applies ``fun`` to each chunk of this
+        subject as it is read, without reading any chunk now.
+        '''
+        source = self._source if self._source is not None else [self.df]
+        validate = self.validate_schema
+
+        def mapped():
+            for chunk in iterate_chunks(source):
+                validate(chunk)
+                yield fun(chunk)
+        return mapped
+
+    @property
+    def is_streaming(self):
+        'Whether this subject receives its data as a stream of chunks'
+        return self._inlet is not None
+
+    def open_stream(self, max_chunks=2):
+        'Opens a stream that receives the chunks produced into this subject'
+        stream = ChunkStream(max_chunks)
+        self._outlets.append(stream)
+        return stream
+
+    def attach_stream(self, stream):
+        'Makes this subject receive its data from a stream'
+        self._inlet = stream
+
+    def iter_chunks(self):
+        '''
+        Iterates over the data of this subject in chunks.  Chunked subjects (see
+        ``from_chunks``) and subjects that receive their data from a stream yield their
+        chunks as they are read, validating each chunk against the schema.  Other subjects
+        yield their dataframe as a single chunk.
+        '''
+        if self._source is not None:
+            for chunk in iterate_chunks(self._source):
+                self.validate_schema(chunk)
+                yield chunk
+            return
+
+        if self._inlet is None:
+            yield self.df
+            return
+
+        stream, self._inlet = self._inlet, None
+        for chunk in stream:
+            self.validate_schema(chunk)
+            yield chunk
+
+    def put_chunk(self, df):
+        '''
+        Adds a chunk of data to this subject.  If the subject is streamed to another pipe,
+        the chunk is sent downstream immediately (waiting if the downstream pipe has fallen
+        behind).  Otherwise, chunks are combined into ``df`` by ``end_chunks``.
+        '''
+        if self._chunks is None:
+            self._chunks = []
+
+        if self._outlets:
+            for stream in self._outlets:
+                stream.put(df)
+            self._chunks.append(None)
+        else:
+            self._chunks.append(df)
+
+    def end_chunks(self):
+        '''
+        Signals that all chunks have been added to this subject.  Called automatically once
+        the pipe that owns the subject has flowed.  If the subject is streamed but no
+        chunks were put, its dataframe is sent downstream as a single chunk.
+        '''
+        chunks, self._chunks = self._chunks, None
+        if self._outlets:
+            outlets, self._outlets = self._outlets, []
+            if chunks is None:
+                for chunk in self.iter_chunks():
+                    for stream in outlets:
+                        stream.put(chunk)
+            for stream in outlets:
+                stream.close()
+        elif chunks is not None:
+            self.df = self._concat_chunks(chunks)
+
+    def end_stream(self):
+        'Stops receiving chunks from a stream that has not been completely read'
+        if self._inlet is not None:
+            self._inlet.detach()
+            self._inlet = None
+
+    def abort_streams(self, error):
+        'Fails any streams to or from this subject'
+        for stream in self._outlets:
+            stream.abort(error)
+        if self._inlet is not None:
+            self._inlet.abort(error)
+
     def to_pd(self):
         return self.df
 
@@ -62,24 +418,30 @@ class PdDataSubject(DataSubject):
         self.df = df
 
     def connect_from(self, other):
+        if getattr(other, 'is_chunked', False):
+            self.from_chunks(other.chunks)
+            return
+
         if other.df is None or other.df.shape == (0, 0):
             self.df = self._empty_df()
         else:
             self.df = other.df
         self.validate_schema()
 
-    def validate_schema(self):
+    def validate_schema(self, df=None):
         'Verify that the dataframe contains all of the columns specified in the schema'
+        df = self.df if df is None else df
         if self.strict_match_schema:
-            return self.validate_data_frame_columns()
-        missing = set(self.schema.keys()) - set(self.df.columns)
+            return self.validate_data_frame_columns(df)
+        missing = set(self.schema.keys()) - set(df.columns)
         if len(missing) == 0:
             return True
         raise MissingFieldsError('DataFrame missing expected fields: {}'.format(missing))
 
-    def validate_data_frame_columns(self):
+    def validate_data_frame_columns(self, df=None):
         'Verify that the schema contains all the columns specefied in the dataframe'
-        missing = set(self.df.columns) - set(self.schema.keys())
+        df = self.df if df is None else df
+        missing = set(df.columns) - set(self.schema.keys())
         if len(missing) > 0:
             raise MissingFieldsError("Schema is missing current columns: {}".format(missing))
         return True
@@ -87,6 +449,60 @@ class PdDataSubject(DataSubject):
     def _empty_df(self):
         return pd.DataFrame(columns=self.schema.keys())
 
+    def release(self):
+        '''
+        Replaces the dataframe with an empty one.  Only memory that is actually freed is
+        reported, so nothing is reported if the dataframe is still referenced elsewhere
+        (e.g., by a subject it has been connected to).
+        '''
+        if self._source is not None:
+            self.df = self._empty_df()
+            return 0
+
+        if self._frame is not None and self._frame.spilled:
+            self.df = self._empty_df()
+            return 0
+
+        df = self.df
+        if df is None or len(df) == 0:
+            return 0
+
+        nbytes = int(df.memory_usage(index=True, deep=True).sum())
+        df_ref = weakref.ref(df)
+        self.df = self._empty_df()
+        del df
+        return nbytes if df_ref() is None else 0
+
+class PdChunkedDataSubject(PdDataSubject):
+    '''
+    A pandas data subject that wraps a re-iterable source of dataframe chunks, so that
+    large data sets can be processed without ever being held in memory all at once.
+    Chunk-capable pipes (e.g., ``PdLambdaPipe``, ``PdForkPipe``, ``PdConcatPipe`` and the
+    CSV target) process the chunks one at a time, and the subjects they produce are chunked
+    as well.  Accessing ``df`` (or calling ``to_pd``) materializes all of the chunks.
+
+    Args:
+        chunks: Either a collection of dataframes, or a function that returns a new iterator
+          of dataframes each time it is called.  Generators can only be iterated once, so
+          pass a function that creates the generator instead.
+
+    Example:
+        Reading a large file in chunks::
+
+            ds = pemi.PdChunkedDataSubject(
+                chunks=lambda: pd.read_csv('big.csv', chunksize=100000),
+                schema=schema
+            )
+            for chunk in ds.iter_chunks():
+                print(len(chunk))
+    '''
+
+    def __init__(self, chunks=None, **kwargs):
+        super().__init__(**kwargs)
+        if chunks is not None:
+            self.from_chunks(chunks)
+
+
 class SaDataSubject(DataSubject):
     def __init__(self, engine, table, sql_schema=None, **kwargs):
         super().__init__(**kwargs)
@@ -152,29 +568,143 @@ class SaDataSubject(DataSubject):
 
 
 
+# Arrow is enabled by changing the conf of the (shared) Spark session, so subjects converting
+# at the same time in different threads must not restore each other's setting
+_ARROW_CONF_LOCK = threading.Lock()
+
 class SparkDataSubject(DataSubject):
-    def __init__(self, spark, df=None, **kwargs):
+    # Names of the Spark data types that already hold values of the same type
+    # that the corresponding Pemi field coerces to.  The first type listed is the one
+    # used when creating Spark dataframes.
+    SPARK_TYPES = {
+        StringField: ['StringType'],
+        IntegerField: ['LongType', 'IntegerType', 'ShortType', 'ByteType'],
+        FloatField: ['DoubleType', 'FloatType'],
+        DecimalField: ['DecimalType'],
+        DateField: ['DateType'],
+        DateTimeField: ['TimestampType', 'TimestampNTZType'],
+        BooleanField: ['BooleanType'],
+    }
+
+    def __init__(self, spark=None, df=None, **kwargs):
         super().__init__(**kwargs)
         self.spark = spark
         self.df = df
 
         self.cached_test_df = None
 
+    @staticmethod
+    @contextmanager
+    def _arrow_enabled(spark):
+        'Temporarily enables Arrow-based conversion between Spark and Pandas'
+        if int(spark.version.split('.')[0]) < 3:
+            conf_key = 'spark.sql.execution.arrow.enabled'
+        else:
+            conf_key = 'spark.sql.execution.arrow.pyspark.enabled'
+
+        with _ARROW_CONF_LOCK:
+            previous = spark.conf.get(conf_key, None)
+            spark.conf.set(conf_key, 'true')
+            try:
+                yield
+            finally:
+                if previous is None:
+                    spark.conf.unset(conf_key)
+                else:
+                    spark.conf.set(conf_key, previous)
+
+    def _matches_spark_type(self, field, spark_type):
+        return type(spark_type).__name__ in self.SPARK_TYPES.get(type(field), [])
+
+    @staticmethod
+    def _fill_nulls(series, field):
+        if field.null is None or not series.isnull().any():
+            return series
+
+        filled = series.astype(object)
+        filled[series.isnull()] = field.null
+        return filled
+
+    def _coerce_column(self, series, field, spark_type):
+        if not self._matches_spark_type(field, spark_type):
+            return coerce_series(series, field)
+
+        if isinstance(field, IntegerField) and series.isnull().any():
+            # Arrow converts integer columns with nulls to floats
+            series = series.astype('Int64').astype(object)
+            series[series.isnull()] = None
+        return self._fill_nulls(series, field)
+
     def to_pd(self):
         if self.cached_test_df is not None:
             return self.cached_test_df
 
-        converted_df = self.df.toPandas()
-        self.cached_test_df = pd.DataFrame()
+        with self._arrow_enabled(self.df.sparkSession):
+            converted_df = self.df.toPandas()
+
+        spark_types = {field.name: field.dataType for field in self.df.schema.fields}
+        self.cached_test_df = pd.DataFrame(index=converted_df.index)
         for column in list(converted_df):
-            self.cached_test_df[column] = converted_df[column].apply(self.schema[column].coerce)
+            if column in self.schema:
+                self.cached_test_df[column] = self._coerce_column(
+                    converted_df[column], self.schema[column], spark_types.get(column)
+                )
+            else:
+                self.cached_test_df[column] = converted_df[column]
 
         return self.cached_test_df
 
+    def spark_schema(self, columns=None):
+        '''
+        Builds a Spark ``StructType`` from the Pemi schema of this subject.
+
+        Args:
+            columns (list): Names of the fields to include (default: all fields in the schema).
+        '''
+        from pyspark.sql import types #pylint: disable=import-outside-toplevel
+
+        def spark_type(field):
+            if isinstance(field, DecimalField):
+                return types.DecimalType(field.precision, field.scale)
+            return getattr(types, self.SPARK_TYPES.get(type(field), ['StringType'])[0])()
+
+        columns = self.schema.keys() if columns is None else columns
+        return types.StructType([
+            types.StructField(name, spark_type(self.schema[name]), nullable=True)
+            for name in columns
+        ])
+
     def from_pd(self, df, **kwargs):
-        self.df = self.spark.createDataFrame(df)
+        json_fields = [
+            name for name, field in self.schema.items()
+            if isinstance(field, JsonField) and name in df
+        ]
+        if len(json_fields) > 0:
+            df = df.copy()
+            for name in json_fields:
+                df[name] = df[name].apply(
+                    lambda v: v if v is None or isinstance(v, str) else json.dumps(v)
+                )
+
+        with self._arrow_enabled(self.spark):
+            self.df = self.spark.createDataFrame(df, schema=self._pd_spark_schema(df))
+
+    def _pd_spark_schema(self, df):
+        'Builds the Spark schema of a dataframe, inferring the types of fields not in the schema'
+        from pyspark.sql import types #pylint: disable=import-outside-toplevel
+
+        schema = self.spark_schema([column for column in df.columns if column in self.schema])
+        extra_columns = [column for column in df.columns if column not in self.schema]
+        if len(extra_columns) == 0:
+            return schema
+
+        fields = {
+            field.name: field
+            for field in schema.fields + self.spark.createDataFrame(df[extra_columns]).schema.fields
+        }
+        return types.StructType([fields[column] for column in df.columns])
 
     def connect_from(self, other):
-        self.spark = other.spark.builder.getOrCreate()
+        self.spark = other.spark
         self.df = other.df
         self.validate_schema()
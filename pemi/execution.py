@@ -0,0 +1,520 @@
+'''
+Native execution of the connection graphs of pipes.
+
+The connections of a pipe are compiled into an ``ExecutionPlan``, which is a topologically
+sorted collection of steps.  A step either flows a nested pipe, or connects the data subject
+of one pipe to the data subject of another.  Plans are executed by an executor (see
+``pemi.executors``), which notifies hooks (see ``pemi.hooks``) as the steps are executed.
+'''
+
+import heapq
+import threading
+import asyncio
+import contextlib
+import concurrent.futures
+from collections import OrderedDict, Counter
+
+import pemi
+import pemi.tracing
+import pemi.metrics
+import pemi.memory
+
+class DagValidationError(Exception): pass
+
+
+class Step: #pylint: disable=too-many-instance-attributes
+    '''
+    A single unit of work in an execution plan.
+
+    Attributes:
+        kind (str): Either ``'flow'`` or ``'connect'``.
+        parent (pemi.Pipe): The pipe that owns the connections this step was compiled from.
+        pipe_name (str): For flow steps, the name of the nested pipe to flow.
+        conn (PipeConnection): For connect steps, the connection to make.
+        deps (set): Steps that must complete before this step can be executed.
+        dependents (list): Steps that depend on this step.
+        index (int): Position of this step in the topologically sorted plan.
+        streaming (bool): For flow steps, whether the pipe produces or consumes a streaming
+          connection.  Streaming steps are flowed in dedicated threads, so that producers
+          and consumers run at the same time.
+        duration (float): For flow steps whose executor measured the time spent flowing
+          the pipe where it ran (e.g., on a dask.distributed worker), that time.  It is
+          only set while the ``after_flow`` hooks of the step are notified.
+    '''
+
+    def __init__(self, kind, parent, pipe_name=None, conn=None):
+        self.kind = kind
+        self.parent = parent
+        self.pipe_name = pipe_name
+        self.conn = conn
+        self.deps = set()
+        self.dependents = []
+        self.index = None
+        self.streaming = False
+        self.duration = None
+
+    @property
+    def pipe(self):
+        'The pipe flowed by this step (looked up when needed, so pipes may be mocked)'
+        return self.parent.pipes[self.pipe_name]
+
+    @property
+    def key(self):
+        if self.kind == 'flow':
+            return ('flow', id(self.parent), self.pipe_name)
+        return ('connect', id(self.conn))
+
+    @property
+    def name(self):
+        if self.kind == 'flow':
+            return self.pipe_name
+        return '{}.{} -> {}.{}'.format(
+            self.conn.from_pipe_name, self.conn.from_subject_name,
+            self.conn.to_pipe_name, self.conn.to_subject_name
+        )
+
+    @property
+    def qualname(self):
+        'A name for the step that is stable across runs (qualified by the parent pipe class)'
+        return '{}.{}'.format(self.parent.__class__.__name__, self.name)
+
+    def __str__(self):
+        return '<Step({}) {}>'.format(self.kind, self.name)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __lt__(self, other):
+        return self.index < other.index
+
+
+class ExecutionPlan:
+    '''
+    A compiled, topologically sorted plan for executing a collection of connections.
+
+    When flattened, nested pipes that do not define their own ``flow`` method (see
+    ``is_flattenable``) are not flowed as a single step.  Instead, their connections are
+    compiled into the same plan, so the steps of different nested pipes can be executed
+    concurrently.  Pipes that define their own ``flow`` are always flowed as a single step.
+
+    Args:
+        connections (list): ``PipeConnection`` objects to compile.
+        flatten (bool): Compile the connections of flattenable nested pipes into the plan.
+
+    Attributes:
+        steps (list): All of the steps of the plan, in topological order.
+        flattened (list): The nested pipes whose connections were compiled into the plan.
+
+    Raises:
+        DagValidationError: If the connections contain a cycle.
+    '''
+
+    def __init__(self, connections, flatten=False):
+        self.flatten = flatten
+        self.flattened = []
+        self.parents = list({id(conn.parent): conn.parent for conn in connections}.values())
+        self._steps = {}
+        for conn in connections:
+            self._add_connection(conn)
+        self.steps = self._toposort(list(self._steps.values()))
+
+    @property
+    def flow_steps(self):
+        return [step for step in self.steps if step.kind == 'flow']
+
+    @staticmethod
+    def is_flattenable(pipe):
+        '''
+        Pipes that do not define their own ``flow`` method just flow their connections,
+        so their connections can be compiled into the plan of an enclosing pipe.
+        '''
+        return type(pipe).flow is pemi.Pipe.flow and len(pipe.connections.connections) > 0
+
+    def _step(self, kind, parent, pipe_name=None, conn=None):
+        step = Step(kind, parent, pipe_name=pipe_name, conn=conn)
+        return self._steps.setdefault(step.key, step)
+
+    @staticmethod
+    def _depend(step, dep):
+        if dep not in step.deps:
+            step.deps.add(dep)
+            dep.dependents.append(step)
+
+    def _flattened_pipe(self, parent, pipe_name):
+        if not self.flatten:
+            return None
+
+        pipe = parent.pipes[pipe_name]
+        if not self.is_flattenable(pipe):
+            return None
+
+        if not any(flattened is pipe for flattened in self.flattened):
+            self.flattened.append(pipe)
+            for conn in pipe.connections.connections:
+                self._add_connection(conn)
+        return pipe
+
+    def _producers(self, parent, pipe_name, subject_name):
+        'Steps that must complete before a target of a nested pipe is ready'
+        pipe = self._flattened_pipe(parent, pipe_name)
+        if pipe is None:
+            return [self._step('flow', parent, pipe_name)]
+
+        return [
+            self._step('connect', pipe, conn=conn) for conn in pipe.connections.connections
+            if conn.is_to_self and conn.to_subject_name == subject_name
+        ]
+
+    def _consumers(self, parent, pipe_name, subject_name):
+        'Steps that must wait for a source of a nested pipe to be ready'
+        pipe = self._flattened_pipe(parent, pipe_name)
+        if pipe is None:
+            return [self._step('flow', parent, pipe_name)]
+
+        return [
+            self._step('connect', pipe, conn=conn) for conn in pipe.connections.connections
+            if conn.is_from_self and conn.from_subject_name == subject_name
+        ]
+
+    def _add_connection(self, conn):
+        step = self._step('connect', conn.parent, conn=conn)
+
+        if conn.streaming:
+            self._add_streaming_connection(conn, step)
+            return
+
+        if not conn.is_from_self:
+            for producer in self._producers(conn.parent, conn.from_pipe_name,
+                                            conn.from_subject_name):
+                self._depend(step, producer)
+
+        if not conn.is_to_self:
+            for consumer in self._consumers(conn.parent, conn.to_pipe_name,
+                                            conn.to_subject_name):
+                self._depend(consumer, step)
+
+    def _add_streaming_connection(self, conn, step):
+        'Streams are opened before either end flows, so that both ends can flow at once'
+        ends = []
+        if not (conn.is_from_self or conn.is_to_self):
+            ends.extend(self._producers(conn.parent, conn.from_pipe_name, conn.from_subject_name))
+            ends.extend(self._consumers(conn.parent, conn.to_pipe_name, conn.to_subject_name))
+
+        if len(ends) != 2 or any(end.kind != 'flow' for end in ends):
+            raise DagValidationError(
+                'Streaming connections must connect two pipes that are flowed: {}'.format(conn)
+            )
+
+        for end in ends:
+            self._depend(end, step)
+            end.streaming = True
+
+    def _target_steps(self, pipe_name, subject_name):
+        'Steps that produce the target subject of a pipe owned by the top level connections'
+        steps = set()
+        for parent in self.parents:
+            if pipe_name == 'self':
+                steps.update(
+                    step for step in self.steps if step.kind == 'connect'
+                    and step.conn.parent is parent and step.conn.is_to_self
+                    and step.conn.to_subject_name == subject_name
+                )
+            elif pipe_name in parent.pipes:
+                steps.update(self._producers(parent, pipe_name, subject_name))
+        return steps & set(self.steps)
+
+    def _pipe_steps(self, pipe_name):
+        'Steps that flow a pipe owned by the top level connections'
+        steps = set()
+        for parent in self.parents:
+            if pipe_name not in parent.pipes or pipe_name == 'self':
+                continue
+
+            pipe = self._flattened_pipe(parent, pipe_name)
+            if pipe is None:
+                steps.add(self._step('flow', parent, pipe_name))
+            else:
+                steps.update(
+                    step for step in self.steps if step.kind == 'connect'
+                    and step.conn.parent is pipe
+                )
+        return steps & set(self.steps)
+
+    @staticmethod
+    def _closure(steps, neighbors):
+        closure = set()
+        pending = list(steps)
+        while pending:
+            step = pending.pop()
+            if step in closure:
+                continue
+            closure.add(step)
+            pending.extend(neighbors(step))
+        return closure
+
+    def select(self, targets=None, from_pipe=None):
+        '''
+        Returns a plan that only includes some of the steps of this plan.
+
+        Args:
+            targets (list): A list of ``(pipe_name, subject_name)`` tuples identifying
+              target subjects.  Only the steps needed to produce those subjects are kept.
+              Use ``'self'`` as the pipe name to identify the targets of the pipe that owns
+              the connections.
+            from_pipe (str): Name of a pipe.  Only the steps that flow the pipe and the
+              steps downstream of it are kept.  Upstream subjects are not recomputed, so
+              the data they already hold is reused.
+
+        Raises:
+            ValueError: If a target or pipe is not part of the plan.
+        '''
+        keep = set(self.steps)
+
+        if targets is not None:
+            target_steps = set()
+            for pipe_name, subject_name in targets:
+                steps = self._target_steps(pipe_name, subject_name)
+                if not steps:
+                    raise ValueError('Target {}.{} is not produced by any connection'.format(
+                        pipe_name, subject_name
+                    ))
+                target_steps.update(steps)
+            keep &= self._closure(target_steps, lambda step: step.deps)
+
+        if from_pipe is not None:
+            pipe_steps = self._pipe_steps(from_pipe)
+            if not pipe_steps:
+                raise ValueError('Pipe {} is not part of the plan'.format(from_pipe))
+            keep &= self._closure(pipe_steps, lambda step: step.dependents)
+
+        return self._subplan(keep)
+
+    def _subplan(self, keep):
+        plan = self.__class__.__new__(self.__class__)
+        plan.flatten = self.flatten
+        plan.flattened = self.flattened
+        plan.parents = self.parents
+
+        copies = OrderedDict(
+            (step, Step(step.kind, step.parent, pipe_name=step.pipe_name, conn=step.conn))
+            for step in self.steps if step in keep
+        )
+        for step, copied in copies.items():
+            copied.streaming = step.streaming
+            for dep in step.deps:
+                if dep in copies:
+                    self._depend(copied, copies[dep])
+
+        plan._steps = { #pylint: disable=protected-access
+            copied.key: copied for copied in copies.values()
+        }
+        plan.steps = self._toposort(list(copies.values()))
+        return plan
+
+    @staticmethod
+    def _toposort(steps):
+        for index, step in enumerate(steps):
+            step.index = index
+
+        remaining = {step: len(step.deps) for step in steps}
+        ready = [step for step in steps if remaining[step] == 0]
+        heapq.heapify(ready)
+
+        ordered = []
+        while ready:
+            step = heapq.heappop(ready)
+            ordered.append(step)
+            for dependent in step.dependents:
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    heapq.heappush(ready, dependent)
+
+        if len(ordered) < len(steps):
+            cycle = sorted({
+                step.pipe_name if step.kind == 'flow' else step.name
+                for step in steps if remaining[step] > 0
+            })
+            raise DagValidationError('Connections contain a cycle between pipes: {}'.format(cycle))
+
+        for index, step in enumerate(ordered):
+            step.index = index
+        return ordered
+
+
+def critical_path(plan, history):
+    '''
+    Computes, for every step of a plan, the estimated duration of the longest path from the
+    start of that step to the end of the plan.  Starting the ready steps with the longest
+    remaining path first keeps slow branches from dominating the total run time.
+
+    Pipes without any recorded history are estimated to take the median duration of the
+    pipes with history (or one second if there is no history at all).  Connect steps are
+    assumed to take no time.
+
+    Returns:
+        dict: Remaining path duration keyed by step.
+    '''
+    known = sorted(
+        duration for duration in
+        (history.estimate(step.qualname) for step in plan.flow_steps) if duration is not None
+    )
+    default = known[len(known) // 2] if known else 1.0
+
+    remaining = {}
+    for step in reversed(plan.steps):
+        duration = history.estimate(step.qualname, default) if step.kind == 'flow' else 0
+        remaining[step] = duration + max(
+            (remaining[dependent] for dependent in step.dependents), default=0
+        )
+    return remaining
+
+
+def step_resources(step):
+    '''
+    Returns the resources needed to execute a flow step, as a ``Counter`` of slots per
+    resource.  These are the ``resources`` of the pipe, along with the group (see
+    ``PipeConnection.group_as``) of any connection to or from the pipe.
+    '''
+    resources = step.pipe.resources
+    if isinstance(resources, dict):
+        needed = Counter(resources)
+    else:
+        needed = Counter({resource: 1 for resource in resources})
+
+    for conn in step.parent.connections.connections:
+        if conn.group is not None and step.pipe_name in (conn.from_pipe_name, conn.to_pipe_name):
+            needed[conn.group] = max(needed[conn.group], 1)
+    return needed
+
+
+class ResourceSlots:
+    '''
+    Tracks how many slots of each limited resource are in use.  A step that needs more
+    slots than a resource has may still start when nobody else is using the resource.
+
+    Args:
+        limits (dict): Number of slots available for each resource.  Resources that are not
+          limited can be used by any number of steps.
+    '''
+
+    def __init__(self, limits):
+        self.limits = limits or {}
+        self.usage = Counter()
+        self._needed = {}
+
+    def needed(self, step):
+        if step not in self._needed:
+            self._needed[step] = Counter({
+                resource: slots for resource, slots in step_resources(step).items()
+                if resource in self.limits
+            })
+        return self._needed[step]
+
+    def available(self, step):
+        return all(
+            self.usage[resource] == 0 or self.usage[resource] + slots <= self.limits[resource]
+            for resource, slots in self.needed(step).items()
+        )
+
+    def acquire(self, step):
+        self.usage.update(self.needed(step))
+
+    def release(self, step):
+        self.usage.subtract(self.needed(step))
+
+
+def connect_step(step, hooks=()):
+    'Executes a connect step'
+    for hook in hooks:
+        hook.before_connect(step.conn)
+    pemi.log.debug('Connecting %s', step.conn)
+    step.conn.connect()
+    for hook in hooks:
+        hook.after_connect(step.conn)
+
+def run_coroutine(coro):
+    '''
+    Runs a coroutine to completion in a new event loop.  Used to flow asynchronous pipes
+    from synchronous code, so it cannot be called from a thread with a running event loop.
+    '''
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+@contextlib.contextmanager
+def instrument_flow(pipe):
+    'Records the trace span, metrics and memory profile of a pipe flowing (when active)'
+    with pemi.tracing.flow_span(pipe), pemi.metrics.flow_metrics(pipe):
+        with pemi.memory.profile_flow(pipe):
+            yield
+
+def flow_pipe(pipe):
+    'Flows a pipe synchronously, running it in a new event loop if the pipe is asynchronous'
+    with instrument_flow(pipe):
+        if pipe.is_async():
+            run_coroutine(pipe.flow_async())
+        else:
+            pipe.flow()
+
+def _subjects(pipe, kind):
+    return [
+        subject for subject in getattr(pipe, kind).values() if hasattr(subject, 'end_chunks')
+    ]
+
+def end_streams(pipe):
+    'Ends the chunks produced and the streams consumed by a pipe that has flowed'
+    for subject in _subjects(pipe, 'targets'):
+        subject.end_chunks()
+    for subject in _subjects(pipe, 'sources'):
+        subject.end_stream()
+
+def abort_streams(pipe, error):
+    'Fails the streams of a pipe, so that the pipes at the other ends stop waiting on it'
+    for kind in ['sources', 'targets']:
+        for subject in _subjects(pipe, kind):
+            subject.abort_streams(error)
+
+def flow_step(step, hooks=()):
+    'Executes a flow step'
+    for hook in hooks:
+        hook.before_flow(step)
+    pemi.log.info('Flowing pipe %s', step.pipe)
+    try:
+        flow_pipe(step.pipe)
+    except BaseException as err:
+        if step.streaming:
+            abort_streams(step.pipe, err)
+        raise
+    if step.streaming:
+        end_streams(step.pipe)
+    for hook in hooks:
+        hook.after_flow(step)
+    return step
+
+def run_in_thread(func, *args):
+    'Runs a function in a new thread and returns a ``concurrent.futures.Future`` of its result'
+    future = concurrent.futures.Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(func(*args))
+        except BaseException as err: #pylint: disable=broad-except
+            future.set_exception(err)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+async def flow_step_async(step, hooks=()):
+    'Executes a flow step of an asynchronous pipe in the running event loop'
+    for hook in hooks:
+        hook.before_flow(step)
+    pemi.log.info('Flowing pipe %s asynchronously', step.pipe)
+    with instrument_flow(step.pipe):
+        await step.pipe.flow_async()
+    for hook in hooks:
+        hook.after_flow(step)
+    return step
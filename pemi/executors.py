@@ -0,0 +1,696 @@
+'''
+Executors of execution plans (see ``pemi.execution``).  The serial executor runs every step
+in the current thread; other executors flow independent pipes concurrently in threads,
+worker processes, an asyncio event loop or a dask.distributed cluster.
+'''
+
+import os
+import copy
+import time
+import uuid
+import mmap
+import heapq
+import queue
+import asyncio
+import tempfile
+import multiprocessing
+import concurrent.futures
+
+import pemi
+import pemi.tracing
+import pemi.metrics
+import pemi.memory
+from pemi.execution import (
+    DagValidationError, ResourceSlots, connect_step, flow_pipe, abort_streams, flow_step,
+    flow_step_async, run_in_thread
+)
+
+class Executor: #pylint: disable=too-few-public-methods
+    '''
+    Executes an execution plan.  The base executor runs every step serially in the
+    current thread, in topological order.
+    '''
+
+    def run(self, plan, hooks=()):
+        streaming = {}
+        try:
+            for step in plan.steps:
+                for dep in step.deps:
+                    if dep in streaming:
+                        streaming[dep].result()
+
+                if step.kind == 'connect':
+                    connect_step(step, hooks)
+                elif step.streaming:
+                    streaming[step] = run_in_thread(flow_step, step, hooks)
+                else:
+                    flow_step(step, hooks)
+
+            for future in streaming.values():
+                future.result()
+        except BaseException as err:
+            for step in streaming:
+                abort_streams(step.pipe, err)
+            concurrent.futures.wait(list(streaming.values()))
+            raise
+
+SerialExecutor = Executor
+
+
+class ConcurrentExecutor(Executor): #pylint: disable=too-few-public-methods
+    '''
+    Base class for executors that flow independent pipes concurrently.  Connect steps
+    are cheap and are executed by the scheduling thread, as soon as they are ready.  Flow
+    steps are submitted as soon as all of their dependencies have completed.
+
+    Args:
+        max_workers (int): Maximum number of pipes that may flow at the same time.
+    '''
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or multiprocessing.cpu_count()
+        self.priorities = {}
+        self.resource_limits = {}
+        self._slots = None
+
+    def _start(self, plan):
+        pass
+
+    def _stop(self):
+        pass
+
+    def _submit(self, step, hooks):
+        'Starts flowing a step and returns a ``concurrent.futures.Future``'
+        raise NotImplementedError
+
+    def _finish(self, step, future, hooks): #pylint: disable=unused-argument
+        'Called by the scheduling thread when a submitted flow step has completed'
+        return future.result()
+
+    def _discard(self, step, future):
+        'Called for flow steps that were still running when execution was aborted'
+
+    def _priority(self, step):
+        '''
+        Ready steps with the smallest priority are started first.  Steps with the largest
+        value in ``priorities`` (e.g., from ``pemi.execution.critical_path``) are started
+        first, and ties are broken by the order of the plan.
+        '''
+        return (-self.priorities.get(step, 0), step.index)
+
+    def _can_start(self, step):
+        'Steps can only start when there are enough slots of the resources they use'
+        return self._slots.available(step)
+
+    def run(self, plan, hooks=()):
+        self._slots = ResourceSlots(self.resource_limits)
+        self._start(plan)
+        try:
+            self._schedule(plan, hooks)
+        finally:
+            self._stop()
+
+    def _schedule(self, plan, hooks):
+        schedule = _Schedule(plan, self._priority)
+        while schedule.error is None and (schedule.ready or schedule.running):
+            self._start_ready(schedule, hooks)
+            if not schedule.running:
+                if schedule.ready and schedule.error is None:
+                    raise DagValidationError('Unable to start any of the ready steps: {}'.format(
+                        [step for _, step in schedule.ready]
+                    ))
+                break
+            self._finish_next(schedule, hooks)
+
+        for step in schedule.running.values():
+            if step.streaming:
+                abort_streams(step.pipe, schedule.error)
+
+        for future, step in schedule.running.items():
+            future.exception()
+            if not step.streaming:
+                self._discard(step, future)
+
+        if schedule.error is not None:
+            raise schedule.error
+
+    def _start_ready(self, schedule, hooks):
+        'Executes ready connect steps and starts as many ready flow steps as possible'
+        deferred = []
+        while schedule.ready and schedule.error is None:
+            step = schedule.pop()
+            if step.kind == 'connect':
+                try:
+                    connect_step(step, hooks)
+                except Exception as err: #pylint: disable=broad-except
+                    schedule.error = err
+                    break
+                schedule.complete(step)
+            elif step.streaming:
+                schedule.start(step, run_in_thread(flow_step, step, hooks))
+            elif schedule.busy() >= self.max_workers or not self._can_start(step):
+                deferred.append(step)
+            else:
+                self._slots.acquire(step)
+                schedule.start(step, self._submit(step, hooks))
+
+        for step in deferred:
+            schedule.push(step)
+
+    def _finish_next(self, schedule, hooks):
+        'Waits for the next running flow step to complete'
+        future = schedule.completed.get()
+        step = schedule.running.pop(future)
+        try:
+            if step.streaming:
+                future.result()
+            else:
+                self._slots.release(step)
+                self._finish(step, future, hooks)
+        except Exception as err: #pylint: disable=broad-except
+            schedule.error = err
+            return
+        schedule.complete(step)
+
+
+class _Schedule:
+    'The state of an execution plan being run by a ``ConcurrentExecutor``'
+
+    def __init__(self, plan, priority):
+        self.priority = priority
+        self.remaining = {step: len(step.deps) for step in plan.steps}
+        self.ready = [(priority(step), step) for step in plan.steps if self.remaining[step] == 0]
+        heapq.heapify(self.ready)
+
+        self.running = {}
+        self.completed = queue.Queue()
+        self.error = None
+
+    def push(self, step):
+        heapq.heappush(self.ready, (self.priority(step), step))
+
+    def pop(self):
+        return heapq.heappop(self.ready)[1]
+
+    def start(self, step, future):
+        self.running[future] = step
+        future.add_done_callback(self.completed.put)
+
+    def complete(self, step):
+        for dependent in step.dependents:
+            self.remaining[dependent] -= 1
+            if self.remaining[dependent] == 0:
+                self.push(dependent)
+
+    def busy(self):
+        return sum(1 for step in self.running.values() if not step.streaming)
+
+
+class ThreadExecutor(ConcurrentExecutor): #pylint: disable=too-few-public-methods
+    'Flows independent pipes concurrently in a pool of threads'
+
+    def __init__(self, max_workers=None):
+        super().__init__(max_workers=max_workers)
+        self.pool = None
+
+    def _start(self, plan):
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def _stop(self):
+        self.pool.shutdown(wait=True)
+        self.pool = None
+
+    def _submit(self, step, hooks):
+        return self.pool.submit(flow_step, step, hooks)
+
+
+class SharedPipeData:
+    '''
+    A handle to the data subjects of a pipe that have been placed in shared memory by
+    ``share_pipe``.  The handle itself is small and cheap to send between processes.
+
+    Attributes:
+        pickled (bytes): The pickled pipe, without the data buffers of its subjects.
+        path (str): Path of the shared memory file holding the data buffers.
+        lengths (list): Size (in bytes) of each of the buffers stored in the file.
+    '''
+
+    def __init__(self, pickled, path, lengths):
+        self.pickled = pickled
+        self.path = path
+        self.lengths = lengths
+
+    @property
+    def nbytes(self):
+        return sum(self.lengths)
+
+    def unlink(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def shared_memory_dir():
+    'Directory used for shared memory files (``/dev/shm`` when available)'
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+def share_pipe(pipe, directory=None):
+    '''
+    Places the data subjects of a pipe (and all nested pipes) in shared memory so they can
+    be loaded by another process with ``load_shared_pipe``.  Subjects are pickled with
+    ``Pipe.to_pickle``, but the column data of dataframes is written to a memory-mapped
+    file rather than being copied into the pickled bytes.
+
+    Returns:
+        SharedPipeData: A handle to the shared data.
+    '''
+    buffers = []
+    pickled = pipe.to_pickle(buffer_callback=buffers.append)
+    raw_buffers = [buf.raw() for buf in buffers]
+
+    fd, path = tempfile.mkstemp(
+        prefix='pemi-', suffix='.shm', dir=directory or shared_memory_dir()
+    )
+    with os.fdopen(fd, 'wb') as shared_file:
+        for raw in raw_buffers:
+            shared_file.write(raw)
+
+    shared = SharedPipeData(pickled, path, [raw.nbytes for raw in raw_buffers])
+    pemi.log.debug('Shared %d bytes of data for pipe %s in %s', shared.nbytes, pipe, path)
+    return shared
+
+def load_shared_pipe(pipe, shared):
+    '''
+    Loads data subjects placed in shared memory by ``share_pipe`` into a pipe.  The data
+    buffers are mapped copy-on-write, so dataframes reference the shared pages directly.
+    The shared memory file is removed once it has been mapped.
+    '''
+    try:
+        buffers = [b''] * len(shared.lengths)
+        if shared.nbytes > 0:
+            with open(shared.path, 'rb') as shared_file:
+                mapped = mmap.mmap(shared_file.fileno(), shared.nbytes, access=mmap.ACCESS_COPY)
+
+            view = memoryview(mapped)
+            offset = 0
+            for idx, length in enumerate(shared.lengths):
+                buffers[idx] = view[offset:offset + length]
+                offset += length
+
+        return pipe.from_pickle(shared.pickled, buffers=buffers)
+    finally:
+        shared.unlink()
+
+
+# Pipes available to the worker processes of a ProcessExecutor.  Worker processes are
+# forked once the pipes have been registered, so each worker has its own copy of them.
+_PROCESS_PIPES = {}
+
+# Instruments (as getter and setter pairs) whose recordings are collected from worker
+# processes.  Active instruments are forked in the worker, and their recordings are sent
+# back with the result and merged into the instruments of the parent process.
+_WORKER_INSTRUMENTS = [
+    (pemi.tracing.get_tracer, pemi.tracing.set_tracer),
+    (pemi.metrics.get_registry, pemi.metrics.set_registry),
+    (pemi.memory.get_profiler, pemi.memory.set_profiler),
+]
+
+def _flow_in_process(key, data, shared_dir):
+    instruments = []
+    for get_instrument, set_instrument in _WORKER_INSTRUMENTS:
+        instrument = get_instrument()
+        instruments.append(instrument and instrument.fork())
+        set_instrument(instruments[-1])
+
+    pipe = _PROCESS_PIPES[key]
+    if isinstance(data, SharedPipeData):
+        load_shared_pipe(pipe, data)
+        flow_pipe(pipe)
+        result = share_pipe(pipe, shared_dir)
+    else:
+        pipe.from_pickle(data)
+        flow_pipe(pipe)
+        result = pipe.to_pickle()
+
+    return result, [instrument and instrument.dump() for instrument in instruments]
+
+class ProcessExecutor(ConcurrentExecutor): #pylint: disable=too-few-public-methods
+    '''
+    Flows independent pipes concurrently in a pool of forked worker processes.  The data
+    subjects of a pipe are sent to a worker process, which flows the pipe and sends the
+    subjects back.  Only the data subjects are transferred back to the parent process, so
+    any other changes a pipe makes to itself while flowing are lost.
+
+    By default, the column data of dataframes is handed off through memory-mapped shared
+    memory files (see ``share_pipe``) and only the remainder of the subjects is pickled.
+
+    Worker processes are forked, so this executor is only available on platforms that
+    support the ``fork`` start method.
+
+    Args:
+        max_workers (int): Maximum number of worker processes.
+        shared_memory (bool): Hand off data through shared memory (default) rather than by
+          pickling entire subjects (via ``Pipe.to_pickle``).
+        shared_dir (str): Directory used for shared memory files (see ``shared_memory_dir``).
+    '''
+
+    def __init__(self, max_workers=None, shared_memory=True, shared_dir=None):
+        super().__init__(max_workers=max_workers)
+        self.shared_memory = shared_memory
+        self.shared_dir = shared_dir or shared_memory_dir()
+        self.pool = None
+        self.keys = []
+        self.outbound = {}
+
+    def _start(self, plan):
+        for step in plan.flow_steps:
+            _PROCESS_PIPES[step.key] = step.pipe
+            self.keys.append(step.key)
+        self.pool = multiprocessing.get_context('fork').Pool(self.max_workers)
+
+    def _stop(self):
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+
+        for key in self.keys:
+            _PROCESS_PIPES.pop(key, None)
+        self.keys = []
+
+        for shared in self.outbound.values():
+            shared.unlink()
+        self.outbound = {}
+
+    def _submit(self, step, hooks):
+        for hook in hooks:
+            hook.before_flow(step)
+
+        pemi.log.info('Flowing pipe %s in a worker process', step.pipe)
+        if self.shared_memory:
+            data = share_pipe(step.pipe, self.shared_dir)
+            self.outbound[step] = data
+        else:
+            data = step.pipe.to_pickle()
+
+        future = concurrent.futures.Future()
+        self.pool.apply_async(
+            _flow_in_process,
+            (step.key, data, self.shared_dir),
+            callback=future.set_result,
+            error_callback=future.set_exception
+        )
+        return future
+
+    def _finish(self, step, future, hooks):
+        if step in self.outbound:
+            self.outbound.pop(step).unlink()
+
+        result, recordings = future.result()
+        if self.shared_memory:
+            load_shared_pipe(step.pipe, result)
+        else:
+            step.pipe.from_pickle(result)
+
+        for (get_instrument, _), recording in zip(_WORKER_INSTRUMENTS, recordings):
+            instrument = get_instrument()
+            if instrument is not None and recording is not None:
+                instrument.merge(recording)
+
+        for hook in hooks:
+            hook.after_flow(step)
+
+    def _discard(self, step, future):
+        if step in self.outbound:
+            self.outbound.pop(step).unlink()
+        if self.shared_memory and future.exception() is None:
+            future.result()[0].unlink()
+
+
+class AsyncExecutor(Executor): #pylint: disable=too-few-public-methods
+    '''
+    Flows pipes in an asyncio event loop, which is well suited to connection graphs with
+    many I/O-bound pipes.  Asynchronous pipes (see ``Pipe.is_async``) are awaited directly
+    in the event loop, so any number of them may be waiting on I/O at the same time.
+    Synchronous pipes are offloaded to a bounded pool of threads.
+
+    Args:
+        max_workers (int): Number of threads used to flow synchronous pipes.
+        max_concurrency (int): If provided, the maximum number of pipes (asynchronous or
+          synchronous) that may flow at the same time.
+    '''
+
+    def __init__(self, max_workers=None, max_concurrency=None):
+        self.max_workers = max_workers or min(32, multiprocessing.cpu_count() + 4)
+        self.max_concurrency = max_concurrency
+        self.resource_limits = {}
+
+    def run(self, plan, hooks=()):
+        loop = asyncio.new_event_loop()
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            loop.run_until_complete(self._run(plan, hooks, loop, pool))
+        finally:
+            pool.shutdown(wait=True)
+            loop.close()
+
+    async def _run(self, plan, hooks, loop, pool):
+        limit = asyncio.Semaphore(self.max_concurrency) if self.max_concurrency else None
+        slots = ResourceSlots(self.resource_limits)
+        slots_changed = asyncio.Condition()
+        tasks = {}
+        streaming = {}
+
+        async def flow(step):
+            async with slots_changed:
+                await slots_changed.wait_for(lambda: slots.available(step))
+                slots.acquire(step)
+
+            try:
+                if step.pipe.is_async():
+                    await flow_step_async(step, hooks)
+                else:
+                    await loop.run_in_executor(pool, flow_step, step, hooks)
+            finally:
+                async with slots_changed:
+                    slots.release(step)
+                    slots_changed.notify_all()
+
+        async def run_step(step):
+            if step.deps:
+                await asyncio.gather(*[tasks[dep] for dep in step.deps])
+
+            if step.kind == 'connect':
+                connect_step(step, hooks)
+            elif step.streaming:
+                streaming[step] = run_in_thread(flow_step, step, hooks)
+                await asyncio.wrap_future(streaming[step])
+            elif limit is None:
+                await flow(step)
+            else:
+                async with limit:
+                    await flow(step)
+
+        for step in plan.steps:
+            tasks[step] = loop.create_task(run_step(step))
+
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException as err:
+            for step in streaming:
+                abort_streams(step.pipe, err)
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            concurrent.futures.wait(list(streaming.values()))
+            raise
+
+
+def _detached(subject):
+    detached = copy.copy(subject)
+    detached.pipe = None
+    return detached
+
+def _flow_distributed(pipe, inputs):
+    '''
+    Flows a pipe on a dask.distributed worker.  ``inputs`` maps the name of each source of
+    the pipe to the subject it is connected from.  Returns the subjects of the pipe and the
+    time spent flowing it on the worker.
+    '''
+    for name, subject in inputs.items():
+        pipe.sources[name].connect_from(subject)
+
+    start = time.perf_counter()
+    flow_pipe(pipe)
+    return {
+        'sources': {name: _detached(subject) for name, subject in pipe.sources.items()},
+        'targets': {name: _detached(subject) for name, subject in pipe.targets.items()},
+        'duration': time.perf_counter() - start,
+    }
+
+def _select_subject(result, kind, name):
+    return result[kind][name]
+
+def _select_duration(result):
+    return result['duration']
+
+class DistributedExecutor(Executor): #pylint: disable=too-few-public-methods
+    '''
+    Flows pipes as tasks on a dask.distributed cluster.  Each pipe is serialized and
+    shipped to a worker along with the subjects it is connected from.  The subjects a pipe
+    produces stay on the worker that produced them (as dask futures), so the scheduler can
+    run downstream pipes close to their data.  Connections are resolved on the scheduling
+    side without moving any data.
+
+    Once all pipes have flowed, the resulting subjects are copied back into the local pipe
+    objects so that the job can be inspected as if it had been flowed locally.  Set
+    ``gather=False`` to only copy back the targets of the pipes that own the connections.
+
+    Pipes are timed on the worker that flows them, and the time is set as the ``duration``
+    of their steps, so that hooks (e.g., ``pemi.hooks.HistoryHook``) do not count the time
+    spent waiting in the queue of the cluster.  Resource limits are not supported.
+
+    Requires the ``distributed`` package.
+
+    Args:
+        client (distributed.Client): The client used to submit tasks (defaults to the
+          current default client).
+        gather (bool): Copy the subjects of all nested pipes back from the cluster.
+    '''
+
+    def __init__(self, client=None, gather=True):
+        self.client = client
+        self.gather = gather
+
+    def run(self, plan, hooks=()):
+        streaming = [step for step in plan.flow_steps if step.streaming]
+        if streaming:
+            raise ValueError(
+                'Streaming connections are not supported by the distributed executor: {}'
+                .format(streaming)
+            )
+
+        import distributed #pylint: disable=import-outside-toplevel
+        client = self.client or distributed.default_client()
+
+        subjects = _SubjectRefs()
+        futures = {}
+        for step in plan.steps:
+            if step.kind == 'connect':
+                subjects.connect(step.conn)
+            else:
+                futures[self._submit(client, step, hooks, subjects)] = step
+
+        for future in distributed.as_completed(list(futures)):
+            step = futures[future]
+            step.duration = future.result()
+            try:
+                for hook in hooks:
+                    hook.after_flow(step)
+            finally:
+                step.duration = None
+
+        self._gather(client, plan, subjects)
+
+    @staticmethod
+    def _submit(client, step, hooks, subjects):
+        inputs = {}
+        for name in step.pipe.sources:
+            ref = subjects.get(step.parent, step.pipe_name, 'sources', name)
+            if ref is not None:
+                inputs[name] = ref
+
+        for hook in hooks:
+            hook.before_flow(step)
+
+        pemi.log.info('Submitting pipe %s to the cluster', step.pipe)
+        future = client.submit(
+            _flow_distributed, step.pipe, inputs,
+            key='pemi-flow-{}-{}'.format(step.qualname, uuid.uuid4().hex), pure=False
+        )
+
+        for kind in ['sources', 'targets']:
+            for name in getattr(step.pipe, kind):
+                subjects.set(step.parent, step.pipe_name, kind, name, client.submit(
+                    _select_subject, future, kind, name,
+                    key='pemi-subject-{}-{}'.format(name, uuid.uuid4().hex)
+                ))
+        return client.submit(
+            _select_duration, future, key='pemi-duration-{}'.format(uuid.uuid4().hex)
+        )
+
+    def _gather(self, client, plan, subjects):
+        top = {id(parent) for parent in plan.parents}
+        remote = {}
+        for key, value in subjects.refs.items():
+            pipe, kind, _ = subjects.owners[key]
+            if not isinstance(value, pemi.data_subject.DataSubject) and \
+                    (self.gather or (id(pipe) in top and kind == 'targets')):
+                remote[key] = value
+
+        for key, subject in zip(remote, client.gather(list(remote.values()))):
+            pipe, kind, name = subjects.owners[key]
+            subject = copy.copy(subject)
+            subject.pipe = pipe
+            getattr(pipe, kind)[name] = subject
+
+
+class _SubjectRefs:
+    '''
+    The subjects of the pipes flowed by a ``DistributedExecutor``, either as local data
+    subjects or as futures of subjects held on the cluster.
+    '''
+
+    def __init__(self):
+        self.owners = {}
+        self.refs = {}
+
+    def key(self, parent, pipe_name, kind, subject_name):
+        pipe = parent.pipes[pipe_name]
+        key = (id(pipe), kind, subject_name)
+        self.owners[key] = (pipe, kind, subject_name)
+        return key
+
+    def get(self, parent, pipe_name, kind, subject_name):
+        return self.refs.get(self.key(parent, pipe_name, kind, subject_name))
+
+    def set(self, parent, pipe_name, kind, subject_name, ref): #pylint: disable=too-many-arguments
+        self.refs[self.key(parent, pipe_name, kind, subject_name)] = ref
+
+    def connect(self, conn):
+        'Resolves a connection without moving any data'
+        from_kind = 'sources' if conn.is_from_self else 'targets'
+        to_kind = 'targets' if conn.is_to_self else 'sources'
+        ref = self.get(conn.parent, conn.from_pipe_name, from_kind, conn.from_subject_name)
+        self.set(conn.parent, conn.to_pipe_name, to_kind, conn.to_subject_name,
+                 ref or _detached(conn.from_subject))
+
+
+EXECUTORS = {
+    'serial': SerialExecutor,
+    'thread': ThreadExecutor,
+    'process': ProcessExecutor,
+    'asyncio': AsyncExecutor,
+    'distributed': DistributedExecutor,
+}
+
+def get_executor(executor, max_workers=None):
+    '''
+    Returns an executor object.
+
+    Args:
+        executor: Either an ``Executor`` instance, or the name of an executor
+          (``'serial'``, ``'thread'``, ``'process'``, ``'asyncio'`` or ``'distributed'``).
+        max_workers (int): Maximum number of concurrent pipes for concurrent executors.
+    '''
+    if isinstance(executor, Executor):
+        return executor
+
+    executor_class = EXECUTORS.get(executor)
+    if executor_class is None:
+        raise ValueError('Unknown executor: {}'.format(executor))
+    if executor_class in (SerialExecutor, DistributedExecutor):
+        return executor_class()
+    return executor_class(max_workers=max_workers)
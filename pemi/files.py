@@ -0,0 +1,84 @@
+'''
+Helpers for the small local files that hold the state of pemi jobs (e.g., watermarks,
+offsets, duration histories and checkpoint ledgers).
+
+Files are written atomically: the content is written to a uniquely named temporary file
+in the same directory, which then replaces the file.  Readers never see a partially
+written file, and concurrent writers never write to the same temporary file.
+'''
+
+import os
+import json
+import tempfile
+import contextlib
+
+# Permissions of files that did not exist before they were written
+DEFAULT_PERMISSIONS = 0o644
+
+@contextlib.contextmanager
+def atomic_write(path, mode='w'):
+    '''
+    Context manager that yields a file object and atomically replaces ``path`` with the
+    content written to it when the block exits.  If the block raises, ``path`` is left
+    untouched.  The replaced file keeps its permissions (new files get
+    ``DEFAULT_PERMISSIONS``).  Text is written as UTF-8.
+    '''
+    directory = os.path.dirname(os.path.abspath(path))
+    tmp_file = tempfile.NamedTemporaryFile( #pylint: disable=consider-using-with
+        mode=mode, encoding=None if 'b' in mode else 'utf-8', dir=directory,
+        prefix='.{}.'.format(os.path.basename(path)), suffix='.tmp', delete=False
+    )
+    try:
+        with tmp_file:
+            yield tmp_file
+        try:
+            permissions = os.stat(path).st_mode & 0o777
+        except FileNotFoundError:
+            permissions = DEFAULT_PERMISSIONS
+        os.chmod(tmp_file.name, permissions)
+        os.replace(tmp_file.name, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_file.name)
+        raise
+
+def read_json(path, default=None):
+    'Reads a JSON file, returning ``default`` if the file does not exist'
+    if not os.path.exists(path):
+        return default
+
+    with open(path, encoding='utf-8') as json_file:
+        return json.load(json_file)
+
+def write_json(path, data, **dump_opts):
+    'Atomically writes ``data`` to a JSON file (``dump_opts`` are passed to ``json.dump``)'
+    with atomic_write(path) as json_file:
+        json.dump(data, json_file, **dump_opts)
+    return path
+
+
+class JsonStore:
+    '''
+    Persists values by key in a local JSON file.  Each ``set`` reads the file, updates
+    the key and atomically rewrites the file.
+
+    Args:
+        path (str): Path to the JSON file.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        'Returns all of the stored values, keyed by key'
+        return read_json(self.path, default={})
+
+    def get(self, key, default=None):
+        'Returns the value stored for ``key``'
+        return self.read().get(key, default)
+
+    def set(self, key, value):
+        'Stores ``value`` for ``key``'
+        stored = self.read()
+        stored[key] = value
+        write_json(self.path, stored, indent=2, sort_keys=True)
@@ -0,0 +1,183 @@
+'''
+Hooks that are notified as execution plans are executed (see ``pemi.execution``).
+'''
+
+import time
+import threading
+
+import pemi
+import pemi.files
+import pemi.execution
+
+class ExecutionHook:
+    '''
+    Base class for objects that want to be notified as a plan is executed.  Hooks of flow
+    steps are called in the thread that flows the pipe.
+    '''
+
+    def before_run(self, plan):
+        pass
+
+    def after_run(self, plan):
+        pass
+
+    def before_connect(self, conn):
+        pass
+
+    def after_connect(self, conn):
+        pass
+
+    def before_flow(self, step):
+        pass
+
+    def after_flow(self, step):
+        pass
+
+
+class ReleaseHook(ExecutionHook):
+    '''
+    Releases data subjects (see ``DataSubject.release``) as soon as every step that
+    consumes them has completed, so that intermediate data does not stay in memory until
+    the whole plan has been executed.  The targets of a pipe are consumed by the
+    connections from them, and the sources of a pipe are consumed when the pipe flows.
+
+    Subjects created with ``retain=True`` are never released, nor are the sources and
+    targets of the pipes that own the connections being flowed.
+
+    Attributes:
+        freed (dict): Bytes of memory freed after each step, keyed by step name.
+    '''
+
+    def __init__(self):
+        self.freed = {}
+        self._consumers = {}
+        self._lock = threading.Lock()
+
+    @property
+    def total_freed(self):
+        return sum(self.freed.values())
+
+    @staticmethod
+    def _consumed(step):
+        'Keys of the subjects consumed by a step'
+        if step.kind == 'flow':
+            return [
+                (step.parent, step.pipe_name, 'sources', name) for name in step.pipe.sources
+            ]
+
+        conn = step.conn
+        if conn.is_from_self:
+            return [(conn.parent, conn.from_pipe_name, 'sources', conn.from_subject_name)]
+        return [(conn.parent, conn.from_pipe_name, 'targets', conn.from_subject_name)]
+
+    @staticmethod
+    def _key(consumed):
+        parent, pipe_name, kind, subject_name = consumed
+        return (id(parent), pipe_name, kind, subject_name)
+
+    def before_run(self, plan):
+        top = {id(step.conn.parent) for step in plan.steps if step.kind == 'connect'} \
+            - {id(pipe) for pipe in plan.flattened}
+
+        self.freed = {}
+        self._consumers = {}
+        for step in plan.steps:
+            for consumed in self._consumed(step):
+                if consumed[1] == 'self' and id(consumed[0]) in top:
+                    continue
+                key = self._key(consumed)
+                self._consumers.setdefault(key, [consumed, 0])[1] += 1
+
+    def _release(self, step):
+        freed = 0
+        for consumed in self._consumed(step):
+            with self._lock:
+                entry = self._consumers.get(self._key(consumed))
+                if entry is None:
+                    continue
+                entry[1] -= 1
+                if entry[1] > 0:
+                    continue
+
+            parent, pipe_name, kind, subject_name = consumed
+            subject = getattr(parent.pipes[pipe_name], kind)[subject_name]
+            if not subject.retain:
+                freed += subject.release()
+
+        if freed > 0:
+            pemi.log.info('Released %d bytes after %s', freed, step)
+        with self._lock:
+            self.freed[step.name] = self.freed.get(step.name, 0) + freed
+
+    def after_connect(self, conn):
+        self._release(pemi.execution.Step('connect', conn.parent, conn=conn))
+
+    def after_flow(self, step):
+        self._release(step)
+
+    def after_run(self, plan):
+        pemi.log.info('Released %d bytes in total', self.total_freed)
+
+
+class DurationHistory:
+    '''
+    Records how long pipes take to flow in a local JSON file, so that the durations can be
+    used to schedule later runs (see ``pemi.execution.critical_path``).  Durations are
+    estimated with an exponentially weighted moving average, so estimates follow pipes that
+    get slower or faster over time.
+
+    Args:
+        path (str): Path to the JSON history file.
+        alpha (float): Weight given to the most recent duration when re-estimating.
+    '''
+
+    def __init__(self, path, alpha=0.5):
+        self.path = path
+        self.alpha = alpha
+        self.durations = pemi.files.read_json(self.path, default={})
+        self._lock = threading.Lock()
+
+    def estimate(self, key, default=None):
+        'Returns the estimated duration (in seconds) of the step with the given key'
+        entry = self.durations.get(key)
+        if entry is None:
+            return default
+        return entry['duration']
+
+    def record(self, key, duration):
+        'Re-estimates the duration of a step from a newly observed duration'
+        with self._lock:
+            entry = self.durations.get(key)
+            if entry is None:
+                entry = self.durations[key] = {'duration': duration, 'runs': 0}
+            else:
+                entry['duration'] = self.alpha * duration + (1 - self.alpha) * entry['duration']
+            entry['runs'] += 1
+
+    def save(self):
+        with self._lock:
+            pemi.files.write_json(self.path, self.durations, indent=2, sort_keys=True)
+
+
+class HistoryHook(ExecutionHook):
+    '''
+    Records the durations of flow steps in a ``DurationHistory``, which is saved after each
+    run.  Steps are timed from ``before_flow`` to ``after_flow``, unless the executor
+    measured the ``duration`` of the step where the pipe ran.
+    '''
+
+    def __init__(self, history):
+        self.history = history
+        self._started = {}
+
+    def before_flow(self, step):
+        self._started[step] = time.perf_counter()
+
+    def after_flow(self, step):
+        duration = time.perf_counter() - self._started.pop(step)
+        if step.duration is not None:
+            duration = step.duration
+        self.history.record(step.qualname, duration)
+
+    def after_run(self, plan):
+        self.history.save()
@@ -0,0 +1,484 @@
+'''
+Memory management for the dataframes held by ``PdDataSubject`` objects.
+
+When a ``MemoryManager`` is active (see ``set_manager``), every dataframe assigned to a
+``PdDataSubject`` is tracked along with its deep memory size.  If the total size of the
+tracked dataframes grows beyond the manager's budget, the least recently used dataframes
+are spilled to local files and are transparently reloaded the next time the ``df``
+attribute of a subject holding them is accessed.
+
+When a ``MemoryProfiler`` is active (see ``set_profiler``), the size of every dataframe
+assigned to a ``PdDataSubject`` and the resident memory of the process before and after each
+pipe flows are recorded, to find the pipes and subjects responsible for high memory usage.
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import weakref
+import itertools
+import contextlib
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import pemi
+import pemi.cache
+import pemi.metrics
+
+try:
+    import resource
+except ImportError: # pragma: no cover
+    resource = None
+
+_MANAGER = None
+_PROFILER = None
+
+def set_manager(manager):
+    '''
+    Activates a memory manager for all ``PdDataSubject`` dataframes assigned from now on.
+    Pass ``None`` to deactivate memory management.
+
+    Returns:
+        MemoryManager: The previously active manager.
+    '''
+    global _MANAGER #pylint: disable=global-statement
+    previous = _MANAGER
+    _MANAGER = manager
+    return previous
+
+def get_manager():
+    'Returns the active memory manager (or ``None``)'
+    return _MANAGER
+
+def set_profiler(profiler):
+    '''
+    Activates a memory profiler for all pipes flowed and ``PdDataSubject`` dataframes
+    assigned from now on.  Pass ``None`` to deactivate profiling.
+
+    Returns:
+        MemoryProfiler: The previously active profiler.
+    '''
+    global _PROFILER #pylint: disable=global-statement
+    previous = _PROFILER
+    _PROFILER = profiler
+    return previous
+
+def get_profiler():
+    'Returns the active memory profiler (or ``None``)'
+    return _PROFILER
+
+
+class FrameHandle:
+    '''
+    A dataframe tracked by a memory manager.  Subjects that hold the same dataframe share
+    the same handle, so the frame is only counted and spilled once.
+
+    Attributes:
+        nbytes (int): Deep memory size of the dataframe.
+        path (str): Path of the spill file while the dataframe is spilled.
+    '''
+
+    def __init__(self, manager, df):
+        self.manager = manager
+        self.df = df
+        self.nbytes = int(df.memory_usage(index=True, deep=True).sum())
+        self.path = None
+        self.fmt = None
+        self.key = next(manager._keys) #pylint: disable=protected-access
+        self.frame_ids = [id(df)]
+
+    @property
+    def spilled(self):
+        return self.df is None
+
+    def get(self):
+        'Returns the dataframe, reloading it if it has been spilled'
+        return self.manager.load(self)
+
+
+class MemoryManager: #pylint: disable=too-many-instance-attributes
+    '''
+    Keeps the total memory used by ``PdDataSubject`` dataframes within a budget by spilling
+    the least recently used dataframes to disk.  Dataframes are spilled as Parquet files when
+    possible (see ``pemi.cache.dump_frame``).
+
+    Args:
+        budget (int): Maximum number of bytes of dataframes to keep in memory.
+        spill_dir (str): Directory in which a temporary spill directory is created
+          (defaults to the system temporary directory).
+
+    Attributes:
+        spills (int): Number of dataframes spilled to disk.
+        spilled_bytes (int): Total number of bytes spilled to disk.
+        reloads (int): Number of dataframes reloaded from disk.
+        reloaded_bytes (int): Total number of bytes reloaded from disk.
+        collected (int): Number of tracked dataframes that were dropped from the manager
+          once they were no longer referenced by any subject (these are not spills).
+
+    While a ``pemi.metrics`` registry is active, spills, reloads and the peak resident size
+    are also recorded as ``pemi_memory_*`` metrics.
+
+    Example:
+        Limiting dataframes to 4GB of memory while a job flows::
+
+            manager = pemi.memory.MemoryManager(budget=4 * 2**30)
+            with manager:
+                job.flow()
+            print(manager.metrics)
+    '''
+
+    def __init__(self, budget, spill_dir=None):
+        self.budget = budget
+        self.spill_dir = spill_dir
+
+        # Activity counters, kept as plain attributes and reported together by metrics
+        self.spills = 0
+        self.spilled_bytes = 0
+        self.reloads = 0
+        self.reloaded_bytes = 0
+        self.collected = 0
+        self.peak_resident_bytes = 0
+
+        self._resident = OrderedDict()
+        self._frames = {}
+        self._keys = itertools.count()
+        self._path = None
+        self._lock = threading.RLock()
+        self._previous = None
+
+    def __enter__(self):
+        self._previous = set_manager(self)
+        return self
+
+    def __exit__(self, *exc):
+        set_manager(self._previous)
+        self._previous = None
+
+    @property
+    def resident_bytes(self):
+        'Number of bytes of tracked dataframes currently held in memory'
+        with self._lock:
+            return sum(handle.nbytes for handle in self._live(self._resident))
+
+    @property
+    def metrics(self):
+        'A dictionary of spill, reload and collection activity'
+        return {
+            'budget_bytes': self.budget,
+            'resident_bytes': self.resident_bytes,
+            'peak_resident_bytes': self.peak_resident_bytes,
+            'spills': self.spills,
+            'spilled_bytes': self.spilled_bytes,
+            'reloads': self.reloads,
+            'reloaded_bytes': self.reloaded_bytes,
+            'collected': self.collected,
+        }
+
+    @staticmethod
+    def _live(refs):
+        return [handle for handle in (ref() for ref in refs.values()) if handle is not None]
+
+    def _spill_path(self):
+        if self._path is None:
+            self._path = tempfile.mkdtemp(prefix='pemi-spill-', dir=self.spill_dir)
+            weakref.finalize(self, shutil.rmtree, self._path, True)
+        return self._path
+
+    def track(self, df):
+        '''
+        Starts tracking a dataframe and returns its handle.  Dataframes already tracked
+        (e.g., when connecting one subject to another) reuse the existing handle.
+        '''
+        with self._lock:
+            ref = self._frames.get(id(df))
+            handle = ref and ref()
+            if handle is not None and handle.df is df:
+                self._touch(handle)
+                return handle
+
+            handle = FrameHandle(self, df)
+            self._frames[id(df)] = weakref.ref(handle)
+            weakref.finalize(handle, self._collect, handle.key, handle.frame_ids, handle.nbytes)
+            self._touch(handle)
+            self._enforce_budget(keep=handle)
+            return handle
+
+    def load(self, handle):
+        'Returns the dataframe of a handle, reloading it from disk if it has been spilled'
+        with self._lock:
+            if handle.spilled:
+                handle.df = pemi.cache.load_frame(handle.path, handle.fmt)
+                os.remove(handle.path)
+                handle.path = None
+
+                self.reloads += 1
+                self.reloaded_bytes += handle.nbytes
+                pemi.metrics.counter(
+                    'pemi_memory_reloads_total', 'Dataframes reloaded from disk'
+                ).inc()
+                pemi.metrics.counter(
+                    'pemi_memory_reloaded_bytes_total', 'Bytes of dataframes reloaded from disk'
+                ).inc(handle.nbytes)
+                self._frames[id(handle.df)] = weakref.ref(handle)
+                handle.frame_ids[0] = id(handle.df)
+                pemi.log.debug('Reloaded %d bytes of spilled data', handle.nbytes)
+
+                self._touch(handle)
+                self._enforce_budget(keep=handle)
+            else:
+                self._touch(handle)
+            return handle.df
+
+    def _touch(self, handle):
+        self._resident.pop(handle.key, None)
+        self._resident[handle.key] = weakref.ref(handle)
+
+    def _enforce_budget(self, keep):
+        resident = self._live(self._resident)
+        total = sum(handle.nbytes for handle in resident)
+        for handle in resident:
+            if total <= self.budget:
+                break
+            if handle is keep:
+                continue
+            total -= handle.nbytes
+            self.spill(handle)
+        self.peak_resident_bytes = max(self.peak_resident_bytes, total)
+        pemi.metrics.gauge(
+            'pemi_memory_peak_resident_bytes', 'Peak bytes of dataframes held in memory'
+        ).set(self.peak_resident_bytes)
+
+    def spill(self, handle):
+        'Writes the dataframe of a handle to disk and drops it from memory'
+        with self._lock:
+            if handle.spilled:
+                return
+
+            path = os.path.join(self._spill_path(), '{}.frame'.format(handle.key))
+            handle.fmt = pemi.cache.dump_frame(handle.df, path)
+            handle.path = path
+            self._frames.pop(id(handle.df), None)
+            self._resident.pop(handle.key, None)
+            handle.df = None
+
+            self.spills += 1
+            self.spilled_bytes += handle.nbytes
+            pemi.metrics.counter('pemi_memory_spills_total', 'Dataframes spilled to disk').inc()
+            pemi.metrics.counter(
+                'pemi_memory_spilled_bytes_total', 'Bytes of dataframes spilled to disk'
+            ).inc(handle.nbytes)
+            pemi.log.debug('Spilled %d bytes of data to %s', handle.nbytes, path)
+
+    def _collect(self, key, frame_ids, nbytes):
+        with self._lock:
+            self._resident.pop(key, None)
+            ref = self._frames.get(frame_ids[0])
+            if ref is not None and ref() is None:
+                del self._frames[frame_ids[0]]
+
+            path = os.path.join(self._path or '', '{}.frame'.format(key))
+            if self._path is not None and os.path.exists(path):
+                os.remove(path)
+
+            self.collected += 1
+            pemi.log.debug('Dropped %d bytes of unreferenced data', nbytes)
+
+
+def peak_rss():
+    'Returns the peak resident set size of the current process in bytes (or ``None``)'
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+def process_rss():
+    '''
+    Returns the current resident set size of the process in bytes.  Where the current size
+    is not available (i.e., without ``/proc``), the peak size is returned instead.
+    '''
+    try:
+        with open('/proc/self/statm', encoding='utf-8') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return peak_rss()
+
+def frame_bytes(df, sample_rows=None):
+    '''
+    Returns the deep memory size of a dataframe.  Measuring the deep size of object columns
+    (e.g., strings) requires inspecting every value, so if ``sample_rows`` is provided, the
+    size of the object columns of larger dataframes is estimated from that many evenly spaced
+    rows.
+    '''
+    if sample_rows is None or len(df) <= sample_rows:
+        return int(df.memory_usage(index=True, deep=True).sum())
+
+    is_object = [
+        dtype.kind == 'O' and not isinstance(dtype, pd.CategoricalDtype) for dtype in df.dtypes
+    ]
+    nbytes = int(df.memory_usage(index=True, deep=False).sum())
+    if not any(is_object):
+        return nbytes
+
+    objects = df.iloc[:, is_object]
+    positions = np.linspace(0, len(df) - 1, num=sample_rows).astype(int)
+    sampled = objects.iloc[positions].memory_usage(index=False, deep=True).sum()
+    shallow = objects.memory_usage(index=False, deep=False).sum()
+    return int(nbytes - shallow + sampled * len(df) / sample_rows)
+
+
+class MemoryProfiler:
+    '''
+    Records the memory used by ``PdDataSubject`` dataframes and by each pipe that flows.
+
+    The deep size of each dataframe is recorded when it is assigned to a subject, and the
+    largest size seen for each subject is reported by ``largest_subjects``.  The resident
+    set size (RSS) of the process is recorded before and after each pipe flows.  If the peak
+    RSS of the process grows while a pipe flows, the pipe's peak delta is the growth from the
+    RSS before the pipe flowed to the new peak; otherwise, it is the change in RSS.  With
+    executors that flow pipes concurrently in threads, the deltas of overlapping pipes
+    include each other's memory.
+
+    Args:
+        sample_rows (int): Sampling mode: estimate the deep size of the object columns of
+          dataframes with more than this many rows from a sample (see ``frame_bytes``).
+
+    Example:
+        Finding the pipes and subjects that use the most memory::
+
+            with pemi.memory.MemoryProfiler(sample_rows=1000) as profiler:
+                job.flow()
+            print(profiler.report())
+    '''
+
+    def __init__(self, sample_rows=None):
+        self.sample_rows = sample_rows
+        self.pipes = {}
+        self.subjects = {}
+
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self._previous = None
+
+    def __enter__(self):
+        self._previous = set_profiler(self)
+        return self
+
+    def __exit__(self, *exc):
+        set_profiler(self._previous)
+        self._previous = None
+
+    def _frame_bytes(self, df):
+        key = id(df)
+        ref, nbytes = self._sizes.get(key, (None, None))
+        if ref is not None and ref() is df:
+            return nbytes
+
+        nbytes = frame_bytes(df, self.sample_rows)
+        self._sizes[key] = (weakref.ref(df, lambda _, key=key: self._sizes.pop(key, None)), nbytes)
+        return nbytes
+
+    def record_subject(self, subject, df, nbytes=None):
+        '''
+        Records the size of a dataframe assigned to a subject.  Dataframes shared by several
+        subjects (e.g., by connected subjects) are only measured once.
+
+        Args:
+            nbytes (int): The deep size of the dataframe, if it is already known.
+        '''
+        if nbytes is None:
+            nbytes = self._frame_bytes(df)
+
+        key = (getattr(subject.pipe, 'name', None), subject.name)
+        with self._lock:
+            recorded = self.subjects.get(key)
+            if recorded is None or nbytes > recorded['bytes']:
+                self.subjects[key] = {
+                    'pipe': key[0], 'subject': key[1], 'bytes': nbytes, 'rows': len(df)
+                }
+
+    def record_flow(self, pipe, rss_before, rss_after, peak_before, peak_after):
+        'Records the resident memory of the process before and after a pipe flowed'
+        peak = peak_after if peak_after is not None and peak_after > peak_before else rss_after
+        key = (pipe.name, pipe.__class__.__name__)
+        with self._lock:
+            recorded = self.pipes.setdefault(key, {
+                'pipe': key[0], 'pipe_class': key[1], 'flows': 0,
+                'rss_delta': rss_after - rss_before, 'peak_delta': peak - rss_before,
+                'rss_after': rss_after,
+            })
+            recorded['flows'] += 1
+            recorded['rss_delta'] = max(recorded['rss_delta'], rss_after - rss_before)
+            recorded['peak_delta'] = max(recorded['peak_delta'], peak - rss_before)
+            recorded['rss_after'] = rss_after
+
+    @contextlib.contextmanager
+    def profile_flow(self, pipe):
+        'Context manager that records the resident memory of the process around a flow'
+        peak_before = peak_rss()
+        rss_before = process_rss()
+        yield
+        self.record_flow(pipe, rss_before, process_rss(), peak_before, peak_rss())
+
+    def pipe_peaks(self, top=None):
+        'Returns the recorded pipes, sorted by largest peak delta first'
+        pipes = sorted(self.pipes.values(), key=lambda pipe: pipe['peak_delta'], reverse=True)
+        return pipes[:top]
+
+    def largest_subjects(self, top=10):
+        'Returns the recorded subjects, sorted by largest dataframe first'
+        subjects = sorted(
+            self.subjects.values(), key=lambda subject: subject['bytes'], reverse=True
+        )
+        return subjects[:top]
+
+    def report(self, top=10):
+        'Returns a text report of the pipes and subjects that used the most memory'
+        lines = ['Pipes by peak memory delta:']
+        for pipe in self.pipe_peaks(top):
+            lines.append('  {pipe} ({pipe_class}): peak {peak_delta:+,d} bytes, '
+                         'rss {rss_delta:+,d} bytes, {flows} flows'.format(**pipe))
+        lines.append('Largest subjects:')
+        for subject in self.largest_subjects(top):
+            lines.append('  {pipe}.{subject}: {bytes:,d} bytes, {rows:,d} rows'.format(**subject))
+        return '\n'.join(lines)
+
+    def fork(self):
+        '''
+        Returns an empty profiler with the same settings.  Used to collect the memory
+        recorded in worker processes, which is merged back into this profiler with ``merge``.
+        '''
+        return MemoryProfiler(sample_rows=self.sample_rows)
+
+    def dump(self):
+        'Returns the recorded pipes and subjects as a picklable tuple'
+        with self._lock:
+            return dict(self.pipes), dict(self.subjects)
+
+    def merge(self, dumped):
+        'Adds pipes and subjects returned by ``dump`` (e.g., of a forked profiler)'
+        pipes, subjects = dumped
+        with self._lock:
+            for key, pipe in pipes.items():
+                recorded = self.pipes.get(key)
+                if recorded is None:
+                    self.pipes[key] = dict(pipe)
+                    continue
+                recorded['flows'] += pipe['flows']
+                recorded['rss_delta'] = max(recorded['rss_delta'], pipe['rss_delta'])
+                recorded['peak_delta'] = max(recorded['peak_delta'], pipe['peak_delta'])
+                recorded['rss_after'] = pipe['rss_after']
+
+            for key, subject in subjects.items():
+                if key not in self.subjects or subject['bytes'] > self.subjects[key]['bytes']:
+                    self.subjects[key] = dict(subject)
+
+
+def profile_flow(pipe):
+    'Returns a context manager that records the memory used by a pipe flowing (if profiling)'
+    if _PROFILER is None:
+        return contextlib.nullcontext()
+    return _PROFILER.profile_flow(pipe)
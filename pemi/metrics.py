@@ -0,0 +1,338 @@
+'''
+Throughput and error metrics of pipe execution.
+
+When a ``MetricsRegistry`` is active (see ``set_registry``), every pipe that flows records
+the number of times it flowed and failed, the time spent flowing, and the rows and bytes
+held by its source and target data subjects.  Built-in pipes record additional metrics
+(e.g., the rows parsed from CSV files or fetched by SQL queries).  Metrics are exported in
+the Prometheus text exposition format, either as a textfile written at the end of a job
+(e.g., for the node exporter textfile collector) or from a local HTTP endpoint while the
+job is running.
+
+While no registry is active, ``counter`` and ``gauge`` return a shared no-op metric.
+'''
+
+import re
+import time
+import threading
+import contextlib
+import http.server
+
+import pemi.files
+
+_REGISTRY = None
+
+def set_registry(registry):
+    '''
+    Activates a metrics registry for all pipes flowed from now on.  Pass ``None`` to
+    deactivate metrics.
+
+    Returns:
+        MetricsRegistry: The previously active registry.
+    '''
+    global _REGISTRY #pylint: disable=global-statement
+    previous = _REGISTRY
+    _REGISTRY = registry
+    return previous
+
+def get_registry():
+    'Returns the active metrics registry (or ``None``)'
+    return _REGISTRY
+
+def counter(name, documentation):
+    'Returns a counter of the active registry, or a no-op metric if metrics are not active'
+    registry = _REGISTRY
+    if registry is None:
+        return _NO_METRIC
+    return registry.metric(name, 'counter', documentation)
+
+def gauge(name, documentation):
+    'Returns a gauge of the active registry, or a no-op metric if metrics are not active'
+    registry = _REGISTRY
+    if registry is None:
+        return _NO_METRIC
+    return registry.metric(name, 'gauge', documentation)
+
+
+class Metric:
+    '''
+    A counter or gauge, holding one value for each combination of label values.
+
+    Attributes:
+        samples (dict): Values keyed by tuples of ``(label, value)`` pairs.
+    '''
+
+    def __init__(self, name, kind, documentation):
+        if not re.match(r'^[a-zA-Z_:][a-zA-Z0-9_:]*$', name):
+            raise ValueError('Invalid metric name: {}'.format(name))
+        self.name = name
+        self.kind = kind
+        self.documentation = documentation
+        self.samples = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    def inc(self, value=1, **labels):
+        'Increments the value of the metric with the given labels'
+        key = self._key(labels)
+        with self._lock:
+            self.samples[key] = self.samples.get(key, 0) + value
+
+    def set(self, value, **labels):
+        'Sets the value of the metric with the given labels'
+        with self._lock:
+            self.samples[self._key(labels)] = value
+
+    def get(self, **labels):
+        'Returns the value of the metric with the given labels (or ``None``)'
+        return self.samples.get(self._key(labels))
+
+    def snapshot(self):
+        'Returns a copy of the samples of the metric'
+        with self._lock:
+            return dict(self.samples)
+
+    def merge(self, samples):
+        'Adds the samples of a forked registry (counters are added, gauges are replaced)'
+        for key, value in samples.items():
+            with self._lock:
+                if self.kind == 'counter':
+                    self.samples[key] = self.samples.get(key, 0) + value
+                else:
+                    self.samples[key] = value
+
+
+class _NoMetric:
+    def inc(self, value=1, **labels):
+        pass
+
+    def set(self, value, **labels):
+        pass
+
+_NO_METRIC = _NoMetric()
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self): #pylint: disable=invalid-name
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = self.registry.to_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): #pylint: disable=redefined-builtin
+        pass
+
+
+class MetricsRegistry:
+    '''
+    Collects metrics recorded while pipes flow and exports them in the Prometheus text
+    exposition format.
+
+    Args:
+        textfile (str): If provided, the metrics are written to this path when the
+          registry is deactivated (i.e., at the end of a ``with`` block or of a job flowed
+          with ``PipeConnections.flow(metrics=...)``).  The file is written atomically, so
+          it may be read by the node exporter textfile collector.
+        port (int): If provided, the metrics are served over HTTP on this port while the
+          registry is active.  Use ``0`` to pick a free port (see ``address``).
+        host (str): Interface the HTTP endpoint listens on.
+
+    Example:
+        Serving metrics while a job flows and writing them to a textfile at the end::
+
+            registry = pemi.metrics.MetricsRegistry(
+                textfile='/var/lib/node_exporter/my_job.prom', port=9108
+            )
+            with registry:
+                job.flow()
+    '''
+
+    def __init__(self, textfile=None, port=None, host='127.0.0.1'):
+        self.textfile = textfile
+        self.port = port
+        self.host = host
+
+        self.metrics = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._previous = None
+
+    def __enter__(self):
+        if self.port is not None:
+            self.serve()
+        self._previous = set_registry(self)
+        return self
+
+    def __exit__(self, *exc):
+        set_registry(self._previous)
+        self._previous = None
+        self.stop()
+        if self.textfile is not None:
+            self.write(self.textfile)
+
+    def metric(self, name, kind, documentation):
+        'Returns the metric with the given name, creating it if needed'
+        metric = self.metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self.metrics.setdefault(name, Metric(name, kind, documentation))
+        if metric.kind != kind:
+            raise ValueError('Metric {} is a {}, not a {}'.format(name, metric.kind, kind))
+        return metric
+
+    def counter(self, name, documentation):
+        'Returns the counter with the given name, creating it if needed'
+        return self.metric(name, 'counter', documentation)
+
+    def gauge(self, name, documentation):
+        'Returns the gauge with the given name, creating it if needed'
+        return self.metric(name, 'gauge', documentation)
+
+    def fork(self):
+        '''
+        Returns an empty registry.  Used to collect the metrics recorded in worker
+        processes, which are merged back into this registry with ``merge``.
+        '''
+        return MetricsRegistry()
+
+    def dump(self):
+        'Returns the recorded metrics as a picklable list'
+        return [
+            (metric.name, metric.kind, metric.documentation, metric.snapshot())
+            for metric in list(self.metrics.values())
+        ]
+
+    def merge(self, dumped):
+        'Adds metrics returned by ``dump`` (e.g., of a forked registry)'
+        for name, kind, documentation, samples in dumped:
+            self.metric(name, kind, documentation).merge(samples)
+
+    def to_prometheus(self):
+        'Returns the metrics in the Prometheus text exposition format'
+        lines = []
+        for name, metric in sorted(list(self.metrics.items())):
+            lines.append('# HELP {} {}'.format(name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(name, metric.kind))
+            for key, value in sorted(metric.snapshot().items()):
+                labels = ','.join('{}="{}"'.format(label, _escape(val)) for label, val in key)
+                lines.append('{}{} {}'.format(
+                    name, '{{{}}}'.format(labels) if labels else '', value
+                ))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        'Writes the metrics to a Prometheus textfile'
+        with pemi.files.atomic_write(path) as metrics_file:
+            metrics_file.write(self.to_prometheus())
+        return path
+
+    def serve(self, port=None, host=None):
+        '''
+        Starts serving the metrics over HTTP (at ``/metrics``) from a background thread.
+
+        Returns:
+            tuple: The host and port the endpoint is listening on.
+        '''
+        if self._server is None:
+            handler = type('MetricsHandler', (_MetricsHandler,), {'registry': self})
+            self._server = http.server.ThreadingHTTPServer(
+                (host or self.host, self.port if port is None else port), handler
+            )
+            self._server.daemon_threads = True
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self.address
+
+    @property
+    def address(self):
+        'The host and port of the HTTP endpoint (or ``None`` if it is not running)'
+        return self._server and self._server.server_address[:2]
+
+    def stop(self):
+        'Stops serving the metrics over HTTP'
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+@contextlib.contextmanager
+def metrics_run(metrics):
+    '''
+    Context manager that activates a metrics registry while a job runs.
+
+    Args:
+        metrics: Either a ``MetricsRegistry``, which is activated, or the path of a
+          textfile to which the metrics recorded while the job runs are written (even if
+          the job fails).  If ``None``, the currently active registry (if any) is left in
+          place.
+    '''
+    if metrics is None or metrics is _REGISTRY:
+        yield _REGISTRY
+        return
+
+    registry = metrics if isinstance(metrics, MetricsRegistry) else MetricsRegistry(metrics)
+    with registry:
+        yield registry
+
+
+def _subject_frames(subjects):
+    for name, subject in subjects.items():
+        resident_df = getattr(subject, 'resident_df', None)
+        df = resident_df() if resident_df is not None else None
+        if df is not None:
+            yield name, df
+
+def _record_subjects(pipe, labels):
+    rows_in = counter('pemi_subject_rows_in_total', 'Rows in the sources of pipes that flowed')
+    rows_out = counter('pemi_subject_rows_out_total', 'Rows in the targets of pipes that flowed')
+    bytes_out = counter(
+        'pemi_subject_bytes_out_total',
+        'Bytes (excluding referenced objects) in the targets of pipes that flowed'
+    )
+    error_rows = counter('pemi_pipe_error_rows_total', 'Rows in the errors targets of pipes')
+
+    for name, df in _subject_frames(pipe.sources):
+        rows_in.inc(len(df), subject=name, **labels)
+    for name, df in _subject_frames(pipe.targets):
+        rows_out.inc(len(df), subject=name, **labels)
+        bytes_out.inc(int(df.memory_usage(index=True, deep=False).sum()), subject=name, **labels)
+        if name == 'errors':
+            error_rows.inc(len(df), **labels)
+
+@contextlib.contextmanager
+def _flow_metrics(pipe):
+    labels = {'pipe': pipe.name, 'pipe_class': pipe.__class__.__name__}
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        counter('pemi_pipe_failures_total', 'Pipe flows that failed').inc(**labels)
+        raise
+    finally:
+        counter('pemi_pipe_flows_total', 'Pipe flows').inc(**labels)
+        counter('pemi_pipe_flow_seconds_total', 'Time spent flowing pipes').inc(
+            time.perf_counter() - start, **labels
+        )
+
+    _record_subjects(pipe, labels)
+
+def flow_metrics(pipe):
+    'Returns a context manager that records the metrics of a pipe flowing'
+    if _REGISTRY is None:
+        return contextlib.nullcontext()
+    return _flow_metrics(pipe)
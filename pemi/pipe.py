@@ -1,9 +1,11 @@
 import pickle
 import copy
+import inspect
 from collections import OrderedDict
 
 import pemi
 import pemi.connections
+import pemi.checkpoint
 
 
 class Pipe:
@@ -28,6 +30,11 @@ class Pipe:
 
     '''
 
+    #: Resources held by the pipe while it flows.  Either a list of resource names, or a
+    #: dictionary of the number of slots needed for each resource.  Executors limit how
+    #: many pipes may use a resource at once (see ``PipeConnections.flow``).
+    resources = ()
+
     def __init__(self, *, name='self', **params):
 
         self.name = name
@@ -105,13 +112,15 @@ class Pipe:
             **kwargs
         )
 
-    def pipe(self, name, pipe):
+    def pipe(self, name, pipe, resources=None):
         '''
         Defines a named pipe nested in this pipe.
 
         Args:
             name (str): Name of the nested pipe.
             pipe (pipe): The nested pipe instance.
+            resources: Resources used by the nested pipe while it flows (see
+              ``Pipe.resources``).
 
         Example:
             Creating a target::
@@ -130,6 +139,8 @@ class Pipe:
         '''
 
         pipe.name = name
+        if resources is not None:
+            pipe.resources = resources
         self.pipes[name] = pipe
 
 
@@ -173,13 +184,17 @@ class Pipe:
         return conn
 
 
-    def to_pickle(self, picklepipe=None):
+    def to_pickle(self, picklepipe=None, buffer_callback=None):
         '''
         Recursively pickle all of the data subjects in this and all nested pipes
 
         Args:
             picklepipe: A pickled representation of a pipe.  Only used for recursion\
                            not meant to be set by user.
+            buffer_callback: If provided, the pipe is pickled with protocol 5 and large
+                data buffers (e.g., the numeric column data of dataframes) are passed to
+                this callable as ``pickle.PickleBuffer`` objects instead of being copied
+                into the pickled bytes.  The same buffers must be given to ``from_pickle``.
 
         Returns:
             bytes: A bytes object containing the pickled pipe.
@@ -192,8 +207,17 @@ class Pipe:
 
 
         '''
-        picklepipe = picklepipe or Pipe()
+        picklepipe = self._pickle_mirror(picklepipe or Pipe())
+
+        if buffer_callback is None or pickle.HIGHEST_PROTOCOL < 5:
+            return pickle.dumps(picklepipe)
+        return pickle.dumps(picklepipe, protocol=5, buffer_callback=buffer_callback)
 
+    def _pickle_mirror(self, picklepipe):
+        '''
+        Builds a tree of bare pipes that mirrors this pipe and only holds copies of the
+        data subjects, which is what actually gets pickled.
+        '''
         for name, source in self.sources.items():
             psource = copy.copy(source)
             psource.pipe = picklepipe
@@ -209,19 +233,20 @@ class Pipe:
 
             nestedpicklepipe = Pipe()
             picklepipe.pipe(name=name, pipe=nestedpicklepipe)
-            picklepipe.pipes[name] = nestedpipe.to_pickle(nestedpicklepipe)
+            nestedpipe._pickle_mirror(nestedpicklepipe) #pylint: disable=protected-access
 
-        return pickle.dumps(picklepipe)
+        return picklepipe
 
 
-
-    def from_pickle(self, picklepipe=None):
+    def from_pickle(self, picklepipe=None, buffers=None):
         '''
         Recursively load all data subjects in all nested pipes from a pickled bytes object
         created by `to_pickle`.
 
         Args:
             picklepipe: The bytes object created by `to_pickle`
+            buffers: The out-of-band buffers collected by the ``buffer_callback`` given
+                to `to_pickle`, if any.
 
         Returns:
             self:
@@ -235,7 +260,11 @@ class Pipe:
                 my_other_pipe = MyPipe().from_pickle(pickled)
         '''
 
-        picklepipe = pickle.loads(picklepipe)
+        if isinstance(picklepipe, (bytes, bytearray, memoryview)):
+            if buffers is None:
+                picklepipe = pickle.loads(picklepipe)
+            else:
+                picklepipe = pickle.loads(picklepipe, buffers=buffers)
 
         for name, source in picklepipe.sources.items():
             source.pipe = self
@@ -253,9 +282,45 @@ class Pipe:
         return self
 
 
+    def to_checkpoint(self, path, compression=None):
+        '''
+        Writes all of the data subjects in this and all nested pipes to a checkpoint file.
+        Unlike `to_pickle`, the data of the subjects is streamed to the file without being
+        copied into a single bytes object (see ``pemi.checkpoint``).
+
+        Args:
+            path (str): Path of the checkpoint file.
+            compression (str): Optionally compress the checkpoint with ``'zlib'``,
+                ``'gzip'``, ``'bz2'`` or ``'lzma'``.
+
+        Returns:
+            int: The size of the checkpoint file in bytes.
+
+        Example:
+            Checkpointing a pipe and restoring it later::
+
+                my_pipe.to_checkpoint('my_pipe.ckpt')
+                my_other_pipe = MyPipe().from_checkpoint('my_pipe.ckpt')
+        '''
+        return pemi.checkpoint.write_checkpoint(self, path, compression=compression)
+
+    def from_checkpoint(self, path):
+        '''
+        Loads all of the data subjects in this and all nested pipes from a checkpoint file
+        created by `to_checkpoint`.  The file is memory-mapped rather than read into memory.
+
+        Returns:
+            self:
+        '''
+        return pemi.checkpoint.read_checkpoint(self, path)
+
+
     def flow(self):
         '''
-        Execute this pipe.  This method is meant to be defined in a child class.
+        Execute this pipe.  This method is meant to be defined in a child class.  Pipes
+        that only need to flow their connections may leave it undefined, in which case the
+        connections are flowed.  The connections of such pipes can also be flattened into
+        the plan of an enclosing pipe (see ``PipeConnections.flow``).
 
         Example:
             A simple hello-world pipe::
@@ -268,8 +333,25 @@ class Pipe:
             'hello world'
         '''
 
+        if len(self.connections.connections) > 0:
+            return self.connections.flow()
         raise NotImplementedError
 
+    def is_async(self):
+        '''
+        Whether this pipe should be flowed asynchronously, via `flow_async`.  By default,
+        pipes are asynchronous when `flow` is defined as a coroutine function
+        (``async def flow(self)``).
+        '''
+        return inspect.iscoroutinefunction(self.flow)
+
+    async def flow_async(self):
+        '''
+        Asynchronously execute this pipe.  Used by the ``'asyncio'`` executor for pipes where
+        `is_async` is true.  By default, this awaits `flow`.
+        '''
+        return await self.flow()
+
     def __str__(self):
         return "<{}({}) {}>".format(self.__class__.__name__, self.name, id(self))
 
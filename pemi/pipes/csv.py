@@ -4,6 +4,8 @@ import re
 import pandas as pd
 
 import pemi
+import pemi.tracing
+import pemi.metrics
 from pemi.pipes.patterns import TargetPipe
 
 def default_column_normalizer(name):
@@ -21,12 +23,24 @@ class StrConverter(dict):
         return str
 
 class LocalCsvFileSourcePipe(pemi.Pipe):
-    def __init__(self, *, paths, schema=None, csv_opts=None,
-                 filename_field=None, filename_full_path=False, normalize_columns=True, **params):
+    '''
+    Reads and coerces the records of local CSV files.
+
+    When ``chunk_size`` is given, the files are not read when the pipe flows.  Instead, the
+    ``main`` and ``errors`` targets become chunked (see ``pemi.PdChunkedDataSubject``) and
+    the files are read ``chunk_size`` records at a time as the chunks are consumed.  Both
+    targets are produced from a single pass over the files (see
+    ``pemi.data_subject.ChunkSplitter``).
+    '''
+
+    def __init__(self, *, paths, schema=None, csv_opts=None, #pylint: disable=too-many-arguments
+                 filename_field=None, filename_full_path=False, normalize_columns=True,
+                 chunk_size=None, **params):
         super().__init__(**params)
 
         self.paths = paths
         self.schema = schema
+        self.chunk_size = chunk_size
         self.filename_field = filename_field
         self.filename_full_path = filename_full_path
         self.csv_opts = self._build_csv_opts(csv_opts or {})
@@ -57,6 +71,22 @@ class LocalCsvFileSourcePipe(pemi.Pipe):
         pemi.log.debug('Parsing files at %s', data)
 
         filepaths = data
+        if self.chunk_size is not None and len(filepaths) > 0:
+            # The files are read again by every pass over the chunks (including passes that
+            # failed part way), so each chunk is only counted the first time it is parsed
+            counted = set()
+            def parse_chunks():
+                for chunk_id, mapper in self._parse_chunks(filepaths):
+                    if chunk_id not in counted:
+                        counted.add(chunk_id)
+                        self._count(mapper)
+                    yield {'main': mapper.mapped, 'errors': mapper.errors}
+
+            splitter = pemi.data_subject.ChunkSplitter(parse_chunks, ['main', 'errors'])
+            self.targets['main'].from_chunks(splitter.source('main'))
+            self.targets['errors'].from_chunks(splitter.source('errors'))
+            return None
+
         mapped_dfs = []
         error_dfs = []
         for filepath in filepaths:
@@ -101,7 +131,17 @@ class LocalCsvFileSourcePipe(pemi.Pipe):
 
         raw_df = pd.read_csv(filepath, **self.csv_opts)
         pemi.log.debug('Found %i raw records', len(raw_df))
+        return self._count(self._map(raw_df, filepath))
+
+    def _parse_chunks(self, filepaths):
+        'Yields the position of each chunk of the files, and its mapper'
+        for file_index, filepath in enumerate(filepaths):
+            pemi.log.debug('Parsing file at %s in chunks of %i', filepath, self.chunk_size)
+            raw_dfs = pd.read_csv(filepath, chunksize=self.chunk_size, **self.csv_opts)
+            for chunk_index, raw_df in enumerate(raw_dfs):
+                yield (file_index, chunk_index), self._map(raw_df, filepath)
 
+    def _map(self, raw_df, filepath):
         raw_df.columns = [self.column_normalizer(col) for col in raw_df.columns]
 
         if self.filename_field:
@@ -111,14 +151,28 @@ class LocalCsvFileSourcePipe(pemi.Pipe):
                 raw_df[self.filename_field] = os.path.basename(filepath)
 
         if self.schema:
-            return raw_df.mapping(
+            mapper = raw_df.mapping(
                 [(name, name, field.coerce) for name, field in self.schema.items()],
                 on_error='redirect'
             )
-        return raw_df.mapping([], inplace=True)
+        else:
+            mapper = raw_df.mapping([], inplace=True)
+        return mapper
+
+    def _count(self, mapper):
+        pemi.metrics.counter('pemi_csv_rows_total', 'Rows parsed from CSV files').inc(
+            len(mapper.mapped), pipe=self.name
+        )
+        pemi.metrics.counter('pemi_csv_error_rows_total', 'CSV rows that failed to parse').inc(
+            len(mapper.errors), pipe=self.name
+        )
+        return mapper
 
     def flow(self):
-        self.parse(self.extract())
+        with pemi.tracing.span('extract', self):
+            data = self.extract()
+        with pemi.tracing.span('parse', self):
+            self.parse(data)
 
 
 class LocalCsvFileTargetPipe(TargetPipe):
@@ -131,11 +185,35 @@ class LocalCsvFileTargetPipe(TargetPipe):
     def encode(self):
         return self.sources['main'].df
 
+    def encode_chunks(self):
+        'Returns an iterator over the chunks of a chunked or streamed source'
+        return self.sources['main'].iter_chunks()
+
     def load(self, encoded_data):
-        df = encoded_data
-        df.to_csv(self.path, **self.csv_opts)
+        '''
+        Writes the encoded data to the CSV file.  The data may be a dataframe or an
+        iterable of dataframe chunks, which are appended to the file as they arrive.
+        '''
+        chunks = [encoded_data] if isinstance(encoded_data, pd.DataFrame) else encoded_data
+
+        csv_opts = self.csv_opts
+        for chunk in chunks:
+            chunk.to_csv(self.path, **csv_opts)
+            csv_opts = {**self.csv_opts, 'mode': 'a', 'header': False}
+
+        if csv_opts is self.csv_opts:
+            pd.DataFrame(columns=self.sources['main'].schema.keys()).to_csv(self.path, **csv_opts)
         return self.path
 
+    def flow(self):
+        source = self.sources['main']
+        if not (source.is_chunked or source.is_streaming):
+            super().flow()
+            return
+
+        with pemi.tracing.span('load', self):
+            self.load(self.encode_chunks())
+
     @staticmethod
     def _build_csv_opts(user_csv_opts):
         mandatory_opts = {}
@@ -0,0 +1,280 @@
+'''
+Pipes that read micro-batches of records from append-only logs.
+'''
+
+import os
+import glob
+import json
+import time
+
+import pandas as pd
+
+import pemi
+import pemi.files
+import pemi.tracing
+
+
+class LogBroker:
+    '''
+    Interface to an append-only log of records split into partitions.  Each partition
+    is read sequentially from an offset, which is stored by the consumer once records
+    have been processed.  Implement this interface to read from a message broker.
+    '''
+
+    def partitions(self):
+        'Returns the names of the partitions of the log'
+        raise NotImplementedError
+
+    def read(self, partition, offset, max_records):
+        '''
+        Reads up to ``max_records`` records from ``partition``, starting at ``offset``.
+
+        Returns:
+            tuple: The list of records (as dictionaries) and the offset following the
+            last record read.
+        '''
+        raise NotImplementedError
+
+
+class LocalLogBroker(LogBroker):
+    '''
+    A log broker backed by a local directory of append-only JSON lines files.  Each file
+    is a partition, and offsets are byte positions within the file.  Lines that have not
+    been completely written yet are left for the next read.  Lines that are not JSON
+    objects are logged and skipped.
+
+    Args:
+        path (str): Directory containing the log files.  Created if it does not exist.
+        pattern (str): Glob pattern matching the log files in the directory.
+
+    Example:
+        Appending records to a local log::
+
+            broker = LocalLogBroker('logs/events')
+            broker.append('events-0.jsonl', [{'id': 1, 'name': 'one'}])
+    '''
+
+    def __init__(self, path, pattern='*.jsonl'):
+        self.path = path
+        self.pattern = pattern
+        os.makedirs(self.path, exist_ok=True)
+
+    def partitions(self):
+        return sorted(
+            os.path.basename(path) for path in glob.glob(os.path.join(self.path, self.pattern))
+        )
+
+    def read(self, partition, offset, max_records):
+        records = []
+        with open(os.path.join(self.path, partition), 'rb') as log_file:
+            log_file.seek(offset)
+            while len(records) < max_records:
+                line = log_file.readline()
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                if line.strip():
+                    record = self._decode(line)
+                    if record is None:
+                        pemi.log.warning('Skipping malformed record in %s before offset %d',
+                                         partition, offset)
+                    else:
+                        records.append(record)
+        return records, offset
+
+    @staticmethod
+    def _decode(line):
+        try:
+            record = json.loads(line.decode('utf-8'))
+        except ValueError:
+            return None
+        return record if isinstance(record, dict) else None
+
+    def append(self, partition, records):
+        'Appends records (dictionaries) to a partition of the log'
+        with open(os.path.join(self.path, partition), 'a', encoding='utf-8') as log_file:
+            for record in records:
+                log_file.write(json.dumps(record) + '\n')
+
+
+class OffsetStore(pemi.files.JsonStore):
+    '''
+    Persists the committed offsets of log consumers in a local JSON file.
+
+    Args:
+        path (str): Path to the JSON file used to store the offsets.
+    '''
+
+    def get(self, key, default=None):
+        'Returns the committed offsets of each partition for ``key``'
+        return super().get(key, {} if default is None else default)
+
+
+class LogSourcePipe(pemi.Pipe): #pylint: disable=too-many-instance-attributes
+    '''
+    Reads a micro-batch of records from an append-only log each time it flows.  A batch
+    ends once ``max_records`` records have been read or ``max_wait`` seconds have passed,
+    whichever comes first.  Records are coerced according to the schema; records that
+    cannot be coerced are redirected to the ``errors`` target.
+
+    Batches start from the committed offsets, which only move forward when
+    ``commit_offsets`` is called (see ``run_micro_batches``).  If a batch fails
+    downstream, the next flow reads the same records again.
+
+    Args:
+        broker (LogBroker): The log to read records from.
+        offset_store (OffsetStore): Store used to persist committed offsets.
+        schema (pemi.Schema): Schema used to coerce the records.
+        offset_key (str): Key used to identify this consumer in the offset store
+          (defaults to the name of the pipe).
+        max_records (int): Maximum number of records in a batch.
+        max_wait (float): Number of seconds to wait for records to arrive before ending
+          a batch that has fewer than ``max_records`` records.
+        poll_interval (float): Number of seconds to wait between reads of the log.
+
+    Attributes:
+        batch_size (int): Number of records read in the last batch.
+        pending_offsets (dict): Offsets following the last batch, committed by
+          ``commit_offsets``.
+    '''
+
+    def __init__(self, *, broker, offset_store, schema=None, #pylint: disable=too-many-arguments
+                 offset_key=None, max_records=10000, max_wait=0, poll_interval=0.5, **params):
+        super().__init__(**params)
+
+        self.broker = broker
+        self.offset_store = offset_store
+        self.schema = schema
+        self.offset_key = offset_key
+        self.max_records = max_records
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+
+        self.batch_size = 0
+        self.pending_offsets = None
+
+        self.target(
+            pemi.PdDataSubject,
+            name='main',
+            schema=self.schema
+        )
+
+        self.target(
+            pemi.PdDataSubject,
+            name='errors',
+            schema=self.schema
+        )
+
+    @property
+    def committed_offsets(self):
+        'The offsets of each partition committed to the offset store'
+        return self.offset_store.get(self.offset_key or self.name)
+
+    def extract(self):
+        offsets = dict(self.committed_offsets)
+        records = []
+        deadline = time.monotonic() + self.max_wait
+
+        while True:
+            for partition in self.broker.partitions():
+                if len(records) >= self.max_records:
+                    break
+                batch, offsets[partition] = self.broker.read(
+                    partition, offsets.get(partition, 0), self.max_records - len(records)
+                )
+                records.extend(batch)
+
+            if len(records) >= self.max_records or time.monotonic() >= deadline:
+                break
+            time.sleep(self.poll_interval)
+
+        pemi.log.info("Read a batch of %d records for '%s'", len(records), self.name)
+        self.pending_offsets = offsets
+        return records
+
+    def parse(self, data):
+        self.batch_size = len(data)
+        raw_df = pd.DataFrame.from_records(data)
+
+        if self.schema:
+            for name in self.schema.keys():
+                if name not in raw_df:
+                    raw_df[name] = None
+            mapper = raw_df.mapping(
+                [(name, name, field.coerce) for name, field in self.schema.items()],
+                on_error='redirect'
+            )
+            self.targets['main'].df = mapper.mapped
+            self.targets['errors'].df = mapper.errors
+        else:
+            self.targets['main'].df = raw_df
+
+        return self.targets['main'].df
+
+    def commit_offsets(self):
+        '''
+        Persists the offsets following the last batch to the offset store.  This should be
+        called once downstream pipes have successfully processed the batch.
+        '''
+        if self.pending_offsets is None:
+            return
+
+        pemi.log.info("Committing offsets for '%s': %s", self.name, self.pending_offsets)
+        self.offset_store.set(self.offset_key or self.name, self.pending_offsets)
+        self.pending_offsets = None
+
+    def flow(self):
+        self.pending_offsets = None
+        with pemi.tracing.span('extract', self):
+            data = self.extract()
+        with pemi.tracing.span('parse', self):
+            self.parse(data)
+
+
+def log_sources(pipe):
+    'Returns all of the ``LogSourcePipe`` objects nested in ``pipe``'
+    sources = [pipe] if isinstance(pipe, LogSourcePipe) else []
+    for name, nested in pipe.pipes.items():
+        if name != 'self':
+            sources.extend(log_sources(nested))
+    return sources
+
+def commit_offsets(pipe):
+    '''
+    Commits the pending offsets of all ``LogSourcePipe`` pipes nested in ``pipe``.  Meant
+    to be called after a job has successfully flowed.
+    '''
+    for source in log_sources(pipe):
+        source.commit_offsets()
+
+def run_micro_batches(job, max_batches=None, stop_when_idle=False, **flow_opts):
+    '''
+    Flows a job once per micro-batch, committing the offsets of its log sources after each
+    successful flow.  The same job object is flowed each time, so its compiled execution
+    plan, caches and any other state it holds stay warm between batches.
+
+    Args:
+        job (pemi.Pipe): The job to flow.
+        max_batches (int): Stop after this many batches (default: run until stopped).
+        stop_when_idle (bool): Stop once a batch is empty for all of the log sources.
+        flow_opts: Keyword arguments passed to ``job.flow``.
+
+    Returns:
+        int: The number of batches flowed.
+
+    Example:
+        Processing everything currently in the log::
+
+            job = MyJob()
+            pemi.pipes.log.run_micro_batches(job, stop_when_idle=True)
+    '''
+    sources = log_sources(job)
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        job.flow(**flow_opts)
+        commit_offsets(job)
+        batches += 1
+
+        if stop_when_idle and all(source.batch_size == 0 for source in sources):
+            break
+    return batches
@@ -1,4 +1,8 @@
+import inspect
+
 import pemi
+import pemi.execution
+import pemi.tracing
 
 class SourcePipe(pemi.Pipe):
     '''
@@ -33,7 +37,27 @@ class SourcePipe(pemi.Pipe):
         raise NotImplementedError
 
     def flow(self):
-        self.parse(self.extract())
+        with pemi.tracing.span('extract', self):
+            data = self.extract()
+            if inspect.isawaitable(data):
+                data = pemi.execution.run_coroutine(data)
+        with pemi.tracing.span('parse', self):
+            self.parse(data)
+
+    def is_async(self):
+        return super().is_async() or inspect.iscoroutinefunction(self.extract)
+
+    async def flow_async(self):
+        'Awaits ``extract`` when it is defined as a coroutine function (``async def extract``)'
+        if inspect.iscoroutinefunction(self.flow):
+            return await self.flow()
+
+        with pemi.tracing.span('extract', self):
+            data = self.extract()
+            if inspect.isawaitable(data):
+                data = await data
+        with pemi.tracing.span('parse', self):
+            return self.parse(data)
 
 
 class TargetPipe(pemi.Pipe):
@@ -74,7 +98,28 @@ class TargetPipe(pemi.Pipe):
         raise NotImplementedError
 
     def flow(self):
-        self.load(self.encode())
+        with pemi.tracing.span('encode', self):
+            encoded_data = self.encode()
+        with pemi.tracing.span('load', self):
+            result = self.load(encoded_data)
+            if inspect.isawaitable(result):
+                pemi.execution.run_coroutine(result)
+
+    def is_async(self):
+        return super().is_async() or inspect.iscoroutinefunction(self.load)
+
+    async def flow_async(self):
+        'Awaits ``load`` when it is defined as a coroutine function (``async def load``)'
+        if inspect.iscoroutinefunction(self.flow):
+            return await self.flow()
+
+        with pemi.tracing.span('encode', self):
+            encoded_data = self.encode()
+        with pemi.tracing.span('load', self):
+            result = self.load(encoded_data)
+            if inspect.isawaitable(result):
+                result = await result
+        return result
 
 
 class ForkPipe(pemi.Pipe):
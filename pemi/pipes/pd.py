@@ -1,13 +1,24 @@
 import pandas as pd
 
 import pemi
+import pemi.cache
+import pemi.metrics
 import pemi.pipes.patterns
 import pemi.transforms
 
 class PdForkPipe(pemi.pipes.patterns.ForkPipe):
     def flow(self):
+        if self.sources['main'].is_chunked:
+            for target in self.targets.values():
+                target.from_chunks(self.sources['main'].map_chunks(pd.DataFrame.copy))
+            return
+
+        for chunk in self.sources['main'].iter_chunks():
+            for target in self.targets.values():
+                target.put_chunk(chunk.copy())
+
         for target in self.targets.values():
-            target.df = self.sources['main'].df.copy()
+            target.end_chunks()
 
 
 class PdConcatPipe(pemi.pipes.patterns.ConcatPipe):
@@ -17,7 +28,23 @@ class PdConcatPipe(pemi.pipes.patterns.ConcatPipe):
         self.concat_opts = concat_opts
 
 
+    def _flow_chunks(self):
+        chunk_sources = [
+            source.map_chunks(lambda chunk: chunk) for source in self.sources.values()
+            if source.is_chunked or source.df is not None
+        ]
+
+        def chained():
+            for chunks in chunk_sources:
+                yield from chunks()
+        self.targets['main'].from_chunks(chained)
+
     def flow(self):
+        chunked = any(source.is_chunked for source in self.sources.values())
+        if chunked and not self.concat_opts:
+            self._flow_chunks()
+            return
+
         source_dfs = [source.df for source in self.sources.values() if source.df is not None]
         if len(source_dfs) == 0:
             self.targets['main'].df = pd.DataFrame()
@@ -103,6 +130,13 @@ class PdLookupJoinPipe(pemi.Pipe):
 
     def _direct_targets(self, merged_df):
         matches = (merged_df['__indicator__'] == 'both')
+        matched = int(matches.sum())
+        pemi.metrics.counter('pemi_lookup_matched_total', 'Rows with a lookup match').inc(
+            matched, pipe=self.name
+        )
+        pemi.metrics.counter('pemi_lookup_missed_total', 'Rows without a lookup match').inc(
+            len(matches) - matched, pipe=self.name
+        )
         if self.on_missing == 'redirect':
             self.targets['main'].df = merged_df[matches].copy()
             self.targets['errors'].df = merged_df[~matches].copy()
@@ -174,22 +208,29 @@ class PdFieldValueForkPipe(pemi.Pipe):
             name='remainder'
         )
 
-    def flow(self):
-        grouped = self.sources['main'].df.groupby(self.field)
+    def _fork_chunk(self, chunk):
+        grouped = chunk.groupby(self.field)
 
         for fork in self.forks:
             if fork in grouped.groups:
-                self.targets[fork].df = grouped.get_group(fork).copy()
+                self.targets[fork].put_chunk(grouped.get_group(fork).copy())
             else:
-                self.targets[fork].df = pd.DataFrame(columns=self.sources['main'].df.columns)
+                self.targets[fork].put_chunk(pd.DataFrame(columns=chunk.columns))
 
         remainder = set(grouped.groups.keys()) - set(self.forks)
         if len(remainder) > 0:
-            self.targets['remainder'].df = pd.concat(
+            self.targets['remainder'].put_chunk(pd.concat(
                 [grouped.get_group(r) for r in remainder]
-            ).sort_index()
+            ).sort_index())
         else:
-            self.targets['remainder'].df = pd.DataFrame(columns=self.sources['main'].df.columns)
+            self.targets['remainder'].put_chunk(pd.DataFrame(columns=chunk.columns))
+
+    def flow(self):
+        for chunk in self.sources['main'].iter_chunks():
+            self._fork_chunk(chunk)
+
+        for target in self.targets.values():
+            target.end_chunks()
 
 class PdLambdaPipe(pemi.Pipe):
     '''
@@ -199,7 +240,20 @@ class PdLambdaPipe(pemi.Pipe):
 
     Args:
       fun (function): A function that accepts a dataframe as argument (source) and returns
-        a dataframe (target).
+        a dataframe (target).  When the source is chunked (see ``pemi.PdChunkedDataSubject``)
+        or streamed (see ``PipeConnection.stream``), the function is called once for each
+        chunk, so it should only use the rows it is given.  Chunked sources produce a
+        chunked target, and the function is only called as the target's chunks are read.
+      row_cache (pemi.cache.RowCache): If provided, the results of ``fun`` are memoized row
+        by row.  Each row is keyed by the values of ``cache_columns``; ``fun`` is only called
+        with the rows whose results are not found in the cache, and the cached values of
+        ``cache_outputs`` are merged back into the other rows.  ``fun`` must then be a
+        row-wise function of ``cache_columns`` that adds or replaces the ``cache_outputs``
+        columns and leaves all other columns unchanged.
+      cache_columns (list): Names of the input columns ``fun`` depends on.
+      cache_outputs (list): Names of the columns ``fun`` produces.
+      cache_version (str): Included in the cache keys, so that results computed by an older
+        version of ``fun`` are not reused (defaults to the qualified name of ``fun``).
 
     :Data Sources:
       **main** (*pemi.PdDataSubject*) - The source dataframe that gets pass to ``fun``.
@@ -209,10 +263,18 @@ class PdLambdaPipe(pemi.Pipe):
         the return value of ``fun``.
 
     '''
-    def __init__(self, fun):
+    def __init__(self, fun, row_cache=None, cache_columns=None, cache_outputs=None,
+                 cache_version=None):
         super().__init__()
 
         self.fun = fun
+        self.row_cache = row_cache
+        self.cache_columns = cache_columns
+        self.cache_outputs = cache_outputs
+        self.cache_version = cache_version
+
+        if row_cache is not None and not (cache_columns and cache_outputs):
+            raise ValueError('A row_cache requires cache_columns and cache_outputs')
 
         self.source(
             pemi.PdDataSubject,
@@ -224,5 +286,50 @@ class PdLambdaPipe(pemi.Pipe):
             name='main'
         )
 
+    def _apply_cached(self, df):
+        # Keys and outputs are aligned by position, since the index may have duplicates
+        namespace = self.cache_version or '{}.{}'.format(
+            getattr(self.fun, '__module__', ''), getattr(self.fun, '__qualname__', '')
+        )
+        keys = pemi.cache.row_keys(df, self.cache_columns, namespace)
+        values = self.row_cache.get_many(set(keys))
+
+        hits = 0
+        missed = {}
+        for position, key in enumerate(keys):
+            if key in values:
+                hits += 1
+            else:
+                missed.setdefault(key, position)
+        pemi.log.debug('Row cache: %d hits and %d misses (%d distinct)',
+                       hits, len(keys) - hits, len(missed))
+
+        if len(missed) > 0:
+            computed = self.fun(df.iloc[list(missed.values())])[self.cache_outputs]
+            if len(computed) != len(missed):
+                raise ValueError('A row_cache requires fun to return one row for each row')
+            computed = dict(zip(missed.keys(), computed.itertuples(index=False, name=None)))
+            self.row_cache.put_many(computed)
+            values.update(computed)
+
+        merged = pd.DataFrame.from_records(
+            [values[key] for key in keys], index=df.index, columns=self.cache_outputs
+        )
+        result = df.copy()
+        for col in self.cache_outputs:
+            result[col] = merged[col].values
+        return result
+
+    def _apply(self, df):
+        if self.row_cache is None or len(df) == 0:
+            return self.fun(df)
+        return self._apply_cached(df)
+
     def flow(self):
-        self.targets['main'].df = self.fun(self.sources['main'].df)
+        if self.sources['main'].is_chunked:
+            self.targets['main'].from_chunks(self.sources['main'].map_chunks(self._apply))
+            return
+
+        for chunk in self.sources['main'].iter_chunks():
+            self.targets['main'].put_chunk(self._apply(chunk))
+        self.targets['main'].end_chunks()
@@ -1,9 +1,113 @@
+import re
+import decimal
+import datetime
+
+import dateutil.parser
 import pandas as pd
+import sqlalchemy as sa
 
 import pemi
+import pemi.cache
+import pemi.files
+import pemi.tracing
+import pemi.metrics
+
+class WatermarkStore(pemi.files.JsonStore):
+    '''
+    A watermark store persists the high-watermark values of incremental extracts in a
+    local JSON file, so that subsequent runs only need to request new or changed records.
+
+    Args:
+        path (str): Path to the JSON file used to store the watermarks.
+
+    Example:
+        Reading and writing watermarks::
+
+            store = WatermarkStore('watermarks.json')
+            store.set('sales', datetime.datetime(2020, 1, 1))
+            store.get('sales') #=> datetime.datetime(2020, 1, 1, 0, 0)
+    '''
+
+    ENCODERS = {
+        datetime.datetime: ('datetime', lambda v: v.isoformat()),
+        datetime.date: ('date', lambda v: v.isoformat()),
+        decimal.Decimal: ('decimal', str),
+        int: ('int', int),
+        float: ('float', float),
+        str: ('str', str),
+    }
+
+    DECODERS = {
+        'datetime': dateutil.parser.isoparse,
+        'date': lambda v: dateutil.parser.isoparse(v).date(),
+        'decimal': decimal.Decimal,
+        'int': int,
+        'float': float,
+        'str': str,
+    }
+
+    def get(self, key, default=None):
+        'Returns the last committed watermark for ``key``'
+        stored = super().get(key)
+        if stored is None:
+            return default
+        return self.DECODERS[stored['type']](stored['value'])
+
+    def set(self, key, value):
+        'Commits ``value`` as the watermark for ``key``'
+        if hasattr(value, 'to_pydatetime'):
+            value = value.to_pydatetime()
+        if hasattr(value, 'item'):
+            value = value.item()
+
+        for value_type in type(value).__mro__:
+            if value_type in self.ENCODERS:
+                type_name, encode = self.ENCODERS[value_type]
+                break
+        else:
+            raise TypeError('Unable to store watermark of type {}'.format(type(value)))
+
+        super().set(key, {'type': type_name, 'value': encode(value)})
+
+
+class SaSqlSourcePipe(pemi.Pipe): #pylint: disable=too-many-instance-attributes
+    '''
+    Extracts data from a database using SqlAlchemy.
 
-class SaSqlSourcePipe(pemi.Pipe):
-    def __init__(self, *, sql, engine, schema=None, result=True, chunk_size=None):
+    Args:
+        sql (str): The SQL statement to execute.
+        engine (sqlalchemy.engine.Engine): The engine used to connect to the database.
+        schema (pemi.Schema): Schema used to coerce the results.
+        result (bool): Whether the SQL statement returns a result set.
+        chunk_size (int): If provided, results are fetched in chunks of this size.
+        stream (bool): If true (and results are not cached), the statement is not executed
+          when the pipe flows: the ``main`` target becomes chunked (see
+          ``pemi.PdChunkedDataSubject``) and each chunk of ``chunk_size`` records is fetched
+          and coerced as it is consumed.  Note that the statement is executed again each
+          time the chunks are iterated, so a streamed target should only have one consumer.
+        watermark (str): Name of a column that increases monotonically as records are
+          added or changed (e.g., an ``updated_at`` timestamp or an auto-incrementing id).
+          When provided, only records with a value greater than the last committed
+          watermark are extracted.  The SQL statement may reference the last committed
+          watermark with the ``:watermark`` bind parameter (in which case a
+          ``watermark_start`` is required for the first run); otherwise, the statement is
+          wrapped in a subquery that filters on the watermark column.
+        watermark_store (WatermarkStore): Store used to persist committed watermarks.
+        watermark_key (str): Key used to identify this extract in the watermark store
+          (defaults to the name of the pipe).
+        watermark_start: Value of the watermark to use when none has been committed yet.
+        cache (pemi.cache.LocalFileCache): If provided, query results are cached locally,
+          keyed by the normalized SQL, bound parameters, engine URL and schema.  Use
+          ``cache.invalidate()`` to force results to be re-queried.
+
+    Incremental extracts only move the watermark forward when ``commit_watermark`` is
+    called, which should happen after the downstream pipes have successfully processed
+    the extracted data (see ``commit_watermarks``).
+    '''
+
+    def __init__(self, *, sql, engine, schema=None, #pylint: disable=too-many-arguments
+                 result=True, chunk_size=None, stream=False, watermark=None,
+                 watermark_store=None, watermark_key=None, watermark_start=None, cache=None):
         super().__init__()
 
         self.sql = sql
@@ -11,6 +115,19 @@ class SaSqlSourcePipe(pemi.Pipe):
         self.schema = schema
         self.result = result
         self.chunk_size = chunk_size
+        self.stream = stream
+
+        self.watermark = watermark
+        self.watermark_store = watermark_store
+        self.watermark_key = watermark_key
+        self.watermark_start = watermark_start
+        self.pending_watermark = None
+        self.cache = cache
+
+        if self.watermark and self.watermark_store is None:
+            raise ValueError('A watermark_store is required for incremental extracts')
+        if self.stream and self.chunk_size is None:
+            raise ValueError('A chunk_size is required to stream results')
 
         self.target(
             pemi.PdDataSubject,
@@ -19,19 +136,80 @@ class SaSqlSourcePipe(pemi.Pipe):
         )
 
 
+    @property
+    def last_watermark(self):
+        'The last watermark value committed to the watermark store'
+        return self.watermark_store.get(
+            self.watermark_key or self.name,
+            default=self.watermark_start
+        )
+
+    def _watermarked_query(self):
+        last_watermark = self.last_watermark
+        if ':watermark' in self.sql:
+            if last_watermark is None:
+                raise ValueError(
+                    "No watermark has been committed for '{}', so a watermark_start is "
+                    "required to bind :watermark".format(self.watermark_key or self.name)
+                )
+            return sa.text(self.sql), {'watermark': last_watermark}
+
+        if last_watermark is None:
+            return sa.text(self.sql), {}
+
+        sql = re.sub(r'[\s;]*$', '', self.sql)
+        wrapped_sql = 'SELECT * FROM ({sql}) pemi_watermark_src ' \
+            'WHERE {column} > :watermark'.format(sql=sql, column=self.watermark)
+        return sa.text(wrapped_sql), {'watermark': last_watermark}
+
+    def _query(self):
+        if self.watermark:
+            return self._watermarked_query()
+        return self.sql, None
+
     def _get_result(self, conn):
+        sql, params = self._query()
+
         sql_df = pd.DataFrame()
         if self.chunk_size is None:
-            sql_df = pd.read_sql(self.sql, conn)
+            sql_df = pd.read_sql(sql, conn, params=params)
         else:
-            for chunk in pd.read_sql(self.sql, conn, chunksize=self.chunk_size):
+            for chunk in pd.read_sql(sql, conn, params=params, chunksize=self.chunk_size):
                 sql_df = sql_df.append(chunk, ignore_index=True)
+        self._count_rows(sql_df)
         return sql_df
 
 
+    def cache_key(self):
+        'The key used to store the results of the query in the cache'
+        sql, params = self._query()
+        return pemi.cache.fingerprint(
+            ' '.join(str(sql).split()).rstrip(';'),
+            params,
+            str(self.engine.url),
+            pemi.cache.schema_fingerprint(self.schema)
+        )
+
+    def _get_cached_result(self):
+        key = self.cache_key()
+        data = self.cache.get(key)
+        if data is None:
+            with self.engine.connect() as conn:
+                data = self._get_result(conn)
+            self.cache.put(key, data)
+            pemi.log.info("SQL cache miss for '%s' (hits: %d, misses: %d)",
+                          self.name, self.cache.hits, self.cache.misses)
+        else:
+            pemi.log.info("SQL cache hit for '%s' (hits: %d, misses: %d)",
+                          self.name, self.cache.hits, self.cache.misses)
+        return data
+
     def extract(self):
         pemi.log.info("Executing SQL '%s' via:\n%s", self.name, self.sql)
 
+        if self.result and self.cache is not None:
+            return self._get_cached_result()
+
         data = None
         with self.engine.connect() as conn:
             if self.result:
@@ -41,22 +219,94 @@ class SaSqlSourcePipe(pemi.Pipe):
 
         return data
 
+    def extract_chunks(self):
+        'Executes the SQL statement and yields coerced chunks of ``chunk_size`` records'
+        pemi.log.info("Executing SQL '%s' in chunks via:\n%s", self.name, self.sql)
+
+        sql, params = self._query()
+        pending_watermark = None
+        with self.engine.connect() as conn:
+            for chunk in pd.read_sql(sql, conn, params=params, chunksize=self.chunk_size):
+                pending_watermark = self._track_watermark(chunk, pending_watermark)
+                self._count_rows(chunk)
+                yield self._coerce(chunk)
+
+    def _count_rows(self, data):
+        pemi.metrics.counter('pemi_sql_rows_fetched_total', 'Rows fetched by SQL queries').inc(
+            len(data), pipe=self.name
+        )
+
+    def _coerce(self, data):
+        if self.schema is None:
+            return data
+
+        mapper = data.mapping(
+            [(name, name, field.coerce) for name, field in self.schema.items()],
+            on_error='raise'
+        )
+        return mapper.mapped
+
     def parse(self, data):
         pemi.log.info("Parsing '%s' results", self.name)
 
         if data is None:
             return None
 
-        if self.schema is None:
-            self.targets['main'].df = data
-        else:
-            mapper = data.mapping(
-                [(name, name, field.coerce) for name, field in self.schema.items()],
-                on_error='raise'
-            )
-            self.targets['main'].df = mapper.mapped
-
+        self._track_watermark(data)
+        self.targets['main'].df = self._coerce(data)
         return self.targets['main'].df
 
+    def _track_watermark(self, df, pending_watermark=None):
+        if not self.watermark or len(df) == 0:
+            return pending_watermark
+
+        watermark = df[self.watermark].max()
+        if pending_watermark is not None:
+            watermark = max(watermark, pending_watermark)
+
+        self.pending_watermark = watermark
+        pemi.log.info("Pending watermark for '%s': %s", self.name, self.pending_watermark)
+        return watermark
+
+    def commit_watermark(self):
+        '''
+        Persists the largest watermark value seen in the last extract to the watermark store.
+        This should be called once downstream pipes have successfully processed the data.
+        '''
+        if not self.watermark or self.pending_watermark is None:
+            return
+
+        pemi.log.info("Committing watermark for '%s': %s", self.name, self.pending_watermark)
+        self.watermark_store.set(self.watermark_key or self.name, self.pending_watermark)
+        self.pending_watermark = None
+
     def flow(self):
-        self.parse(self.extract())
+        if self.stream and self.result and self.cache is None:
+            self.targets['main'].from_chunks(self.extract_chunks)
+            return
+
+        with pemi.tracing.span('extract', self):
+            data = self.extract()
+        with pemi.tracing.span('parse', self):
+            self.parse(data)
+
+
+def commit_watermarks(pipe):
+    '''
+    Commits the pending watermarks of all incremental ``SaSqlSourcePipe`` extracts
+    nested in ``pipe``.  Meant to be called after a job has successfully flowed.
+
+    Example:
+        Committing watermarks after a job completes::
+
+            job = MyJob()
+            job.flow()
+            pemi.pipes.sa.commit_watermarks(job)
+    '''
+    for name, nested in pipe.pipes.items():
+        if name == 'self':
+            continue
+        commit_watermarks(nested)
+
+    if isinstance(pipe, SaSqlSourcePipe):
+        pipe.commit_watermark()
@@ -0,0 +1,17 @@
+import pemi
+import pemi.pipes.patterns
+
+class SparkForkPipe(pemi.pipes.patterns.ForkPipe):
+    '''
+    Delivers the Spark dataframe of the main source to each of the fork targets.  The targets
+    reference the same lazy dataframe, so when flowed via ``PipeConnections.flow``, the source
+    is persisted until all of the pipes consuming the forks have flowed.
+    '''
+
+    def __init__(self, *, forks=None, **params):
+        super().__init__(subject_class=pemi.SparkDataSubject, forks=forks, **params)
+
+    def flow(self):
+        for target in self.targets.values():
+            target.spark = self.sources['main'].spark
+            target.df = self.sources['main'].df
@@ -0,0 +1,240 @@
+'''
+Timeline tracing of pipe execution.
+
+When a ``Tracer`` is active (see ``set_tracer``), spans are recorded for each pipe that
+flows, each connection that is made, and the extract/parse steps of source pipes and
+encode/load steps of target pipes.  Spans record the process and thread they ran in, so
+nested pipes appear as nested spans of the thread that flowed them.  Recorded spans can be
+exported as Chrome trace-event JSON (see ``Tracer.write``), which can be opened with a
+trace viewer such as ``chrome://tracing`` or Perfetto.
+
+While no tracer is active, ``span`` returns a shared no-op context manager, so tracing can
+be left in place at very little cost.
+'''
+
+import os
+import time
+import threading
+import contextlib
+from collections import deque
+
+import pemi.files
+
+_TRACER = None
+_NO_SPAN = contextlib.nullcontext()
+
+def set_tracer(tracer):
+    '''
+    Activates a tracer for all pipes flowed from now on.  Pass ``None`` to deactivate
+    tracing.
+
+    Returns:
+        Tracer: The previously active tracer.
+    '''
+    global _TRACER #pylint: disable=global-statement
+    previous = _TRACER
+    _TRACER = tracer
+    return previous
+
+def get_tracer():
+    'Returns the active tracer (or ``None``)'
+    return _TRACER
+
+def span(name, pipe=None, category='pemi', **args):
+    '''
+    Returns a context manager that records a span with the active tracer, or a no-op
+    context manager if tracing is not active.
+
+    Args:
+        name (str): Name of the span (e.g., ``'extract'``).
+        pipe (pemi.Pipe): If provided, the pipe the span belongs to, which is recorded in
+          the arguments of the span.
+        category (str): Category of the span.
+        args: Additional arguments recorded with the span.
+    '''
+    tracer = _TRACER
+    if tracer is None:
+        return _NO_SPAN
+    if pipe is not None:
+        args['pipe'] = pipe_label(pipe)
+    return tracer.span(name, category, args)
+
+def flow_span(pipe):
+    'Returns a context manager that records a span for a pipe flowing'
+    tracer = _TRACER
+    if tracer is None:
+        return _NO_SPAN
+    label = pipe_label(pipe)
+    return tracer.span(label, 'flow', {'pipe': label})
+
+def connect_span(conn):
+    'Returns a context manager that records a span for a connection being made'
+    tracer = _TRACER
+    if tracer is None:
+        return _NO_SPAN
+    return tracer.span(str(conn), 'connect', {'streaming': conn.streaming})
+
+@contextlib.contextmanager
+def trace_run(trace):
+    '''
+    Context manager that activates a tracer while a job runs.
+
+    Args:
+        trace: Either a ``Tracer``, which is activated, or the path of a file to which the
+          spans recorded while the job runs are written (even if the job fails).  If
+          ``None``, the currently active tracer (if any) is left in place.
+    '''
+    if trace is None or trace is _TRACER:
+        yield _TRACER
+        return
+
+    tracer = trace if isinstance(trace, Tracer) else Tracer()
+    previous = set_tracer(tracer)
+    try:
+        yield tracer
+    finally:
+        set_tracer(previous)
+        if tracer is not trace:
+            tracer.write(trace)
+
+def pipe_label(pipe):
+    'A short label identifying a pipe in traces (e.g., ``"LocalCsvFileSourcePipe(sales)"``)'
+    return '{}({})'.format(pipe.__class__.__name__, pipe.name)
+
+
+class _Span:
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.record(self.name, self.category, self.start, time.perf_counter_ns(),
+                           self.args)
+
+
+class Tracer:
+    '''
+    Records spans of pipe execution and exports them as Chrome trace-event JSON.
+
+    Spans are held in memory in a bounded buffer, so a tracer can be left active in a
+    long-running process; once ``max_events`` spans have been recorded, the oldest spans
+    are dropped.
+
+    Args:
+        max_events (int): Maximum number of spans to keep (default: unbounded).
+
+    Attributes:
+        events (collections.deque): The recorded spans, as trace-event dictionaries.
+        dropped (int): Number of spans dropped from the buffer.
+
+    Example:
+        Tracing a job and writing the trace to a file::
+
+            with pemi.tracing.Tracer() as tracer:
+                job.flow()
+            tracer.write('job-trace.json')
+    '''
+
+    def __init__(self, max_events=None):
+        self.max_events = max_events
+        self.events = deque(maxlen=max_events)
+        self.dropped = 0
+        self.thread_names = {}
+        self.origin = time.perf_counter_ns()
+        self._previous = None
+
+    def __enter__(self):
+        self._previous = set_tracer(self)
+        return self
+
+    def __exit__(self, *exc):
+        set_tracer(self._previous)
+        self._previous = None
+
+    def span(self, name, category='pemi', args=None):
+        'Returns a context manager that records a span with this tracer'
+        return _Span(self, name, category, args or {})
+
+    def record(self, name, category, start, end, args=None):
+        '''
+        Records a complete span.
+
+        Args:
+            start (int): Start of the span, from ``time.perf_counter_ns``.
+            end (int): End of the span, from ``time.perf_counter_ns``.
+        '''
+        pid = os.getpid()
+        tid = threading.get_native_id()
+        if (pid, tid) not in self.thread_names:
+            self.thread_names[(pid, tid)] = threading.current_thread().name
+
+        if self.max_events is not None and len(self.events) == self.max_events:
+            self.dropped += 1
+        self.events.append({
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': (start - self.origin) / 1000,
+            'dur': (end - start) / 1000,
+            'pid': pid,
+            'tid': tid,
+            'args': args or {},
+        })
+
+    def fork(self):
+        '''
+        Returns an empty tracer with the same time origin as this one.  Used to collect the
+        spans recorded in worker processes, which are merged back with ``merge``.
+        '''
+        forked = Tracer(max_events=self.max_events)
+        forked.origin = self.origin
+        return forked
+
+    def dump(self):
+        'Returns the recorded spans and the names of their threads as a picklable tuple'
+        return list(self.events), dict(self.thread_names)
+
+    def merge(self, dumped):
+        'Adds spans returned by ``dump`` (e.g., of a forked tracer)'
+        events, thread_names = dumped
+        for event in events:
+            if self.max_events is not None and len(self.events) == self.max_events:
+                self.dropped += 1
+            self.events.append(event)
+        self.thread_names.update(thread_names)
+
+    def to_chrome_trace(self):
+        'Returns the recorded spans as a Chrome trace-event JSON object'
+        metadata = [
+            {
+                'name': 'thread_name',
+                'ph': 'M',
+                'pid': pid,
+                'tid': tid,
+                'args': {'name': name},
+            }
+            for (pid, tid), name in sorted(self.thread_names.items())
+        ]
+        return {
+            'traceEvents': metadata + list(self.events),
+            'displayTimeUnit': 'ms',
+            'otherData': {'dropped_events': self.dropped},
+        }
+
+    def write(self, path):
+        'Writes the recorded spans to a Chrome trace-event JSON file'
+        return pemi.files.write_json(path, self.to_chrome_trace())
+
+    def reset(self):
+        'Discards all of the recorded spans'
+        self.events.clear()
+        self.dropped = 0
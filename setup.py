@@ -100,6 +100,8 @@ setup(
     extras_require={
         'dev': [],
         'test': ['pytest'],
+        'parquet': ['pyarrow'],
+        'distributed': ['distributed'],
     },
 
     # If there are data files included in your packages that need to be
@@ -1 +1,26 @@
+import pytest
+import sqlalchemy as sa
+
+import pemi.cache
+
 pytest_plugins = ['pemi.pytest']
+
+@pytest.fixture
+def sqlite_engine(tmpdir):
+    engine = sa.create_engine('sqlite:///{}'.format(tmpdir.join('events.db')))
+    with engine.connect() as conn:
+        conn.execute('CREATE TABLE events (id INT, name VARCHAR(80))')
+        conn.execute("INSERT INTO events VALUES (1, 'one'), (2, 'two')")
+    return engine
+
+@pytest.fixture
+def file_cache(tmpdir):
+    return pemi.cache.LocalFileCache(str(tmpdir.join('cache')))
+
+@pytest.fixture
+def flow_main():
+    def flow(pipe, df):
+        pipe.sources['main'].df = df
+        pipe.flow()
+        return pipe.targets['main'].df
+    return flow
@@ -0,0 +1,155 @@
+import time
+import threading
+
+import pytest
+
+import pemi
+import pemi.pipes.pd
+import pemi.pipes.log
+from pemi.fields import *
+
+class TestLocalLogBroker:
+    @pytest.fixture
+    def broker(self, tmpdir):
+        return pemi.pipes.log.LocalLogBroker(str(tmpdir.join('log')))
+
+    def test_it_reads_from_an_offset(self, broker):
+        broker.append('p0.jsonl', [{'id': 1}, {'id': 2}, {'id': 3}])
+
+        records, offset = broker.read('p0.jsonl', 0, 2)
+        assert records == [{'id': 1}, {'id': 2}]
+
+        records, _ = broker.read('p0.jsonl', offset, 10)
+        assert records == [{'id': 3}]
+
+    def test_it_leaves_partial_lines(self, broker):
+        broker.append('p0.jsonl', [{'id': 1}])
+        with open(broker.path + '/p0.jsonl', 'a', encoding='utf-8') as log_file:
+            log_file.write('{"id": ')
+
+        records, offset = broker.read('p0.jsonl', 0, 10)
+        assert records == [{'id': 1}]
+        assert broker.read('p0.jsonl', offset, 10) == ([], offset)
+
+    def test_it_skips_malformed_lines(self, broker):
+        broker.append('p0.jsonl', [{'id': 1}])
+        with open(broker.path + '/p0.jsonl', 'a', encoding='utf-8') as log_file:
+            log_file.write('{"id": oops}\n3\n')
+        broker.append('p0.jsonl', [{'id': 2}])
+
+        records, offset = broker.read('p0.jsonl', 0, 10)
+        assert records == [{'id': 1}, {'id': 2}]
+        assert broker.read('p0.jsonl', offset, 10) == ([], offset)
+
+
+class TestLogSourcePipe:
+    @pytest.fixture
+    def broker(self, tmpdir):
+        broker = pemi.pipes.log.LocalLogBroker(str(tmpdir.join('log')))
+        broker.append('p0.jsonl', [{'id': '1', 'name': 'one'}, {'id': 'x', 'name': 'bad'}])
+        broker.append('p1.jsonl', [{'id': '3', 'name': 'three'}])
+        return broker
+
+    @pytest.fixture
+    def store(self, tmpdir):
+        return pemi.pipes.log.OffsetStore(str(tmpdir.join('offsets.json')))
+
+    @staticmethod
+    def build_pipe(broker, store, **kwargs):
+        return pemi.pipes.log.LogSourcePipe(
+            name='events',
+            broker=broker,
+            offset_store=store,
+            schema=pemi.Schema(id=IntegerField(), name=StringField()),
+            **kwargs
+        )
+
+    def test_it_coerces_records(self, broker, store):
+        pipe = self.build_pipe(broker, store)
+        pipe.flow()
+
+        assert list(pipe.targets['main'].df['id']) == [1, 3]
+        assert list(pipe.targets['errors'].df['name']) == ['bad']
+
+    def test_it_limits_the_batch_size(self, broker, store):
+        pipe = self.build_pipe(broker, store, max_records=2)
+        pipe.flow()
+        assert pipe.batch_size == 2
+
+        pipe.commit_offsets()
+        pipe.flow()
+        assert list(pipe.targets['main'].df['name']) == ['three']
+
+    def test_it_rereads_uncommitted_batches(self, broker, store):
+        pipe = self.build_pipe(broker, store)
+        pipe.flow()
+        pipe.flow()
+        assert pipe.batch_size == 3
+
+        pipe.commit_offsets()
+        pipe.flow()
+        assert pipe.batch_size == 0
+        assert list(pipe.targets['main'].df.columns) == ['id', 'name']
+
+    def test_it_waits_for_records(self, broker, store):
+        pipe = self.build_pipe(broker, store, max_records=4, max_wait=5, poll_interval=0.05)
+        threading.Timer(0.2, broker.append, ['p1.jsonl', [{'id': '4', 'name': 'four'}]]).start()
+
+        start = time.time()
+        pipe.flow()
+        assert pipe.batch_size == 4
+        assert time.time() - start < 5
+
+    def test_it_ends_batches_after_max_wait(self, broker, store):
+        pipe = self.build_pipe(broker, store, max_records=10, max_wait=0.2, poll_interval=0.05)
+
+        start = time.time()
+        pipe.flow()
+        assert pipe.batch_size == 3
+        assert time.time() - start >= 0.2
+
+
+class TestRunMicroBatches:
+    class CountingJob(pemi.Pipe):
+        def __init__(self, broker, store, **kwargs):
+            super().__init__(**kwargs)
+            self.totals = []
+
+            self.pipe(
+                name='events',
+                pipe=pemi.pipes.log.LogSourcePipe(
+                    broker=broker,
+                    offset_store=store,
+                    schema=pemi.Schema(id=IntegerField()),
+                    max_records=2
+                )
+            )
+            self.pipe(name='total', pipe=pemi.pipes.pd.PdLambdaPipe(self.total))
+            self.connect('events', 'main').to('total', 'main')
+
+        def total(self, df):
+            self.totals.append(int(df['id'].sum()))
+            return df
+
+    def test_it_flows_each_batch_and_commits_offsets(self, tmpdir):
+        broker = pemi.pipes.log.LocalLogBroker(str(tmpdir.join('log')))
+        broker.append('p0.jsonl', [{'id': idx} for idx in range(1, 6)])
+        store = pemi.pipes.log.OffsetStore(str(tmpdir.join('offsets.json')))
+
+        job = self.CountingJob(broker, store)
+        plan = job.connections.plan()
+        batches = pemi.pipes.log.run_micro_batches(job, stop_when_idle=True)
+
+        assert batches == 4
+        assert job.totals == [3, 7, 5, 0]
+        assert job.connections.plan() is plan
+        assert store.get('events') == {'p0.jsonl': broker.read('p0.jsonl', 0, 10)[1]}
+
+    def test_it_stops_after_max_batches(self, tmpdir):
+        broker = pemi.pipes.log.LocalLogBroker(str(tmpdir.join('log')))
+        broker.append('p0.jsonl', [{'id': idx} for idx in range(1, 6)])
+        store = pemi.pipes.log.OffsetStore(str(tmpdir.join('offsets.json')))
+
+        job = self.CountingJob(broker, store)
+        assert pemi.pipes.log.run_micro_batches(job, max_batches=2) == 2
+        assert job.totals == [3, 7]
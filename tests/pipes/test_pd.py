@@ -7,6 +7,8 @@ import pemi
 import pemi.data
 import pemi.testing as pt
 import pemi.pipes.pd
+import pemi.pipes.csv
+import pemi.cache
 from pemi.fields import *
 
 class KeyFactory(factory.Factory):
@@ -628,3 +630,181 @@ class TestPdLambdaPipe: #pylint: disable=too-few-public-methods
             'newname': [1, 2, 3],
         })
         pt.assert_frame_equal(pipe.targets['main'].df, expected_df)
+
+
+class TestChunkedPipes:
+    @pytest.fixture
+    def reads(self):
+        return []
+
+    @pytest.fixture
+    def chunks(self, reads):
+        def read():
+            for idx in range(3):
+                reads.append(idx)
+                yield pd.DataFrame({'n': [2 * idx, 2 * idx + 1]}, index=[2 * idx, 2 * idx + 1])
+        return read
+
+    def test_lambda_pipe_maps_each_chunk_lazily(self, chunks, reads):
+        sizes = []
+
+        def add_one(df):
+            sizes.append(len(df))
+            return df.assign(n=df['n'] + 1)
+
+        pipe = pemi.pipes.pd.PdLambdaPipe(add_one)
+        pipe.sources['main'].from_chunks(chunks)
+        pipe.flow()
+
+        assert pipe.targets['main'].is_chunked
+        assert reads == []
+
+        assert list(pipe.targets['main'].df['n']) == [1, 2, 3, 4, 5, 6]
+        assert sizes == [2, 2, 2]
+
+    def test_fork_pipe_forks_chunks(self, chunks):
+        pipe = pemi.pipes.pd.PdForkPipe(forks=['a', 'b'])
+        pipe.sources['main'].from_chunks(chunks)
+        pipe.flow()
+
+        for fork in ['a', 'b']:
+            assert pipe.targets[fork].is_chunked
+            assert len(list(pipe.targets[fork].iter_chunks())) == 3
+            assert list(pipe.targets[fork].df['n']) == list(range(6))
+
+    def test_concat_pipe_chains_chunks(self, chunks):
+        pipe = pemi.pipes.pd.PdConcatPipe(sources=['s1', 's2'])
+        pipe.sources['s1'].from_chunks(chunks)
+        pipe.sources['s2'].df = pd.DataFrame({'n': [10]})
+        pipe.flow()
+
+        assert len(list(pipe.targets['main'].iter_chunks())) == 4
+        assert list(pipe.targets['main'].df['n']) == [0, 1, 2, 3, 4, 5, 10]
+
+
+class TestLocalCsvFileChunks:
+    @pytest.fixture
+    def csv_path(self, tmpdir):
+        path = str(tmpdir.join('numbers.csv'))
+        pd.DataFrame({'n': range(5), 'word': list('abcde')}).to_csv(path, index=False)
+        return path
+
+    def test_source_reads_chunks(self, csv_path):
+        pipe = pemi.pipes.csv.LocalCsvFileSourcePipe(
+            paths=[csv_path],
+            schema=pemi.Schema(n=IntegerField()),
+            chunk_size=2
+        )
+        pipe.flow()
+
+        assert pipe.targets['main'].is_chunked
+        chunks = list(pipe.targets['main'].iter_chunks())
+        assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+        assert list(pipe.targets['main'].df['n']) == [0, 1, 2, 3, 4]
+
+    def test_source_reads_each_file_once_for_main_and_errors(self, csv_path, monkeypatch):
+        reads = []
+        read_csv = pd.read_csv
+        def counting_read_csv(path, **kwargs):
+            reads.append(path)
+            return read_csv(path, **kwargs)
+        monkeypatch.setattr(pemi.pipes.csv.pd, 'read_csv', counting_read_csv)
+
+        pipe = pemi.pipes.csv.LocalCsvFileSourcePipe(
+            paths=[csv_path],
+            schema=pemi.Schema(n=IntegerField(), word=IntegerField()),
+            chunk_size=2
+        )
+        pipe.flow()
+
+        assert [len(chunk) for chunk in pipe.targets['main'].iter_chunks()] == [0, 0, 0]
+        assert [len(chunk) for chunk in pipe.targets['errors'].iter_chunks()] == [2, 2, 1]
+        assert reads == [csv_path]
+
+    def test_target_encodes_a_dataframe(self, csv_path, tmpdir):
+        target = pemi.pipes.csv.LocalCsvFileTargetPipe(
+            schema=None, path=str(tmpdir.join('copy.csv'))
+        )
+        target.sources['main'].df = pd.read_csv(csv_path)
+
+        pt.assert_frame_equal(target.encode(), pd.read_csv(csv_path))
+
+    def test_target_writes_chunks(self, csv_path, tmpdir):
+        path = str(tmpdir.join('copy.csv'))
+        target = pemi.pipes.csv.LocalCsvFileTargetPipe(schema=None, path=path)
+        target.sources['main'].from_chunks(lambda: pd.read_csv(csv_path, chunksize=2))
+        target.flow()
+
+        pt.assert_frame_equal(pd.read_csv(path), pd.read_csv(csv_path))
+
+
+class TestPdLambdaPipeRowCache:
+    @pytest.fixture
+    def calls(self):
+        return []
+
+    @pytest.fixture
+    def normalize(self, calls):
+        def normalize(df):
+            calls.append(list(df['address']))
+            return df.assign(normalized=df['address'].str.upper().str.strip())
+        return normalize
+
+    @staticmethod
+    def build_pipe(normalize, row_cache):
+        return pemi.pipes.pd.PdLambdaPipe(
+            normalize,
+            row_cache=row_cache,
+            cache_columns=['address'],
+            cache_outputs=['normalized'],
+            cache_version='v1'
+        )
+
+    @staticmethod
+    def addresses(values):
+        return pd.DataFrame({'id': range(len(values)), 'address': values})
+
+    def test_it_only_computes_misses(self, normalize, calls, flow_main, tmpdir):
+        row_cache = pemi.cache.RowCache(str(tmpdir.join('rows.db')))
+        flow_main(self.build_pipe(normalize, row_cache), self.addresses(['a st', 'b st']))
+        result = flow_main(
+            self.build_pipe(normalize, row_cache),
+            self.addresses(['b st', 'c st ', 'a st', 'c st '])
+        )
+
+        assert calls == [['a st', 'b st'], ['c st ']]
+        pt.assert_frame_equal(result, pd.DataFrame({
+            'id': range(4),
+            'address': ['b st', 'c st ', 'a st', 'c st '],
+            'normalized': ['B ST', 'C ST', 'A ST', 'C ST']
+        }))
+        assert row_cache.stats['hits'] == 2
+
+    def test_it_aligns_rows_with_duplicate_index_labels(self, flow_main, tmpdir):
+        row_cache = pemi.cache.RowCache(str(tmpdir.join('rows.db')))
+        pipe = pemi.pipes.pd.PdLambdaPipe(
+            lambda df: df.assign(y=df['x'] * 10),
+            row_cache=row_cache,
+            cache_columns=['x'],
+            cache_outputs=['y'],
+            cache_version='v1'
+        )
+        source_df = pd.concat([pd.DataFrame({'x': [1, 2]}), pd.DataFrame({'x': [3, 2]})])
+        result = flow_main(pipe, source_df)
+
+        pt.assert_frame_equal(result, source_df.assign(y=[10, 20, 30, 20]))
+        keys = pemi.cache.row_keys(pd.DataFrame({'x': [2, 3]}), ['x'], 'v1')
+        assert row_cache.get_many(keys) == {keys[0]: (20,), keys[1]: (30,)}
+
+    def test_it_evicts_least_recently_used_rows(self, normalize, flow_main, tmpdir):
+        row_cache = pemi.cache.RowCache(str(tmpdir.join('rows.db')), max_rows=2)
+        flow_main(self.build_pipe(normalize, row_cache), self.addresses(['a st', 'b st', 'c st']))
+
+        assert row_cache.stats['rows'] == 2
+        assert row_cache.evictions == 1
+
+    def test_it_requires_columns(self, normalize, tmpdir):
+        with pytest.raises(ValueError):
+            pemi.pipes.pd.PdLambdaPipe(
+                normalize, row_cache=pemi.cache.RowCache(str(tmpdir.join('rows.db')))
+            )
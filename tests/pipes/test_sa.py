@@ -1,4 +1,6 @@
 import os
+import decimal
+import datetime
 
 import pytest
 import factory
@@ -8,6 +10,7 @@ import sqlalchemy as sa
 import pemi
 import pemi.testing as pt
 import pemi.pipes.sa
+import pemi.cache
 from pemi.fields import *
 
 sa_engine = sa.create_engine('postgresql://{user}:{password}@{host}/{dbname}'.format(
@@ -136,3 +139,163 @@ with pt.Scenario(
         ).then(
             pt.then.target_matches_example(scenario.targets['main'], ex_sales)
         )
+
+
+def build_source_pipe(engine, sql='SELECT * FROM events', **params):
+    return pemi.pipes.sa.SaSqlSourcePipe(
+        engine=engine,
+        schema=pemi.Schema(
+            id=IntegerField(),
+            name=StringField()
+        ),
+        sql=sql,
+        **params
+    )
+
+
+class TestSaSqlSourcePipeWatermark:
+    @pytest.fixture
+    def store(self, tmpdir):
+        return pemi.pipes.sa.WatermarkStore(str(tmpdir.join('watermarks.json')))
+
+    @staticmethod
+    def build_pipe(engine, store, sql='SELECT * FROM events;'):
+        return build_source_pipe(
+            engine, sql, watermark='id', watermark_store=store, watermark_key='events'
+        )
+
+    def test_it_extracts_everything_on_the_first_run(self, sqlite_engine, store):
+        pipe = self.build_pipe(sqlite_engine, store)
+        pipe.flow()
+        assert list(pipe.targets['main'].df['id']) == [1, 2]
+
+    def test_it_only_extracts_records_after_the_committed_watermark(self, sqlite_engine, store):
+        pipe = self.build_pipe(sqlite_engine, store)
+        pipe.flow()
+        pipe.commit_watermark()
+
+        with sqlite_engine.connect() as conn:
+            conn.execute("INSERT INTO events VALUES (3, 'three')")
+
+        pipe = self.build_pipe(sqlite_engine, store)
+        pipe.flow()
+        assert list(pipe.targets['main'].df['id']) == [3]
+
+    def test_it_does_not_move_the_watermark_until_committed(self, sqlite_engine, store):
+        pipe = self.build_pipe(sqlite_engine, store)
+        pipe.flow()
+        assert store.get('events') is None
+
+        pipe.flow()
+        assert list(pipe.targets['main'].df['id']) == [1, 2]
+
+    def test_it_binds_the_watermark_parameter(self, sqlite_engine, store):
+        store.set('events', 1)
+        pipe = self.build_pipe(
+            sqlite_engine, store, sql='SELECT * FROM events WHERE id > :watermark'
+        )
+        pipe.flow()
+        assert list(pipe.targets['main'].df['id']) == [2]
+
+    def test_it_requires_a_start_to_bind_the_watermark_on_the_first_run(self, sqlite_engine,
+                                                                         store):
+        pipe = self.build_pipe(
+            sqlite_engine, store, sql='SELECT * FROM events WHERE id > :watermark'
+        )
+        with pytest.raises(ValueError):
+            pipe.flow()
+
+        pipe.watermark_start = 0
+        pipe.flow()
+        assert list(pipe.targets['main'].df['id']) == [1, 2]
+
+    def test_it_commits_watermarks_of_nested_pipes(self, sqlite_engine, store):
+        job = pemi.Pipe()
+        job.pipe(name='events', pipe=self.build_pipe(sqlite_engine, store))
+        job.pipes['events'].flow()
+
+        pemi.pipes.sa.commit_watermarks(job)
+        assert store.get('events') == 2
+
+
+class TestSaSqlSourcePipeChunks:
+    def test_it_reads_all_chunks_when_it_flows(self, sqlite_engine):
+        pipe = build_source_pipe(sqlite_engine, chunk_size=1)
+        pipe.flow()
+        assert not pipe.targets['main'].is_chunked
+        assert list(pipe.targets['main'].df['id']) == [1, 2]
+
+        with sqlite_engine.connect() as conn:
+            conn.execute('DELETE FROM events')
+        assert list(pipe.targets['main'].df['id']) == [1, 2]
+
+    def test_it_fetches_chunks_as_they_are_consumed(self, sqlite_engine, tmpdir):
+        with sqlite_engine.connect() as conn:
+            conn.execute("INSERT INTO events VALUES (3, 'three')")
+
+        pipe = build_source_pipe(
+            sqlite_engine,
+            chunk_size=2,
+            stream=True,
+            watermark='id',
+            watermark_store=pemi.pipes.sa.WatermarkStore(str(tmpdir.join('watermarks.json')))
+        )
+        pipe.flow()
+        assert pipe.targets['main'].is_chunked
+        assert pipe.pending_watermark is None
+
+        chunks = list(pipe.targets['main'].iter_chunks())
+        assert [list(chunk['id']) for chunk in chunks] == [[1, 2], [3]]
+        assert pipe.pending_watermark == 3
+
+
+class TestWatermarkStore:
+    @pytest.mark.parametrize('value', [
+        3,
+        1.5,
+        'abc',
+        decimal.Decimal('3.14'),
+        datetime.date(2020, 1, 2),
+        datetime.datetime(2020, 1, 2, 3, 4, 5, 6),
+    ])
+    def test_it_round_trips_values(self, value, tmpdir):
+        store = pemi.pipes.sa.WatermarkStore(str(tmpdir.join('watermarks.json')))
+        store.set('key', value)
+        assert store.get('key') == value
+
+
+class TestSaSqlSourcePipeCache:
+    def test_it_serves_repeated_queries_from_the_cache(self, sqlite_engine, file_cache):
+        build_source_pipe(sqlite_engine, cache=file_cache).flow()
+
+        with sqlite_engine.connect() as conn:
+            conn.execute("INSERT INTO events VALUES (3, 'three')")
+
+        pipe = build_source_pipe(sqlite_engine, 'SELECT *\n  FROM events;', cache=file_cache)
+        pipe.flow()
+
+        assert list(pipe.targets['main'].df['id']) == [1, 2]
+        assert (file_cache.hits, file_cache.misses) == (1, 1)
+
+    def test_it_requeries_after_invalidation(self, sqlite_engine, file_cache):
+        build_source_pipe(sqlite_engine, cache=file_cache).flow()
+
+        with sqlite_engine.connect() as conn:
+            conn.execute("INSERT INTO events VALUES (3, 'three')")
+        file_cache.invalidate()
+
+        pipe = build_source_pipe(sqlite_engine, cache=file_cache)
+        pipe.flow()
+        assert list(pipe.targets['main'].df['id']) == [1, 2, 3]
+
+    def test_it_does_not_share_results_across_schemas(self, sqlite_engine, file_cache):
+        build_source_pipe(sqlite_engine, cache=file_cache).flow()
+
+        pipe = pemi.pipes.sa.SaSqlSourcePipe(
+            engine=sqlite_engine,
+            schema=pemi.Schema(id=IntegerField()),
+            sql='SELECT * FROM events',
+            cache=file_cache
+        )
+        pipe.flow()
+        assert file_cache.misses == 2
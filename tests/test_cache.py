@@ -0,0 +1,215 @@
+import os
+import time
+import multiprocessing
+import decimal
+import datetime
+
+import pytest
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+import pemi
+import pemi.cache
+
+class TestLocalFileCache:
+    @pytest.fixture
+    def df(self):
+        return pd.DataFrame({
+            'id': [1, 2, 3],
+            'name': ['one', 'two', 'three'],
+            'amount': [decimal.Decimal('1.10'), decimal.Decimal('2.20'), None],
+            'created': [datetime.date(2020, 1, 1), datetime.date(2020, 1, 2), None]
+        })
+
+    def test_it_returns_cached_frames(self, df, tmpdir):
+        cache = pemi.cache.LocalFileCache(str(tmpdir))
+        cache.put('key', df)
+        assert_frame_equal(cache.get('key'), df)
+
+    def test_it_counts_hits_and_misses(self, df, tmpdir):
+        cache = pemi.cache.LocalFileCache(str(tmpdir))
+        assert cache.get('key') is None
+        cache.put('key', df)
+        cache.get('key')
+        cache.get('key')
+        assert (cache.hits, cache.misses) == (2, 1)
+
+    def test_it_falls_back_to_pickle_for_complex_values(self, tmpdir):
+        df = pd.DataFrame({'json': [{'a': 1}, {'b': [1, 2]}]})
+        cache = pemi.cache.LocalFileCache(str(tmpdir))
+        cache.put('key', df)
+        assert_frame_equal(cache.get('key'), df)
+
+    def test_it_caches_other_values(self, tmpdir):
+        cache = pemi.cache.LocalFileCache(str(tmpdir))
+        cache.put('key', {'a': [1, 2, 3]})
+        assert cache.get('key') == {'a': [1, 2, 3]}
+
+    def test_it_expires_entries(self, df, tmpdir):
+        cache = pemi.cache.LocalFileCache(str(tmpdir), ttl=0.01)
+        cache.put('key', df)
+        time.sleep(0.02)
+        assert cache.get('key') is None
+        assert cache.stats['entries'] == 0
+
+    def test_it_evicts_least_recently_used_entries(self, df, tmpdir):
+        cache = pemi.cache.LocalFileCache(str(tmpdir))
+        cache.put('a', df)
+        entry_bytes = cache.stats['bytes']
+
+        cache = pemi.cache.LocalFileCache(str(tmpdir), max_bytes=int(entry_bytes * 2.5))
+        cache.put('b', df)
+        cache.get('a')
+        cache.put('c', df)
+
+        assert 'a' in cache
+        assert 'b' not in cache
+        assert 'c' in cache
+        assert cache.evictions == 1
+
+    def test_hits_do_not_rewrite_the_index(self, df, tmpdir):
+        cache = pemi.cache.LocalFileCache(str(tmpdir))
+        cache.put('a', df)
+        index_path = os.path.join(str(tmpdir), cache.INDEX_FILE)
+        index_mtime = os.stat(index_path).st_mtime_ns
+
+        time.sleep(0.01)
+        cache.get('a')
+        assert os.stat(index_path).st_mtime_ns == index_mtime
+
+    def test_processes_do_not_lose_entries(self, tmpdir):
+        def put_all(prefix):
+            cache = pemi.cache.LocalFileCache(str(tmpdir))
+            for idx in range(20):
+                cache.put('{}{}'.format(prefix, idx), idx)
+
+        context = multiprocessing.get_context('fork')
+        processes = [context.Process(target=put_all, args=(prefix,)) for prefix in 'abc']
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        assert pemi.cache.LocalFileCache(str(tmpdir)).stats['entries'] == 60
+
+    def test_it_invalidates_entries(self, df, tmpdir):
+        cache = pemi.cache.LocalFileCache(str(tmpdir))
+        cache.put('a', df)
+        cache.put('b', df)
+
+        cache.invalidate('a')
+        assert 'a' not in cache
+        assert 'b' in cache
+
+        cache.invalidate()
+        assert cache.stats['entries'] == 0
+
+
+class TestDumpFrame:
+    @pytest.mark.parametrize('values', [
+        [datetime.datetime(2020, 1, 1, 5, 30), None],
+        [decimal.Decimal('1.50'), decimal.Decimal('2.125'), None],
+        [1, 2, None],
+        [1.5, None],
+    ])
+    def test_it_round_trips_object_columns(self, values, tmpdir):
+        df = pd.DataFrame({'value': pd.Series(values, dtype=object)})
+        path = str(tmpdir.join('frame'))
+        loaded = pemi.cache.load_frame(path, pemi.cache.dump_frame(df, path))
+
+        assert_frame_equal(loaded, df)
+        assert [repr(value) for value in loaded['value']] == [repr(value) for value in values]
+
+    @pytest.mark.parametrize('values', [
+        ['one', None],
+        [datetime.date(2020, 1, 1), None],
+    ])
+    def test_it_writes_parquet_when_it_round_trips(self, values, tmpdir):
+        df = pd.DataFrame({'value': pd.Series(values, dtype=object)})
+        assert pemi.cache.dump_frame(df, str(tmpdir.join('frame'))) == 'parquet'
+
+
+class TestFingerprint:
+    def test_it_does_not_depend_on_dict_order(self):
+        assert pemi.cache.fingerprint({'a': 1, 'b': 2}) == pemi.cache.fingerprint({'b': 2, 'a': 1})
+
+    def test_it_depends_on_values(self):
+        assert pemi.cache.fingerprint('a', 1) != pemi.cache.fingerprint('a', 2)
+
+
+class TestFrameFingerprint:
+    def test_it_depends_on_values(self):
+        df = pd.DataFrame({'id': [1, 2], 'name': ['one', 'two']})
+        assert pemi.cache.frame_fingerprint(df) == pemi.cache.frame_fingerprint(df.copy())
+        assert pemi.cache.frame_fingerprint(df) != pemi.cache.frame_fingerprint(
+            df.assign(name=['one', 'TWO'])
+        )
+
+    def test_it_depends_on_dtypes(self):
+        df = pd.DataFrame({'id': [1, 2]})
+        assert pemi.cache.frame_fingerprint(df) != pemi.cache.frame_fingerprint(
+            df.astype('float64')
+        )
+
+    def test_it_fingerprints_unhashable_values(self):
+        df = pd.DataFrame({'tags': [['a'], ['b', 'c']]})
+        assert pemi.cache.frame_fingerprint(df) != pemi.cache.frame_fingerprint(
+            pd.DataFrame({'tags': [['a'], ['b']]})
+        )
+
+
+class TestRowKeys:
+    def test_it_keys_rows_by_their_values(self):
+        df = pd.DataFrame({'id': [1, 1, 2], 'name': ['one', 'one', 'one'], 'other': [1, 2, 3]})
+        keys = pemi.cache.row_keys(df, ['id', 'name'], 'v1')
+
+        assert keys[0] == keys[1]
+        assert keys[0] != keys[2]
+        assert keys[0] == "v1:(1, 'one')"
+
+    def test_it_distinguishes_types(self):
+        df = pd.DataFrame({'key': [1, '1', None, float('nan')]}, dtype=object)
+        assert len(set(pemi.cache.row_keys(df, ['key']))) == 4
+
+
+class TestMemoizeFlow:
+    @pytest.fixture
+    def pipe_class(self, file_cache):
+        @pemi.cache.memoize_flow(file_cache, version='1')
+        class DoublePipe(pemi.Pipe):
+            flows = 0
+
+            def __init__(self, **params):
+                super().__init__(**params)
+                self.source(pemi.PdDataSubject, name='main')
+                self.target(pemi.PdDataSubject, name='main')
+
+            def flow(self):
+                DoublePipe.flows += 1
+                factor = self.params.get('factor', 2)
+                self.targets['main'].df = self.sources['main'].df * factor
+
+        return DoublePipe
+
+    def test_it_restores_targets_on_hits(self, pipe_class, flow_main, file_cache):
+        flow_main(pipe_class(), pd.DataFrame({'n': [1, 2]}))
+        result = flow_main(pipe_class(), pd.DataFrame({'n': [1, 2]}))
+
+        assert pipe_class.flows == 1
+        assert list(result['n']) == [2, 4]
+        assert file_cache.stats['hits'] == 1
+        assert file_cache.stats['misses'] == 1
+
+    def test_it_flows_when_sources_change(self, pipe_class, flow_main):
+        flow_main(pipe_class(), pd.DataFrame({'n': [1, 2]}))
+        result = flow_main(pipe_class(), pd.DataFrame({'n': [1, 3]}))
+
+        assert pipe_class.flows == 2
+        assert list(result['n']) == [2, 6]
+
+    def test_it_flows_when_params_change(self, pipe_class, flow_main):
+        flow_main(pipe_class(), pd.DataFrame({'n': [1, 2]}))
+        result = flow_main(pipe_class(factor=3), pd.DataFrame({'n': [1, 2]}))
+
+        assert pipe_class.flows == 2
+        assert list(result['n']) == [3, 6]
@@ -4,7 +4,7 @@ import pytest
 
 import sqlalchemy as sa
 import pandas as pd
-from pandas.testing import assert_frame_equal
+from pandas.testing import assert_frame_equal, assert_series_equal
 
 import pemi
 from pemi.fields import *
@@ -133,3 +133,86 @@ class TestSaDataSubject:
 
         df = sa_subject.to_pd()
         assert sorted(df.columns) == sorted(['afield', 'bfield', 'json_field'])
+
+
+class TestCoerceSeries:
+    def test_it_coerces_each_value(self):
+        series = pd.Series(['1', ' 2', '1', '3'])
+        coerced = pemi.data_subject.coerce_series(series, IntegerField())
+        assert list(coerced) == [1, 2, 1, 3]
+
+    def test_it_matches_element_wise_coercion(self):
+        series = pd.Series(['01/02/2017', '01/03/2017', '01/02/2017', ''])
+        field = DateField(format='%m/%d/%Y')
+        assert_series_equal(
+            pemi.data_subject.coerce_series(series, field),
+            series.apply(field.coerce)
+        )
+
+    def test_it_coerces_unhashable_values(self):
+        series = pd.Series([{'a': 1}, {'a': 1}])
+        assert list(pemi.data_subject.coerce_series(series, JsonField())) == [{'a': 1}, {'a': 1}]
+
+
+class TestPdDataSubjectRelease:
+    def test_it_reports_freed_bytes(self):
+        subject = pemi.PdDataSubject(df=pd.DataFrame({'n': range(1000)}))
+        assert subject.release() >= 8000
+        assert len(subject.df) == 0
+
+    def test_it_does_not_report_shared_frames(self):
+        df = pd.DataFrame({'n': range(1000)})
+        subject = pemi.PdDataSubject(df=df)
+        assert subject.release() == 0
+
+
+class TestPdChunkedDataSubject:
+    @staticmethod
+    def chunks():
+        return [pd.DataFrame({'n': [1, 2]}), pd.DataFrame({'n': [3]}, index=[2])]
+
+    def test_it_iterates_chunks(self):
+        subject = pemi.PdChunkedDataSubject(chunks=self.chunks())
+        assert [list(chunk['n']) for chunk in subject.iter_chunks()] == [[1, 2], [3]]
+        assert [list(chunk['n']) for chunk in subject.iter_chunks()] == [[1, 2], [3]]
+
+    def test_it_reads_chunks_lazily(self):
+        calls = []
+
+        def chunks():
+            calls.append(True)
+            yield from self.chunks()
+
+        subject = pemi.PdChunkedDataSubject(chunks=chunks)
+        assert calls == []
+        assert subject.is_chunked
+
+        assert list(subject.to_pd()['n']) == [1, 2, 3]
+        assert calls == [True]
+        assert not subject.is_chunked
+
+    def test_it_validates_each_chunk(self):
+        subject = pemi.PdChunkedDataSubject(
+            chunks=[pd.DataFrame({'n': [1]}), pd.DataFrame({'m': [2]})],
+            schema=pemi.Schema(n=IntegerField())
+        )
+
+        chunks = subject.iter_chunks()
+        next(chunks)
+        with pytest.raises(pemi.data_subject.MissingFieldsError):
+            next(chunks)
+
+    def test_connected_subjects_stay_chunked(self):
+        subject = pemi.PdChunkedDataSubject(chunks=self.chunks())
+        connected = pemi.PdDataSubject()
+        connected.connect_from(subject)
+
+        assert connected.is_chunked
+        assert list(connected.df['n']) == [1, 2, 3]
+
+    def test_setting_df_replaces_the_chunks(self):
+        subject = pemi.PdChunkedDataSubject(chunks=self.chunks())
+        subject.df = pd.DataFrame({'n': [9]})
+
+        assert not subject.is_chunked
+        assert [list(chunk['n']) for chunk in subject.iter_chunks()] == [[9]]
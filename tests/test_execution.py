@@ -0,0 +1,878 @@
+import time
+import threading
+import asyncio
+
+import pytest
+import pandas as pd
+
+from pandas.testing import assert_frame_equal
+
+import pemi
+import pemi.connections
+import pemi.execution
+import pemi.executors
+import pemi.hooks
+import pemi.checkpoint
+import pemi.pipes.pd
+import pemi.pipes.csv
+import pemi.pipes.patterns
+from pemi.execution import DagValidationError
+
+class NumberSourcePipe(pemi.Pipe):
+    def __init__(self, *, value, delay=0, **kwargs):
+        super().__init__(**kwargs)
+        self.value = value
+        self.delay = delay
+
+        self.target(
+            pemi.PdDataSubject,
+            name='main'
+        )
+
+    def flow(self):
+        time.sleep(self.delay)
+        self.targets['main'].df = pd.DataFrame({'n': [self.value]})
+
+class AddOnePipe(pemi.Pipe):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        self.source(
+            pemi.PdDataSubject,
+            name='main'
+        )
+
+        self.target(
+            pemi.PdDataSubject,
+            name='main'
+        )
+
+    def flow(self):
+        self.targets['main'].df = self.sources['main'].df.assign(
+            n=self.sources['main'].df['n'] + 1
+        )
+
+class FailingPipe(AddOnePipe):
+    def flow(self):
+        raise ValueError('This pipe fails')
+
+
+class DiamondJob(pemi.Pipe):
+    '''
+    s1 -> a1 -\
+               concat -> a3
+    s2 -> a2 -/
+    '''
+
+    def __init__(self, delay=0, **kwargs):
+        super().__init__(**kwargs)
+
+        self.pipe(name='s1', pipe=NumberSourcePipe(value=1, delay=delay))
+        self.pipe(name='s2', pipe=NumberSourcePipe(value=10, delay=delay))
+        self.pipe(name='a1', pipe=AddOnePipe())
+        self.pipe(name='a2', pipe=AddOnePipe())
+        self.pipe(name='concat', pipe=pemi.pipes.pd.PdConcatPipe(sources=['a1', 'a2']))
+        self.pipe(name='a3', pipe=AddOnePipe())
+
+        self.connect('s1', 'main').to('a1', 'main')
+        self.connect('s2', 'main').to('a2', 'main')
+        self.connect('a1', 'main').to('concat', 'a1')
+        self.connect('a2', 'main').to('concat', 'a2')
+        self.connect('concat', 'main').to('a3', 'main')
+
+    def flow(self, **kwargs): #pylint: disable=arguments-differ
+        self.connections.flow(**kwargs)
+
+
+class TestExecutionPlan:
+    def test_steps_are_topologically_sorted(self):
+        plan = pemi.execution.ExecutionPlan(DiamondJob().connections.connections)
+        order = [step.name for step in plan.flow_steps]
+
+        assert order.index('s1') < order.index('a1') < order.index('concat')
+        assert order.index('s2') < order.index('a2') < order.index('concat')
+        assert order.index('concat') < order.index('a3')
+
+    def test_it_detects_cycles(self):
+        job = DiamondJob()
+        job.connect('a3', 'main').to('s1', 'main')
+
+        with pytest.raises(DagValidationError) as excinfo:
+            pemi.execution.ExecutionPlan(job.connections.connections)
+        assert "'a3'" in str(excinfo.value)
+        assert "'s1'" in str(excinfo.value)
+
+    def test_plan_is_cached(self):
+        job = DiamondJob()
+        assert job.connections.plan() is job.connections.plan()
+
+    def test_plan_is_recompiled_when_connections_change(self):
+        job = DiamondJob()
+        plan = job.connections.plan()
+        job.pipe(name='t1', pipe=AddOnePipe())
+        job.connect('a3', 'main').to('t1', 'main')
+
+        assert job.connections.plan() is not plan
+        assert 't1' in [step.name for step in job.connections.plan().flow_steps]
+
+    def test_dask_flows_reuse_the_plan(self, monkeypatch):
+        import dask #pylint: disable=import-outside-toplevel
+
+        job = DiamondJob()
+        plan = job.connections.plan()
+        monkeypatch.setattr(pemi.connections, 'SparkPersistPlanner', None)
+        job.flow(dask_get=dask.get)
+
+        assert job.connections.plan() is plan
+
+
+class TestExecutors:
+    @pytest.mark.parametrize('executor', ['serial', 'thread', 'process'])
+    def test_it_flows_all_pipes(self, executor):
+        job = DiamondJob()
+        job.flow(executor=executor, max_workers=2)
+
+        assert_frame_equal(
+            job.pipes['a3'].targets['main'].df.reset_index(drop=True),
+            pd.DataFrame({'n': [3, 12]})
+        )
+
+    def test_it_flows_with_dask(self):
+        import dask #pylint: disable=import-outside-toplevel
+
+        job = DiamondJob()
+        job.flow(dask_get=dask.get)
+
+        assert_frame_equal(
+            job.pipes['a3'].targets['main'].df.reset_index(drop=True),
+            pd.DataFrame({'n': [3, 12]})
+        )
+
+    def test_thread_executor_flows_independent_pipes_concurrently(self):
+        job = DiamondJob(delay=0.5)
+
+        start = time.time()
+        job.flow(executor='thread', max_workers=2)
+        assert time.time() - start < 0.9
+
+    @pytest.mark.parametrize('executor', ['serial', 'thread', 'process'])
+    def test_it_raises_pipe_errors(self, executor):
+        job = DiamondJob()
+        job.pipe(name='a2', pipe=FailingPipe())
+
+        with pytest.raises(ValueError, match='This pipe fails'):
+            job.flow(executor=executor)
+
+    def test_unknown_executor(self):
+        with pytest.raises(ValueError):
+            DiamondJob().flow(executor='bogus')
+
+    def test_unknown_option(self):
+        with pytest.raises(TypeError):
+            DiamondJob().flow(executor='thread', max_worker=2)
+
+
+class TestSharedMemory:
+    @pytest.fixture
+    def pipe(self):
+        pipe = AddOnePipe()
+        pipe.sources['main'].df = pd.DataFrame({
+            'n': range(100000),
+            'f': [0.5] * 100000,
+            's': ['a'] * 100000
+        })
+        return pipe
+
+    def test_it_round_trips_subjects(self, pipe, tmpdir):
+        shared = pemi.executors.share_pipe(pipe, str(tmpdir))
+        loaded = pemi.executors.load_shared_pipe(AddOnePipe(), shared)
+
+        assert_frame_equal(loaded.sources['main'].df, pipe.sources['main'].df)
+
+    def test_column_data_is_not_pickled(self, pipe, tmpdir):
+        shared = pemi.executors.share_pipe(pipe, str(tmpdir))
+        assert shared.nbytes >= 100000 * 16
+        assert len(shared.pickled) < 100000 * 8
+
+    def test_loaded_frames_are_writable(self, pipe, tmpdir):
+        shared = pemi.executors.share_pipe(pipe, str(tmpdir))
+        loaded = pemi.executors.load_shared_pipe(AddOnePipe(), shared)
+
+        loaded.sources['main'].df.loc[0, 'n'] = -1
+        assert loaded.sources['main'].df['n'][0] == -1
+        assert pipe.sources['main'].df['n'][0] == 0
+
+    def test_shared_files_are_removed(self, tmpdir):
+        job = DiamondJob()
+        job.flow(executor=pemi.executors.ProcessExecutor(shared_dir=str(tmpdir)))
+
+        assert tmpdir.listdir() == []
+        assert list(job.pipes['a3'].targets['main'].df['n']) == [3, 12]
+
+    def test_it_flows_without_shared_memory(self):
+        job = DiamondJob()
+        job.flow(executor=pemi.executors.ProcessExecutor(shared_memory=False))
+        assert list(job.pipes['a3'].targets['main'].df['n']) == [3, 12]
+
+
+class AsyncNumberSourcePipe(NumberSourcePipe):
+    async def flow(self):
+        await asyncio.sleep(self.delay)
+        self.targets['main'].df = pd.DataFrame({'n': [self.value]})
+
+class AsyncExtractSourcePipe(pemi.pipes.patterns.SourcePipe):
+    def __init__(self, *, value, **kwargs):
+        super().__init__(schema=pemi.Schema(), **kwargs)
+        self.value = value
+
+    async def extract(self):
+        await asyncio.sleep(0.2)
+        return pd.DataFrame({'n': [self.value]})
+
+    def parse(self, data):
+        self.targets['main'].df = data
+
+class ManySourcesJob(pemi.Pipe):
+    def __init__(self, source_class, nsources=20, **kwargs):
+        super().__init__(**kwargs)
+
+        sources = ['s{}'.format(idx) for idx in range(nsources)]
+        for idx, name in enumerate(sources):
+            if source_class is AsyncExtractSourcePipe:
+                self.pipe(name=name, pipe=source_class(value=idx))
+            else:
+                self.pipe(name=name, pipe=source_class(value=idx, delay=0.2))
+            self.connect(name, 'main').to('concat', name)
+
+        self.pipe(name='concat', pipe=pemi.pipes.pd.PdConcatPipe(sources=sources))
+
+    def flow(self, **kwargs): #pylint: disable=arguments-differ
+        self.connections.flow(**kwargs)
+
+
+class TestAsyncExecutor:
+    def test_it_flows_sync_pipes(self):
+        job = DiamondJob()
+        job.flow(executor='asyncio')
+        assert list(job.pipes['a3'].targets['main'].df['n']) == [3, 12]
+
+    @pytest.mark.parametrize('source_class', [AsyncNumberSourcePipe, AsyncExtractSourcePipe])
+    def test_async_pipes_overlap(self, source_class):
+        job = ManySourcesJob(source_class)
+
+        start = time.time()
+        job.flow(executor='asyncio', max_workers=1)
+        assert time.time() - start < 1
+
+        assert sorted(job.pipes['concat'].targets['main'].df['n']) == list(range(20))
+
+    def test_sync_pipes_are_bounded_by_max_workers(self):
+        job = ManySourcesJob(NumberSourcePipe, nsources=4)
+
+        start = time.time()
+        job.flow(executor='asyncio', max_workers=2)
+        assert time.time() - start > 0.4
+
+    def test_it_limits_concurrency(self):
+        job = ManySourcesJob(AsyncNumberSourcePipe, nsources=4)
+
+        start = time.time()
+        job.flow(executor=pemi.executors.AsyncExecutor(max_concurrency=2))
+        assert time.time() - start > 0.4
+
+    @pytest.mark.parametrize('executor', ['serial', 'thread'])
+    def test_other_executors_flow_async_pipes(self, executor):
+        job = ManySourcesJob(AsyncExtractSourcePipe, nsources=2)
+        job.flow(executor=executor)
+        assert sorted(job.pipes['concat'].targets['main'].df['n']) == [0, 1]
+
+    def test_it_raises_pipe_errors(self):
+        job = DiamondJob()
+        job.pipe(name='a2', pipe=FailingPipe())
+
+        with pytest.raises(ValueError, match='This pipe fails'):
+            job.flow(executor='asyncio')
+
+
+class AddOneTwicePipe(pemi.Pipe):
+    '''
+    Does not define flow, so its connections can be flattened into an enclosing plan.
+    '''
+
+    def __init__(self, delay=0, **kwargs):
+        super().__init__(**kwargs)
+
+        self.source(pemi.PdDataSubject, name='main')
+        self.target(pemi.PdDataSubject, name='main')
+        self.target(pemi.PdDataSubject, name='slow')
+
+        self.pipe(name='a1', pipe=AddOnePipe())
+        self.pipe(name='a2', pipe=AddOnePipe())
+        self.pipe(name='slow', pipe=NumberSourcePipe(value=100, delay=delay))
+
+        self.connect('self', 'main').to('a1', 'main')
+        self.connect('a1', 'main').to('a2', 'main')
+        self.connect('a2', 'main').to('self', 'main')
+        self.connect('slow', 'main').to('self', 'slow')
+
+class NestedJob(pemi.Pipe):
+    def __init__(self, delay=0, **kwargs):
+        super().__init__(**kwargs)
+
+        self.pipe(name='s1', pipe=NumberSourcePipe(value=1))
+        self.pipe(name='twice1', pipe=AddOneTwicePipe(delay=delay))
+        self.pipe(name='twice2', pipe=AddOneTwicePipe(delay=delay))
+        self.pipe(name='a3', pipe=AddOnePipe())
+
+        self.connect('s1', 'main').to('twice1', 'main')
+        self.connect('twice1', 'main').to('twice2', 'main')
+        self.connect('twice2', 'main').to('a3', 'main')
+
+
+class TestFlatten:
+    def test_pipes_without_flow_flow_their_connections(self):
+        job = NestedJob()
+        job.flow()
+        assert list(job.pipes['a3'].targets['main'].df['n']) == [6]
+
+    @pytest.mark.parametrize('executor', ['serial', 'thread', 'asyncio'])
+    def test_it_flows_flattened_plans(self, executor):
+        job = NestedJob()
+        job.connections.flow(flatten=True, executor=executor)
+
+        assert list(job.pipes['a3'].targets['main'].df['n']) == [6]
+        assert list(job.pipes['twice2'].targets['slow'].df['n']) == [100]
+
+    def test_flattened_plans_include_nested_steps(self):
+        job = NestedJob()
+        plan = job.connections.plan(flatten=True)
+
+        assert [step.name for step in plan.flow_steps if step.parent is job] == ['s1', 'a3']
+        assert job.pipes['twice1'] in plan.flattened
+        assert len(plan.flow_steps) == 8
+
+    def test_pipes_with_custom_flow_are_not_flattened(self):
+        plan = DiamondJob().connections.plan(flatten=True)
+        assert plan.flattened == []
+        assert 'concat' in [step.name for step in plan.flow_steps]
+
+    def test_nested_branches_flow_concurrently(self):
+        job = NestedJob(delay=0.5)
+
+        start = time.time()
+        job.connections.flow(flatten=True, executor='thread', max_workers=4)
+        assert time.time() - start < 0.9
+
+
+class TestRelease:
+    @pytest.fixture
+    def job(self):
+        job = DiamondJob()
+        job.pipe(name='t1', pipe=AddOnePipe())
+        job.connect('a3', 'main').to('t1', 'main')
+        return job
+
+    @pytest.mark.parametrize('executor', ['serial', 'thread', 'process', 'asyncio'])
+    def test_it_releases_consumed_subjects(self, job, executor):
+        job.connections.flow(executor=executor, release=True)
+
+        for name in ['s1', 's2', 'a1', 'a2', 'concat', 'a3']:
+            assert len(job.pipes[name].targets['main'].df) == 0
+        assert len(job.pipes['t1'].sources['main'].df) == 0
+
+    def test_unconsumed_targets_are_kept(self, job):
+        job.connections.flow(release=True)
+        assert list(job.pipes['t1'].targets['main'].df['n']) == [4, 13]
+
+    def test_retained_subjects_are_kept(self, job):
+        job.pipes['concat'].targets['main'].retain = True
+        job.connections.flow(release=True)
+
+        assert list(job.pipes['concat'].targets['main'].df['n']) == [2, 11]
+        assert len(job.pipes['a3'].sources['main'].df) == 0
+
+    def test_it_reports_freed_memory(self, job):
+        hook = pemi.hooks.ReleaseHook()
+        job.connections.flow(hooks=[hook], release=False)
+
+        assert hook.freed['a3'] > 0
+        assert hook.freed['s1.main -> a1.main'] == 0
+        assert hook.total_freed == sum(hook.freed.values())
+
+    def test_subjects_are_not_released_by_default(self, job):
+        job.connections.flow()
+        assert list(job.pipes['a3'].targets['main'].df['n']) == [3, 12]
+
+
+
+class RecordingPipe(NumberSourcePipe):
+    def __init__(self, started, **kwargs):
+        super().__init__(**kwargs)
+        self.started = started
+
+    def flow(self):
+        self.started.append(self.value)
+        super().flow()
+
+class UnevenJob(pemi.Pipe):
+    'Two fast independent sources, and one slow source'
+
+    def __init__(self, started, **kwargs):
+        super().__init__(**kwargs)
+
+        delays = {'fast1': 0, 'fast2': 0, 'slow': 0.2}
+        for value, (name, delay) in enumerate(delays.items()):
+            self.pipe(name=name, pipe=RecordingPipe(started, value=value, delay=delay))
+            self.connect(name, 'main').to('concat', name)
+        self.pipe(name='concat', pipe=pemi.pipes.pd.PdConcatPipe(sources=list(delays)))
+
+    def flow(self, **kwargs): #pylint: disable=arguments-differ
+        self.connections.flow(**kwargs)
+
+
+class TestCriticalPath:
+    def test_it_records_durations(self, tmpdir):
+        path = str(tmpdir.join('history.json'))
+        UnevenJob([]).flow(history=path)
+
+        history = pemi.hooks.DurationHistory(path)
+        assert history.estimate('UnevenJob.slow') >= 0.2
+        assert history.estimate('UnevenJob.fast1') < 0.2
+        assert history.durations['UnevenJob.slow']['runs'] == 1
+
+    def test_it_re_estimates_durations(self, tmpdir):
+        history = pemi.hooks.DurationHistory(str(tmpdir.join('history.json')), alpha=0.5)
+        history.record('step', 4)
+        history.record('step', 2)
+        assert history.estimate('step') == 3
+        assert history.durations['step']['runs'] == 2
+
+    def test_it_computes_remaining_path_durations(self, tmpdir):
+        history = pemi.hooks.DurationHistory(str(tmpdir.join('history.json')))
+        for name, duration in [('s1', 1), ('a1', 2), ('s2', 5), ('a2', 1), ('a3', 3)]:
+            history.record('DiamondJob.{}'.format(name), duration)
+
+        plan = DiamondJob().connections.plan()
+        remaining = {
+            step.name: duration
+            for step, duration in pemi.execution.critical_path(plan, history).items()
+            if step.kind == 'flow'
+        }
+
+        assert remaining['s2'] == 5 + 1 + 2 + 3
+        assert remaining['s1'] == 1 + 2 + 2 + 3
+
+    def test_it_starts_the_longest_path_first(self, tmpdir):
+        path = str(tmpdir.join('history.json'))
+
+        started = []
+        UnevenJob(started).flow(executor='thread', max_workers=1, history=path)
+        assert started == [0, 1, 2]
+
+        started = []
+        UnevenJob(started).flow(executor='thread', max_workers=1, history=path)
+        assert started[0] == 2
+
+
+class TestPartialExecution:
+    @pytest.fixture
+    def job(self):
+        job = DiamondJob()
+        job.target(pemi.PdDataSubject, name='main')
+        job.connect('a3', 'main').to('self', 'main')
+        return job
+
+    def flowed(self, job):
+        return {
+            name for name, pipe in job.pipes.items()
+            if name != 'self' and len(pipe.targets['main'].df) > 0
+        }
+
+    def test_it_flows_upstream_of_targets(self, job):
+        job.connections.flow(targets=[('a1', 'main')])
+        assert self.flowed(job) == {'s1', 'a1'}
+
+    def test_it_flows_upstream_of_self_targets(self, job):
+        job.connections.flow(targets=[('self', 'main')])
+        assert list(job.targets['main'].df['n']) == [3, 12]
+
+    def test_it_flows_multiple_targets(self, job):
+        job.connections.flow(targets=[('a1', 'main'), ('s2', 'main')])
+        assert self.flowed(job) == {'s1', 'a1', 's2'}
+
+    def test_it_flows_from_a_pipe(self, job):
+        job.connections.flow()
+        job.pipes['s1'].value = 100
+        job.pipes['a2'].sources['main'].df = pd.DataFrame({'n': [1000]})
+
+        job.connections.flow(from_pipe='a2')
+        assert list(job.pipes['a3'].targets['main'].df['n']) == [3, 1002]
+
+    def test_it_flows_from_a_flattened_pipe(self):
+        job = NestedJob()
+        job.connections.flow(flatten=True)
+        job.pipes['twice2'].sources['main'].df = pd.DataFrame({'n': [10]})
+
+        job.connections.flow(flatten=True, from_pipe='twice2')
+        assert list(job.pipes['a3'].targets['main'].df['n']) == [13]
+
+    def test_it_raises_on_unknown_targets(self, job):
+        with pytest.raises(ValueError):
+            job.connections.flow(targets=[('bogus', 'main')])
+
+        with pytest.raises(ValueError):
+            job.connections.flow(from_pipe='bogus')
+
+
+class ConcurrencyCounter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = 0
+        self.peak = 0
+
+    def __enter__(self):
+        with self.lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+
+    def __exit__(self, *exc):
+        with self.lock:
+            self.current -= 1
+
+class CountedSourcePipe(NumberSourcePipe):
+    def __init__(self, counter, **kwargs):
+        super().__init__(**kwargs)
+        self.counter = counter
+
+    def flow(self):
+        with self.counter:
+            super().flow()
+
+class ResourceJob(pemi.Pipe):
+    def __init__(self, db_counter, other_counter, **kwargs):
+        super().__init__(**kwargs)
+
+        sources = []
+        for idx in range(4):
+            for kind, counter in [('db', db_counter), ('other', other_counter)]:
+                name = '{}{}'.format(kind, idx)
+                sources.append(name)
+                self.pipe(
+                    name=name,
+                    pipe=CountedSourcePipe(counter, value=idx, delay=0.1),
+                    resources=['warehouse'] if kind == 'db' else None
+                )
+                self.connect(name, 'main').to('concat', name)
+
+        self.pipe(name='concat', pipe=pemi.pipes.pd.PdConcatPipe(sources=sources))
+
+
+class TestResourceLimits:
+    @pytest.mark.parametrize('executor', ['thread', 'asyncio'])
+    def test_it_limits_pipes_using_a_resource(self, executor):
+        db_counter, other_counter = ConcurrencyCounter(), ConcurrencyCounter()
+        job = ResourceJob(db_counter, other_counter)
+        job.connections.flow(executor=executor, max_workers=8, resource_limits={'warehouse': 2})
+
+        assert db_counter.peak == 2
+        assert other_counter.peak == 4
+
+    def test_connection_groups_are_resources(self):
+        db_counter, other_counter = ConcurrencyCounter(), ConcurrencyCounter()
+        job = ResourceJob(db_counter, other_counter)
+        for conn in job.connections.connections:
+            if conn.from_pipe_name.startswith('other'):
+                conn.group_as('other')
+
+        job.connections.flow(executor='thread', max_workers=8, resource_limits={'other': 1})
+        assert db_counter.peak == 4
+        assert other_counter.peak == 1
+
+    def test_it_counts_resource_slots(self):
+        step = DiamondJob().connections.plan().flow_steps[0]
+        step.pipe.resources = {'memory': 3, 'warehouse': 1}
+
+        slots = pemi.execution.ResourceSlots({'memory': 4})
+        assert slots.needed(step) == {'memory': 3}
+        assert slots.available(step)
+
+        slots.acquire(step)
+        assert not slots.available(step)
+
+        slots.release(step)
+        slots.usage['memory'] = 1
+        assert slots.available(step)
+
+
+class TestDistributedExecutor:
+    @pytest.fixture(scope='class')
+    def client(self):
+        distributed = pytest.importorskip('distributed')
+        with distributed.LocalCluster(n_workers=2, threads_per_worker=1, processes=True,
+                                      dashboard_address=None) as cluster:
+            with distributed.Client(cluster) as client:
+                yield client
+
+    def test_it_flows_all_pipes(self, client):
+        job = DiamondJob()
+        job.connections.flow(executor=pemi.executors.DistributedExecutor(client))
+
+        assert list(job.pipes['a3'].targets['main'].df['n']) == [3, 12]
+        assert list(job.pipes['a1'].sources['main'].df['n']) == [1]
+
+    def test_it_flows_on_the_default_client(self, client): #pylint: disable=unused-argument
+        job = DiamondJob()
+        job.connections.flow(executor='distributed')
+        assert list(job.pipes['a3'].targets['main'].df['n']) == [3, 12]
+
+    def test_it_only_gathers_outputs(self, client):
+        job = DiamondJob()
+        job.target(pemi.PdDataSubject, name='main')
+        job.connect('a3', 'main').to('self', 'main')
+        job.connections.flow(executor=pemi.executors.DistributedExecutor(client, gather=False))
+
+        assert list(job.targets['main'].df['n']) == [3, 12]
+        assert len(job.pipes['a1'].targets['main'].df) == 0
+
+    def test_it_uses_local_sources(self, client):
+        job = AddOneTwicePipe()
+        job.sources['main'].df = pd.DataFrame({'n': [5]})
+        job.connections.flow(executor=pemi.executors.DistributedExecutor(client))
+
+        assert list(job.targets['main'].df['n']) == [7]
+
+    def test_it_flows_flattened_plans(self, client):
+        job = NestedJob()
+        job.connections.flow(flatten=True, executor=pemi.executors.DistributedExecutor(client))
+        assert list(job.pipes['a3'].targets['main'].df['n']) == [6]
+
+    def test_it_raises_pipe_errors(self, client):
+        job = DiamondJob()
+        job.pipe(name='a2', pipe=FailingPipe())
+
+        with pytest.raises(ValueError, match='This pipe fails'):
+            job.connections.flow(executor=pemi.executors.DistributedExecutor(client))
+
+    def test_it_times_pipes_on_the_workers(self, client, tmpdir):
+        job = pemi.Pipe()
+        sources = ['s1', 's2', 's3']
+        for value, name in enumerate(sources):
+            job.pipe(name=name, pipe=NumberSourcePipe(value=value, delay=0.3))
+            job.connect(name, 'main').to('concat', name)
+        job.pipe(name='concat', pipe=pemi.pipes.pd.PdConcatPipe(sources=sources))
+
+        path = str(tmpdir.join('history.json'))
+        job.connections.flow(executor=pemi.executors.DistributedExecutor(client), history=path)
+
+        # With two workers, one of the sources waits for the others before it flows
+        history = pemi.hooks.DurationHistory(path)
+        for name in sources:
+            assert 0.3 <= history.estimate('Pipe.{}'.format(name)) < 0.6
+
+    def test_it_rejects_resource_limits(self):
+        with pytest.raises(ValueError, match='Resource limits'):
+            DiamondJob().connections.flow(
+                executor=pemi.executors.DistributedExecutor(), resource_limits={'warehouse': 1}
+            )
+
+
+class ChunkSourcePipe(pemi.Pipe):
+    def __init__(self, *, chunks, chunk_size=2, fail_at=None, **kwargs):
+        super().__init__(**kwargs)
+        self.chunks = chunks
+        self.chunk_size = chunk_size
+        self.fail_at = fail_at
+        self.events = []
+
+        self.target(
+            pemi.PdDataSubject,
+            name='main'
+        )
+
+    def flow(self):
+        for idx in range(self.chunks):
+            if idx == self.fail_at:
+                raise ValueError('This source fails')
+            start = idx * self.chunk_size
+            self.targets['main'].put_chunk(
+                pd.DataFrame({'n': range(start, start + self.chunk_size)})
+            )
+            self.events.append(('put', idx))
+
+class StreamingJob(pemi.Pipe):
+    def __init__(self, chunks=4, max_chunks=2, fun=None, fail_at=None, **kwargs):
+        super().__init__(**kwargs)
+        self.events = []
+        self.pipe(name='source', pipe=ChunkSourcePipe(chunks=chunks, fail_at=fail_at))
+        self.pipes['source'].events = self.events
+        self.pipe(name='add', pipe=pemi.pipes.pd.PdLambdaPipe(fun or self.add_one))
+        self.pipe(name='sink', pipe=AddOnePipe())
+
+        self.connect('source', 'main').to('add', 'main').stream(max_chunks=max_chunks)
+        self.connect('add', 'main').to('sink', 'main')
+
+    def add_one(self, df):
+        self.events.append(('got', df['n'].iloc[0] // 2))
+        time.sleep(0.05)
+        return df.assign(n=df['n'] + 1)
+
+
+class TestStreaming:
+    @pytest.mark.parametrize('executor', ['serial', 'thread', 'asyncio'])
+    def test_it_streams_chunks(self, executor):
+        job = StreamingJob()
+        job.connections.flow(executor=executor)
+
+        assert list(job.pipes['add'].targets['main'].df['n']) == list(range(1, 9))
+        assert list(job.pipes['sink'].targets['main'].df['n']) == list(range(2, 10))
+        assert [event for event in job.events if event[0] == 'got'] == [
+            ('got', idx) for idx in range(4)
+        ]
+
+    def test_consumer_starts_before_producer_finishes(self):
+        job = StreamingJob(chunks=6)
+        job.connections.flow(executor='thread')
+
+        assert job.events.index(('got', 0)) < job.events.index(('put', 5))
+
+    def test_it_applies_backpressure(self):
+        job = StreamingJob(chunks=8, max_chunks=1)
+        job.connections.flow()
+
+        puts = gets = lag = 0
+        for kind, _ in job.events:
+            puts += kind == 'put'
+            gets += kind == 'got'
+            lag = max(lag, puts - gets)
+        assert lag <= 2
+
+    def test_stream_holds_at_most_max_chunks(self):
+        stream = pemi.data_subject.ChunkStream(max_chunks=2)
+
+        def produce():
+            for idx in range(10):
+                stream.put(idx)
+            stream.close()
+
+        producer = threading.Thread(target=produce)
+        producer.start()
+        time.sleep(0.1)
+        assert producer.is_alive()
+
+        assert list(stream) == list(range(10))
+        assert stream.peak_chunks == 2
+        producer.join()
+
+    @pytest.mark.parametrize('executor', ['serial', 'thread', 'asyncio'])
+    def test_consumer_errors_stop_the_producer(self, executor):
+        def fail(_df):
+            raise ValueError('This consumer fails')
+
+        job = StreamingJob(chunks=20, max_chunks=1, fun=fail)
+        with pytest.raises(ValueError, match='This consumer fails'):
+            job.connections.flow(executor=executor)
+        assert len(job.events) < 20
+
+    @pytest.mark.parametrize('executor', ['serial', 'thread', 'asyncio'])
+    def test_producer_errors_stop_the_consumer(self, executor):
+        job = StreamingJob(chunks=4, fail_at=2)
+        with pytest.raises(ValueError, match='This source fails'):
+            job.connections.flow(executor=executor)
+
+    def test_it_validates_chunks(self):
+        job = StreamingJob()
+        job.pipes['add'].sources['main'].schema = pemi.Schema(
+            missing=pemi.fields.StringField()
+        )
+
+        with pytest.raises(pemi.data_subject.MissingFieldsError):
+            job.connections.flow()
+
+    def test_it_forks_chunks(self):
+        job = StreamingJob()
+        job.pipe(name='fork', pipe=pemi.pipes.pd.PdFieldValueForkPipe(field='odd', forks=[True]))
+        job.connections.connections.pop()
+        job.pipes['add'].fun = lambda df: df.assign(odd=df['n'] % 2 == 1)
+        job.connect('add', 'main').to('fork', 'main').stream()
+        job.connections.flow(executor='thread')
+
+        assert list(job.pipes['fork'].targets[True].df['n']) == [1, 3, 5, 7]
+        assert list(job.pipes['fork'].targets['remainder'].df['n']) == [0, 2, 4, 6]
+
+    def test_it_writes_csv_chunks(self, tmp_path):
+        path = str(tmp_path / 'out.csv')
+        job = StreamingJob()
+        job.pipe(name='sink', pipe=pemi.pipes.csv.LocalCsvFileTargetPipe(schema=None, path=path))
+        job.connections.connections.pop()
+        job.connect('add', 'main').to('sink', 'main').stream()
+        job.connections.flow()
+
+        assert list(pd.read_csv(path)['n']) == list(range(1, 9))
+
+    def test_it_requires_flowed_pipes(self):
+        job = StreamingJob()
+        job.target(pemi.PdDataSubject, name='main')
+        job.connect('sink', 'main').to('self', 'main').stream()
+
+        with pytest.raises(DagValidationError):
+            job.connections.plan()
+
+    def test_distributed_executor_rejects_streams(self):
+        plan = StreamingJob().connections.plan()
+        with pytest.raises(ValueError):
+            pemi.executors.DistributedExecutor().run(plan)
+
+
+class TestCheckpointResume:
+    @staticmethod
+    def failing_job():
+        job = DiamondJob()
+        job.pipe(name='a3', pipe=FailingPipe())
+        return job
+
+    @staticmethod
+    def resumed_job():
+        'A job whose sources fail if they are flowed again'
+        job = DiamondJob()
+        job.pipe(name='s1', pipe=FailingPipe())
+        job.pipe(name='s2', pipe=FailingPipe())
+        return job
+
+    @pytest.mark.parametrize('executor', ['serial', 'thread', 'process', 'asyncio'])
+    def test_it_resumes_from_the_failed_pipe(self, tmpdir, executor):
+        run_dir = str(tmpdir.join('run'))
+        with pytest.raises(ValueError, match='This pipe fails'):
+            self.failing_job().connections.flow(checkpoint=run_dir, executor=executor)
+
+        completed = pemi.checkpoint.CheckpointHook(run_dir).completed()
+        assert sorted(completed) == [
+            'DiamondJob/{}'.format(name) for name in ['a1', 'a2', 'concat', 's1', 's2']
+        ]
+
+        job = self.resumed_job()
+        job.connections.flow(checkpoint=run_dir, resume=True, executor=executor)
+        assert list(job.pipes['a3'].targets['main'].df['n']) == [3, 12]
+        assert list(job.pipes['s1'].targets['main'].df['n']) == [1]
+
+    def test_it_starts_over_unless_resumed(self, tmpdir):
+        run_dir = str(tmpdir.join('run'))
+        with pytest.raises(ValueError):
+            self.failing_job().connections.flow(checkpoint=run_dir)
+
+        with pytest.raises(ValueError, match='This pipe fails'):
+            self.resumed_job().connections.flow(checkpoint=run_dir)
+        assert pemi.checkpoint.CheckpointHook(run_dir).completed() == {}
+
+    def test_it_checkpoints_flattened_pipes(self, tmpdir):
+        run_dir = str(tmpdir.join('run'))
+        job = NestedJob()
+        job.pipe(name='a3', pipe=FailingPipe())
+        with pytest.raises(ValueError):
+            job.connections.flow(flatten=True, checkpoint=run_dir)
+
+        job = NestedJob()
+        hook = pemi.checkpoint.CheckpointHook(run_dir)
+        job.connections.flow(flatten=True, checkpoint=hook, resume=True)
+
+        assert 'NestedJob/twice2/a2' in hook.restored
+        assert list(job.pipes['a3'].targets['main'].df['n']) == [6]
@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+import pemi.files
+
+class TestAtomicWrite:
+    def test_it_replaces_the_file(self, tmpdir):
+        path = str(tmpdir.join('state.json'))
+        pemi.files.write_json(path, {'a': 1})
+        pemi.files.write_json(path, {'a': 2})
+
+        assert pemi.files.read_json(path) == {'a': 2}
+        assert os.listdir(str(tmpdir)) == ['state.json']
+
+    def test_a_failed_write_leaves_the_file_untouched(self, tmpdir):
+        path = str(tmpdir.join('state.json'))
+        pemi.files.write_json(path, {'a': 1})
+
+        with pytest.raises(TypeError):
+            pemi.files.write_json(path, {'a': object()})
+
+        assert pemi.files.read_json(path) == {'a': 1}
+        assert os.listdir(str(tmpdir)) == ['state.json']
+
+    def test_it_keeps_permissions(self, tmpdir):
+        path = str(tmpdir.join('state.json'))
+        pemi.files.write_json(path, {'a': 1})
+        os.chmod(path, 0o600)
+        pemi.files.write_json(path, {'a': 2})
+
+        assert os.stat(path).st_mode & 0o777 == 0o600
+
+    def test_new_files_get_the_default_permissions(self, tmpdir):
+        path = pemi.files.write_json(str(tmpdir.join('state.json')), {'a': 1})
+        assert os.stat(path).st_mode & 0o777 == pemi.files.DEFAULT_PERMISSIONS
+
+
+class TestJsonStore:
+    def test_it_stores_values_by_key(self, tmpdir):
+        store = pemi.files.JsonStore(str(tmpdir.join('store.json')))
+        assert store.get('a') is None
+
+        store.set('a', 1)
+        store.set('b', [2])
+
+        assert pemi.files.JsonStore(store.path).read() == {'a': 1, 'b': [2]}
@@ -0,0 +1,154 @@
+import pytest
+import numpy as np
+import pandas as pd
+
+from pandas.testing import assert_frame_equal
+
+import pemi
+import pemi.memory
+import pemi.metrics
+import pemi.pipes.pd
+
+def make_df(value, nrows=10000):
+    return pd.DataFrame({'n': [value] * nrows, 's': ['abc'] * nrows})
+
+def frame_bytes(df):
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+class TestMemoryManager:
+    @pytest.fixture
+    def manager(self, tmpdir):
+        budget = int(frame_bytes(make_df(0)) * 2.5)
+        with pemi.memory.MemoryManager(budget=budget, spill_dir=str(tmpdir)) as manager:
+            yield manager
+
+    def test_it_is_inactive_by_default(self):
+        assert pemi.memory.get_manager() is None
+
+    def test_it_tracks_subject_frames(self, manager):
+        subject = pemi.PdDataSubject(df=make_df(1))
+        assert manager.resident_bytes == frame_bytes(subject.df)
+
+    def test_it_spills_least_recently_used_frames(self, manager):
+        subjects = [pemi.PdDataSubject(df=make_df(idx)) for idx in range(3)]
+
+        assert manager.spills == 1
+        assert subjects[0]._frame.spilled #pylint: disable=protected-access
+        assert not subjects[2]._frame.spilled #pylint: disable=protected-access
+        assert manager.resident_bytes <= manager.budget
+
+    def test_it_reloads_spilled_frames(self, manager):
+        subjects = [pemi.PdDataSubject(df=make_df(idx)) for idx in range(3)]
+
+        assert_frame_equal(subjects[0].df, make_df(0))
+        assert manager.reloads == 1
+        assert manager.spills == 2
+        assert subjects[1]._frame.spilled #pylint: disable=protected-access
+
+    def test_connected_subjects_share_frames(self, manager):
+        upstream = pemi.PdDataSubject(df=make_df(1))
+        downstream = pemi.PdDataSubject()
+        downstream.connect_from(upstream)
+
+        assert manager.resident_bytes == frame_bytes(upstream.df)
+        assert upstream._frame is downstream._frame #pylint: disable=protected-access
+
+    def test_it_drops_unreferenced_frames(self, manager, tmpdir):
+        subjects = [pemi.PdDataSubject(df=make_df(idx)) for idx in range(3)]
+        subjects[0].df = make_df(10, nrows=0)
+
+        assert manager.collected == 1
+        assert manager.metrics['collected'] == 1
+        assert manager.spills == 1
+        assert [path for path in tmpdir.visit() if path.isfile()] == []
+
+    def test_it_publishes_metrics(self, manager):
+        with pemi.metrics.MetricsRegistry() as registry:
+            subjects = [pemi.PdDataSubject(df=make_df(idx)) for idx in range(3)]
+            subjects[0].df #pylint: disable=pointless-statement
+
+        def value(name, kind='counter'):
+            return registry.metric(name, kind, '').get()
+
+        assert value('pemi_memory_spills_total') == manager.spills == 2
+        assert value('pemi_memory_spilled_bytes_total') == manager.spilled_bytes
+        assert value('pemi_memory_reloads_total') == manager.reloads == 1
+        assert value('pemi_memory_peak_resident_bytes', 'gauge') == manager.peak_resident_bytes
+
+    def test_subjects_pickle_spilled_frames(self, manager):
+        subjects = [pemi.PdDataSubject(df=make_df(idx)) for idx in range(3)]
+
+        pipe = pemi.Pipe()
+        pipe.sources['main'] = subjects[0]
+        unpickled = pemi.Pipe().from_pickle(pipe.to_pickle())
+        assert_frame_equal(unpickled.sources['main'].df, make_df(0))
+
+
+class GrowingPipe(pemi.Pipe):
+    def __init__(self, nrows, **kwargs):
+        super().__init__(**kwargs)
+        self.nrows = nrows
+        self.target(pemi.PdDataSubject, name='main')
+
+    def flow(self):
+        self.targets['main'].df = pd.DataFrame({'n': np.arange(self.nrows)})
+
+class GrowingJob(pemi.Pipe):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.pipe(name='small', pipe=GrowingPipe(nrows=10))
+        self.pipe(name='large', pipe=GrowingPipe(nrows=2000000))
+        self.pipe(name='concat', pipe=pemi.pipes.pd.PdConcatPipe(sources=['small', 'large']))
+        self.connect('small', 'main').to('concat', 'small')
+        self.connect('large', 'main').to('concat', 'large')
+
+    def flow(self, **kwargs): #pylint: disable=arguments-differ
+        self.connections.flow(**kwargs)
+
+
+class TestMemoryProfiler:
+    def test_it_is_inactive_by_default(self):
+        assert pemi.memory.get_profiler() is None
+
+    @pytest.mark.parametrize('executor', ['serial', 'process'])
+    def test_it_records_pipe_peaks(self, executor):
+        with pemi.memory.MemoryProfiler() as profiler:
+            GrowingJob().flow(executor=executor)
+
+        pipes = {pipe['pipe']: pipe for pipe in profiler.pipe_peaks()}
+        assert set(pipes) == {'small', 'large', 'concat'}
+        assert pipes['large']['flows'] == 1
+        assert pipes['large']['peak_delta'] > 8 * 2000000 / 2
+
+    def test_it_records_the_largest_subjects(self):
+        with pemi.memory.MemoryProfiler() as profiler:
+            GrowingJob().flow()
+
+        largest = profiler.largest_subjects(top=2)
+        assert [(subject['pipe'], subject['subject']) for subject in largest] == [
+            ('concat', 'main'), ('large', 'main')
+        ]
+        assert largest[1]['bytes'] == frame_bytes(pd.DataFrame({'n': np.arange(2000000)}))
+        assert largest[1]['rows'] == 2000000
+        assert 'large.main' in profiler.report()
+
+    def test_sampling_estimates_object_columns(self):
+        df = pd.DataFrame({'n': range(10000), 's': ['a' * (idx % 20) for idx in range(10000)]})
+
+        estimate = pemi.memory.frame_bytes(df, sample_rows=100)
+        assert estimate == pytest.approx(frame_bytes(df), rel=0.05)
+        assert pemi.memory.frame_bytes(df[['n']], sample_rows=100) == frame_bytes(df[['n']])
+
+    def test_shared_frames_are_measured_once(self, monkeypatch):
+        measured = []
+        monkeypatch.setattr(
+            pemi.memory, 'frame_bytes', lambda df, sample_rows: measured.append(df) or 1
+        )
+
+        with pemi.memory.MemoryProfiler():
+            upstream = pemi.PdDataSubject(df=make_df(1), name='upstream')
+            downstream = pemi.PdDataSubject(name='downstream')
+            downstream.connect_from(upstream)
+
+        assert len(measured) == 1
@@ -0,0 +1,178 @@
+import urllib.request
+
+import pytest
+import pandas as pd
+
+import pemi
+import pemi.metrics
+import pemi.pipes.pd
+import pemi.pipes.sa
+import pemi.pipes.csv
+
+class AddOnePipe(pemi.Pipe):
+    def __init__(self, fail=False, **kwargs):
+        super().__init__(**kwargs)
+        self.fail = fail
+        self.source(pemi.PdDataSubject, name='main')
+        self.target(pemi.PdDataSubject, name='main')
+
+    def flow(self):
+        if self.fail:
+            raise ValueError('This pipe fails')
+        self.targets['main'].df = self.sources['main'].df.assign(
+            n=self.sources['main'].df['n'] + 1
+        )
+
+class CsvJob(pemi.Pipe):
+    def __init__(self, csv_path, fail=False, chunk_size=None, **kwargs):
+        super().__init__(**kwargs)
+
+        self.pipe(
+            name='numbers',
+            pipe=pemi.pipes.csv.LocalCsvFileSourcePipe(
+                schema=pemi.Schema(n=pemi.IntegerField()),
+                paths=[csv_path],
+                chunk_size=chunk_size
+            )
+        )
+        self.pipe(name='add_one', pipe=AddOnePipe(fail=fail))
+        self.connect('numbers', 'main').to('add_one', 'main')
+
+    def flow(self, **kwargs): #pylint: disable=arguments-differ
+        self.connections.flow(**kwargs)
+
+
+@pytest.fixture
+def csv_path(tmpdir):
+    path = str(tmpdir.join('numbers.csv'))
+    pd.DataFrame({'n': ['1', '2', 'x', '3']}).to_csv(path, index=False)
+    return path
+
+def value(registry, name, **labels):
+    return registry.metrics[name].get(**labels)
+
+
+class TestMetricsRegistry:
+    def test_it_is_inactive_by_default(self, csv_path):
+        assert pemi.metrics.get_registry() is None
+        assert pemi.metrics.counter('pemi_test_total', 'Test') is pemi.metrics.gauge(
+            'pemi_test', 'Test'
+        )
+        CsvJob(csv_path).flow()
+
+    @pytest.mark.parametrize('executor', ['serial', 'thread', 'process'])
+    def test_it_records_pipe_metrics(self, csv_path, executor):
+        with pemi.metrics.MetricsRegistry() as registry:
+            CsvJob(csv_path).flow(executor=executor)
+
+        labels = {'pipe': 'add_one', 'pipe_class': 'AddOnePipe'}
+        assert value(registry, 'pemi_pipe_flows_total', **labels) == 1
+        assert value(registry, 'pemi_pipe_flow_seconds_total', **labels) > 0
+        assert value(registry, 'pemi_subject_rows_in_total', subject='main', **labels) == 3
+        assert value(registry, 'pemi_subject_rows_out_total', subject='main', **labels) == 3
+        assert value(registry, 'pemi_subject_bytes_out_total', subject='main', **labels) > 0
+
+        csv_labels = {'pipe': 'numbers', 'pipe_class': 'LocalCsvFileSourcePipe'}
+        assert value(registry, 'pemi_pipe_error_rows_total', **csv_labels) == 1
+        assert value(registry, 'pemi_csv_rows_total', pipe='numbers') == 3
+        assert value(registry, 'pemi_csv_error_rows_total', pipe='numbers') == 1
+
+    def test_it_counts_chunked_csv_rows_once(self, csv_path):
+        with pemi.metrics.MetricsRegistry() as registry:
+            job = CsvJob(csv_path, chunk_size=2)
+            job.flow()
+            list(job.pipes['numbers'].targets['errors'].iter_chunks())
+            list(job.pipes['numbers'].targets['main'].iter_chunks())
+
+        assert value(registry, 'pemi_csv_rows_total', pipe='numbers') == 3
+        assert value(registry, 'pemi_csv_error_rows_total', pipe='numbers') == 1
+
+    def test_it_counts_csv_chunks_once_when_a_pass_fails(self, tmpdir):
+        paths = [str(tmpdir.join('numbers{}.csv'.format(idx))) for idx in range(2)]
+        pd.DataFrame({'n': ['1', '2', '3']}).to_csv(paths[0], index=False)
+
+        with pemi.metrics.MetricsRegistry() as registry:
+            pipe = pemi.pipes.csv.LocalCsvFileSourcePipe(
+                name='numbers',
+                schema=pemi.Schema(n=pemi.IntegerField()),
+                paths=paths,
+                chunk_size=2
+            )
+            pipe.flow()
+            with pytest.raises(FileNotFoundError):
+                list(pipe.targets['main'].iter_chunks())
+
+            pd.DataFrame({'n': ['4']}).to_csv(paths[1], index=False)
+            # The failed pass ends on the next read, and the one after reads the files again
+            for _ in range(2):
+                list(pipe.targets['main'].iter_chunks())
+
+        assert value(registry, 'pemi_csv_rows_total', pipe='numbers') == 4
+
+    def test_it_counts_failures(self, csv_path):
+        with pemi.metrics.MetricsRegistry() as registry:
+            with pytest.raises(ValueError):
+                CsvJob(csv_path, fail=True).flow()
+
+        labels = {'pipe': 'add_one', 'pipe_class': 'AddOnePipe'}
+        assert value(registry, 'pemi_pipe_failures_total', **labels) == 1
+        assert value(registry, 'pemi_pipe_flows_total', **labels) == 1
+
+    def test_it_counts_lookup_matches(self):
+        pipe = pemi.pipes.pd.PdLookupJoinPipe(name='lkp', main_key=['key'], lookup_key=['key'])
+        pipe.sources['main'].df = pd.DataFrame({'key': [1, 2, 3]})
+        pipe.sources['lookup'].df = pd.DataFrame({'key': [1, 2], 'value': ['a', 'b']})
+
+        with pemi.metrics.MetricsRegistry() as registry:
+            pipe.flow()
+
+        assert value(registry, 'pemi_lookup_matched_total', pipe='lkp') == 2
+        assert value(registry, 'pemi_lookup_missed_total', pipe='lkp') == 1
+
+    def test_it_counts_sql_rows_fetched(self, sqlite_engine):
+        job = pemi.Pipe()
+        job.pipe(
+            name='events',
+            pipe=pemi.pipes.sa.SaSqlSourcePipe(
+                engine=sqlite_engine, schema=pemi.Schema(id=pemi.IntegerField()),
+                sql='SELECT * FROM events'
+            )
+        )
+        with pemi.metrics.MetricsRegistry() as registry:
+            job.pipes['events'].flow()
+
+        assert value(registry, 'pemi_sql_rows_fetched_total', pipe='events') == 2
+
+    def test_it_exports_prometheus_text(self):
+        registry = pemi.metrics.MetricsRegistry()
+        registry.counter('pemi_rows_total', 'Rows').inc(2, pipe='a "quoted" name')
+        registry.gauge('pemi_workers', 'Workers').set(4)
+
+        assert registry.to_prometheus() == '\n'.join([
+            '# HELP pemi_rows_total Rows',
+            '# TYPE pemi_rows_total counter',
+            'pemi_rows_total{pipe="a \\"quoted\\" name"} 2',
+            '# HELP pemi_workers Workers',
+            '# TYPE pemi_workers gauge',
+            'pemi_workers 4',
+        ]) + '\n'
+
+    def test_flow_writes_a_textfile(self, csv_path, tmpdir):
+        path = str(tmpdir.join('job.prom'))
+        CsvJob(csv_path).flow(metrics=path)
+
+        with open(path) as metrics_file:
+            lines = metrics_file.read().splitlines()
+
+        assert pemi.metrics.get_registry() is None
+        assert 'pemi_csv_rows_total{pipe="numbers"} 3' in lines
+
+    def test_it_serves_metrics_over_http(self):
+        with pemi.metrics.MetricsRegistry(port=0) as registry:
+            registry.counter('pemi_rows_total', 'Rows').inc(3)
+            host, port = registry.address
+            with urllib.request.urlopen('http://{}:{}/metrics'.format(host, port)) as response:
+                body = response.read().decode('utf-8')
+
+        assert 'pemi_rows_total 3' in body.splitlines()
+        assert registry.address is None
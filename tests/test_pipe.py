@@ -1,6 +1,9 @@
 import os
+import mmap
 
 import pytest
+import numpy as np
+import pandas as pd
 import sqlalchemy as sa
 
 from pandas.testing import assert_frame_equal
@@ -181,3 +184,57 @@ class TestPickling():
             job.pipes['s1'].targets['main'].df,
             unpickled_job.pipes['s1'].targets['main'].df
         )
+
+
+class TestCheckpoint:
+    @pytest.fixture
+    def job(self):
+        job = JobPipe()
+        job.flow()
+        job.pipes['s1'].targets['main'].df = pd.DataFrame({
+            'style': ['ipa'] * 1000,
+            'abv': np.arange(1000, dtype='float64')
+        })
+        return job
+
+    @pytest.mark.parametrize('compression', [None, 'zlib', 'lzma'])
+    def test_it_restores_a_checkpoint(self, job, tmpdir, compression):
+        path = str(tmpdir.join('job.ckpt'))
+        assert job.to_checkpoint(path, compression=compression) == os.path.getsize(path)
+
+        restored = JobPipe().from_checkpoint(path)
+        for sub_pipe, kind, subject in [
+                ('s1', 'targets', 'main'),
+                ('concat', 'sources', 's2'),
+                ('concat', 'targets', 'main')
+        ]:
+            assert_frame_equal(
+                getattr(restored.pipes[sub_pipe], kind)[subject].df,
+                getattr(job.pipes[sub_pipe], kind)[subject].df
+            )
+
+    def test_it_memory_maps_column_data(self, job, tmpdir):
+        path = str(tmpdir.join('job.ckpt'))
+        job.to_checkpoint(path)
+        restored = JobPipe().from_checkpoint(path)
+
+        values = restored.pipes['s1'].targets['main'].df['abv'].values
+        base = values
+        while getattr(base, 'base', None) is not None:
+            base = base.base
+        assert isinstance(getattr(base, 'obj', base), mmap.mmap)
+
+        values[0] = -1
+        assert JobPipe().from_checkpoint(path).pipes['s1'].targets['main'].df['abv'][0] == 0
+
+    def test_it_rejects_other_files(self, tmpdir):
+        path = str(tmpdir.join('job.ckpt'))
+        with open(path, 'wb') as other_file:
+            other_file.write(JobPipe().to_pickle())
+
+        with pytest.raises(pemi.checkpoint.CheckpointError):
+            JobPipe().from_checkpoint(path)
+
+    def test_it_rejects_unknown_compression(self, job, tmpdir):
+        with pytest.raises(ValueError):
+            job.to_checkpoint(str(tmpdir.join('job.ckpt')), compression='zip')
@@ -1,9 +1,16 @@
+import decimal
+import datetime
+
 import pytest
 import factory
 
 import pyspark
+import pandas as pd
 
 import pemi
+import pemi.connections
+import pemi.execution
+import pemi.pipes.spark
 import pemi.testing as pt
 from pemi.data_subject import SparkDataSubject
 from pemi.fields import *
@@ -160,3 +167,175 @@ with pt.Scenario(
             pt.then.target_matches_example(scenario.targets['beer_sales'], beer_sales_table,
                                            by=['beer_id', 'sold_at'])
         )
+
+
+class TestSparkDataSubjectToPd:
+    @pytest.fixture
+    def subject(self):
+        return SparkDataSubject(
+            spark=spark_session,
+            schema=pemi.Schema(
+                id=IntegerField(),
+                name=StringField(),
+                sold_at=DateField(format='%m/%d/%Y')
+            )
+        )
+
+    def test_it_coerces_columns_that_do_not_match_the_spark_type(self, subject):
+        subject.df = spark_session.createDataFrame(
+            [(1, 'IPA', '01/02/2017'), (2, 'Stout', '01/03/2017')],
+            ['id', 'name', 'sold_at']
+        )
+
+        assert list(subject.to_pd()['sold_at']) == [
+            datetime.date(2017, 1, 2), datetime.date(2017, 1, 3)
+        ]
+
+    def test_it_keeps_columns_that_match_the_spark_type(self, subject):
+        subject.df = spark_session.createDataFrame(
+            [(1, 'IPA', '01/02/2017'), (2, None, '01/03/2017')],
+            ['id', 'name', 'sold_at']
+        )
+
+        df = subject.to_pd()
+        assert list(df['id']) == [1, 2]
+        assert list(df['name']) == ['IPA', '']
+
+    def test_it_converts_integers_with_nulls(self, subject):
+        subject.df = spark_session.createDataFrame(
+            [(1, 'IPA', '01/02/2017'), (None, 'Stout', '01/03/2017')],
+            'id LONG, name STRING, sold_at STRING'
+        )
+
+        assert list(subject.to_pd()['id']) == [1, None]
+
+    def test_it_does_not_need_a_session(self):
+        subject = SparkDataSubject(schema=pemi.Schema(id=IntegerField(), name=StringField()))
+        subject.df = spark_session.createDataFrame([(1, 'IPA')], ['id', 'name'])
+
+        assert list(subject.to_pd()['name']) == ['IPA']
+
+
+class TestSparkDataSubjectFromPd:
+    @pytest.fixture
+    def subject(self):
+        return SparkDataSubject(
+            spark=spark_session,
+            schema=pemi.Schema(
+                id=IntegerField(),
+                sold_at=DateField(),
+                price=DecimalField(precision=8, scale=3),
+                details=JsonField()
+            )
+        )
+
+    @pytest.fixture
+    def df(self):
+        return pd.DataFrame({
+            'id': [1, 2],
+            'sold_at': [datetime.date(2017, 1, 2), None],
+            'price': [decimal.Decimal('1.500'), decimal.Decimal('12.250')],
+            'details': [{'a': 1}, None]
+        })
+
+    def test_it_creates_spark_types_from_the_schema(self, subject, df):
+        subject.from_pd(df)
+
+        assert [(f.name, f.dataType.simpleString()) for f in subject.df.schema.fields] == [
+            ('id', 'bigint'),
+            ('sold_at', 'date'),
+            ('price', 'decimal(8,3)'),
+            ('details', 'string')
+        ]
+
+    def test_it_round_trips_data(self, subject, df):
+        subject.from_pd(df)
+
+        actual = subject.to_pd()
+        assert list(actual['sold_at']) == [datetime.date(2017, 1, 2), None]
+        assert list(actual['price']) == [decimal.Decimal('1.500'), decimal.Decimal('12.250')]
+        assert list(actual['details']) == [{'a': 1}, None]
+
+    def test_it_infers_types_for_fields_not_in_the_schema(self, subject):
+        subject.from_pd(pd.DataFrame({'other': ['x'], 'id': [1], 'price': [None]}))
+        assert [(f.name, f.dataType.simpleString()) for f in subject.df.schema.fields] == [
+            ('other', 'string'),
+            ('id', 'bigint'),
+            ('price', 'decimal(8,3)')
+        ]
+
+
+class TestSparkPersistPlanner:
+    class SourcePipe(pemi.Pipe):
+        def __init__(self, **params):
+            super().__init__(**params)
+            self.target(SparkDataSubject, name='main', spark=spark_session)
+
+        def flow(self):
+            self.targets['main'].df = spark_session.createDataFrame([(1,), (2,)], ['id'])
+
+    class ConsumerPipe(pemi.Pipe):
+        def __init__(self, **params):
+            super().__init__(**params)
+            self.source(SparkDataSubject, name='main')
+            self.source_was_cached = None
+
+        def flow(self):
+            self.source_was_cached = self.sources['main'].df.is_cached
+
+    class ForkedJob(pemi.Pipe):
+        def __init__(self, **params):
+            super().__init__(**params)
+
+            self.pipe(name='source', pipe=TestSparkPersistPlanner.SourcePipe())
+            self.connect('source', 'main').to('fork', 'main')
+
+            self.pipe(name='fork', pipe=pemi.pipes.spark.SparkForkPipe(forks=['x', 'y']))
+            self.connect('fork', 'x').to('x', 'main')
+            self.connect('fork', 'y').to('y', 'main')
+
+            self.pipe(name='x', pipe=TestSparkPersistPlanner.ConsumerPipe())
+            self.pipe(name='y', pipe=TestSparkPersistPlanner.ConsumerPipe())
+
+        def flow(self):
+            self.connections.flow(**self.params)
+
+    def test_it_plans_to_persist_forked_subjects(self):
+        job = self.ForkedJob()
+        planner = pemi.connections.SparkPersistPlanner(job.connections.connections)
+        assert planner.consumers == {
+            (id(job), 'source', 'main'): {('flow', id(job), 'x'), ('flow', id(job), 'y')}
+        }
+
+    def test_it_plans_same_named_pipes_of_different_parents(self):
+        first = self.ForkedJob()
+        second = self.ForkedJob()
+        planner = pemi.connections.SparkPersistPlanner(pemi.execution.ExecutionPlan(
+            first.connections.connections + second.connections.connections
+        ))
+        assert planner.consumers == {
+            (id(first), 'source', 'main'): {('flow', id(first), 'x'), ('flow', id(first), 'y')},
+            (id(second), 'source', 'main'): {('flow', id(second), 'x'), ('flow', id(second), 'y')}
+        }
+
+    def test_it_persists_subjects_while_consumers_flow(self):
+        job = self.ForkedJob()
+        job.flow()
+
+        assert job.pipes['x'].source_was_cached
+        assert job.pipes['y'].source_was_cached
+        assert not job.pipes['source'].targets['main'].df.is_cached
+
+    def test_it_unpersists_once_with_concurrent_consumers(self):
+        job = self.ForkedJob(executor='thread', max_workers=2)
+        job.flow()
+
+        assert job.pipes['x'].source_was_cached
+        assert job.pipes['y'].source_was_cached
+        assert not job.pipes['source'].targets['main'].df.is_cached
+
+    def test_it_does_not_persist_when_disabled(self):
+        job = self.ForkedJob(spark_storage_level=None)
+        job.flow()
+
+        assert not job.pipes['x'].source_was_cached
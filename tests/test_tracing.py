@@ -0,0 +1,141 @@
+import os
+import json
+
+import pytest
+import pandas as pd
+
+import pemi
+import pemi.tracing
+import pemi.pipes.pd
+import pemi.pipes.csv
+
+class AddOnePipe(pemi.Pipe):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.source(pemi.PdDataSubject, name='main')
+        self.target(pemi.PdDataSubject, name='main')
+
+    def flow(self):
+        self.targets['main'].df = self.sources['main'].df.assign(
+            n=self.sources['main'].df['n'] + 1
+        )
+
+class AddTwoPipe(pemi.Pipe):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.source(pemi.PdDataSubject, name='main')
+        self.target(pemi.PdDataSubject, name='main')
+
+        self.pipe(name='a1', pipe=AddOnePipe())
+        self.pipe(name='a2', pipe=AddOnePipe())
+        self.connect('self', 'main').to('a1', 'main')
+        self.connect('a1', 'main').to('a2', 'main')
+        self.connect('a2', 'main').to('self', 'main')
+
+class TracedJob(pemi.Pipe):
+    def __init__(self, csv_path, **kwargs):
+        super().__init__(**kwargs)
+
+        self.pipe(
+            name='numbers',
+            pipe=pemi.pipes.csv.LocalCsvFileSourcePipe(
+                schema=pemi.Schema(n=pemi.IntegerField()),
+                paths=[csv_path]
+            )
+        )
+        self.pipe(name='add_two', pipe=AddTwoPipe())
+        self.pipe(name='add_one', pipe=AddOnePipe())
+
+        self.connect('numbers', 'main').to('add_two', 'main')
+        self.connect('numbers', 'errors').to('add_one', 'main')
+
+    def flow(self, **kwargs): #pylint: disable=arguments-differ
+        self.connections.flow(**kwargs)
+
+
+@pytest.fixture
+def job(tmpdir):
+    csv_path = str(tmpdir.join('numbers.csv'))
+    pd.DataFrame({'n': [1, 2, 3]}).to_csv(csv_path, index=False)
+    return TracedJob(csv_path)
+
+def spans(tracer, category=None):
+    return [
+        event for event in tracer.to_chrome_trace()['traceEvents']
+        if event['ph'] == 'X' and category in (None, event['cat'])
+    ]
+
+def contains(outer, inner):
+    return (
+        outer['pid'] == inner['pid'] and outer['tid'] == inner['tid']
+        and outer['ts'] <= inner['ts']
+        and inner['ts'] + inner['dur'] <= outer['ts'] + outer['dur']
+    )
+
+
+class TestTracer:
+    def test_it_is_inactive_by_default(self, job):
+        assert pemi.tracing.get_tracer() is None
+        assert pemi.tracing.span('extract') is pemi.tracing.span('parse')
+        job.flow()
+
+    def test_it_records_flow_connect_and_source_spans(self, job):
+        with pemi.tracing.Tracer() as tracer:
+            job.flow()
+
+        names = {event['name'] for event in spans(tracer, 'flow')}
+        assert names == {
+            'LocalCsvFileSourcePipe(numbers)', 'AddTwoPipe(add_two)', 'AddOnePipe(a1)',
+            'AddOnePipe(a2)', 'AddOnePipe(add_one)'
+        }
+        assert len(spans(tracer, 'connect')) == 5
+        assert [event['args']['pipe'] for event in spans(tracer, 'pemi')] == [
+            'LocalCsvFileSourcePipe(numbers)', 'LocalCsvFileSourcePipe(numbers)'
+        ]
+        assert [event['name'] for event in spans(tracer, 'pemi')] == ['extract', 'parse']
+
+    def test_nested_pipes_are_nested_spans(self, job):
+        with pemi.tracing.Tracer() as tracer:
+            job.flow()
+
+        by_name = {event['name']: event for event in spans(tracer, 'flow')}
+        assert contains(by_name['AddTwoPipe(add_two)'], by_name['AddOnePipe(a1)'])
+        assert not contains(by_name['AddTwoPipe(add_two)'], by_name['AddOnePipe(add_one)'])
+
+    def test_it_records_worker_process_spans(self, job):
+        with pemi.tracing.Tracer() as tracer:
+            job.flow(executor='process', max_workers=2)
+
+        pids = {event['pid'] for event in spans(tracer, 'flow')}
+        assert os.getpid() not in pids
+        assert len(spans(tracer, 'flow')) == 5
+        assert len(spans(tracer, 'connect')) == 5
+
+    def test_it_records_errors(self):
+        tracer = pemi.tracing.Tracer()
+        with tracer, pytest.raises(ValueError):
+            with pemi.tracing.span('load', pemi.Pipe(name='target')):
+                raise ValueError('Load failed')
+
+        assert spans(tracer)[0]['args'] == {'pipe': 'Pipe(target)', 'error': 'ValueError'}
+
+    def test_it_drops_the_oldest_spans(self):
+        with pemi.tracing.Tracer(max_events=2) as tracer:
+            for idx in range(3):
+                with pemi.tracing.span('step', index=idx):
+                    pass
+
+        assert [event['args']['index'] for event in spans(tracer)] == [1, 2]
+        assert tracer.to_chrome_trace()['otherData'] == {'dropped_events': 1}
+
+    def test_flow_writes_a_chrome_trace(self, job, tmpdir):
+        path = str(tmpdir.join('trace.json'))
+        job.flow(executor='thread', trace=path)
+
+        with open(path) as trace_file:
+            trace = json.load(trace_file)
+
+        assert pemi.tracing.get_tracer() is None
+        assert len([event for event in trace['traceEvents'] if event['ph'] == 'X']) == 12
+        thread_names = [event for event in trace['traceEvents'] if event['ph'] == 'M']
+        assert {event['name'] for event in thread_names} == {'thread_name'}